@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+本机FTP基准测试
+在本进程中启动 ftp_testserver.LocalFTPServer (可模拟延迟、带宽和会话数上限)，按几种文件大小组合生成测试数据，
+分别测量各个下载客户端：
+  downloader       FTPDownloader.download_with_resume，单连接逐个下载
+  segmented        FTPDownloader.download_segmented，大文件分段并行 (小文件自动退回单连接)
+  mirror           FTPDownloader.mirror，边遍历目录边并行下载
+  manager          GUI 的下载管理器 DownloadManager，工作线程
+  manager-async    DownloadManager + AsyncFTPConnection，事件循环中的协程
+  manager-process  DownloadManager 多进程后端
+另外测量大目录的列表时间 (MLSD 与 LIST)。每个测试在独立的子进程中运行，记录耗时、吞吐量、
+每个文件的平均耗时和内存峰值；结果写入JSON (--json)，便于对比不同版本，跟踪性能回归
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import multiprocessing
+from pathlib import Path
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from ftp_concurrency import ConcurrencyStore
+from ftp_downloader import FTPDownloader, parse_chunk_size
+from ftp_listing import ListingEngine
+from ftp_ratelimit import parse_rate
+from ftp_testserver import LocalFTPServer
+from ftp_transfer import DEFAULT_BUFFER_SIZE
+
+KB = 1024
+MB = 1024 ** 2
+
+# 文件大小组合: 名称 -> ((文件数, 每个文件的大小), ...)
+MIXES = {
+    'large': ((4, 64 * MB),),
+    'mixed': ((2, 32 * MB), (32, 1 * MB), (200, 16 * KB)),
+    'small': ((500, 4 * KB),),
+}
+CLIENTS = ('downloader', 'segmented', 'mirror', 'manager', 'manager-async', 'manager-process')
+FILES_PER_DIR = 100
+CONTEXT = multiprocessing.get_context('spawn')
+
+
+def make_dataset(root: Path, mix: str, scale: float, block: bytes):
+    """在 root/mix 下生成测试文件，每个子目录最多 FILES_PER_DIR 个文件；返回 [(相对路径, 大小)]"""
+    files = []
+    for count, size in MIXES[mix]:
+        size = max(1, int(size * scale))
+        for _ in range(count):
+            index = len(files)
+            rel = f"d{index // FILES_PER_DIR:03d}/f{index:05d}.bin"
+            path = root / mix / rel
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with open(path, 'wb') as f:
+                left = size
+                while left:
+                    left -= f.write(block[:min(left, len(block))])
+            files.append((rel, size))
+    return files
+
+
+def make_listing(root: Path, entries: int) -> str:
+    """生成一个含 entries 个空文件的目录，返回其远程路径"""
+    path = root / 'listing'
+    path.mkdir(parents=True, exist_ok=True)
+    for i in range(entries):
+        (path / f"entry-{i:06d}.dat").touch()
+    return '/listing'
+
+
+# ---------- 客户端 (在子进程中运行) ----------
+
+def bench_downloader(address, remote_dir, files, local_dir, options, segmented=False):
+    host, port = address
+    downloader = FTPDownloader(host, 'bench', 'bench', port, verify=options.verify)
+    if not downloader.connect():
+        raise ConnectionError(f"无法连接 {host}:{port}")
+    chunk_size = options.chunk_size or DEFAULT_BUFFER_SIZE
+    try:
+        for rel, _ in files:
+            remote_path, local_path = f"{remote_dir}/{rel}", local_dir / rel
+            if segmented:
+                downloader.download_segmented(remote_path, local_path, options.segments, chunk_size)
+            else:
+                downloader.download_with_resume(remote_path, local_path, chunk_size)
+    finally:
+        downloader.disconnect()
+
+
+def bench_segmented(address, remote_dir, files, local_dir, options):
+    bench_downloader(address, remote_dir, files, local_dir, options, segmented=True)
+
+
+def bench_mirror(address, remote_dir, files, local_dir, options):
+    host, port = address
+    downloader = FTPDownloader(host, 'bench', 'bench', port, verify=options.verify)
+    downloader.mirror(remote_dir, local_dir, jobs=options.jobs, chunk_size=options.chunk_size or DEFAULT_BUFFER_SIZE)
+
+
+def bench_manager(address, remote_dir, files, local_dir, options, is_async=False, processes=0):
+    # 导入 ftp_gui 需要 tkinter，只在测试下载管理器时导入
+    from ftp_gui import AsyncFTPConnection, DownloadManager, FTPConnection
+
+    conn = AsyncFTPConnection() if is_async else FTPConnection()
+    conn.connect(*address, 'bench', 'bench')
+    manager = DownloadManager(conn, processes=processes)
+    # 自动调节时学到的并发数保存在临时目录中，不影响本机已保存的设置
+    manager.auto_concurrency = options.auto_concurrency
+    manager.concurrency_store = ConcurrencyStore(local_dir.parent / 'concurrency.json')
+    manager.verify = options.verify
+    if options.chunk_size:
+        manager.chunk_size = options.chunk_size
+    manager.set_max_concurrent(options.jobs)
+    try:
+        for rel, size in files:
+            manager.add_task(f"{remote_dir}/{rel}", str(local_dir / rel), size)
+        manager.start_downloads()
+        while any(task.status in ("等待中", "下载中") for task in manager.tasks):
+            time.sleep(0.05)
+    finally:
+        manager.shutdown()
+        conn.disconnect()
+    # 等待工作进程退出，子进程的内存峰值才计入 RUSAGE_CHILDREN
+    for child in multiprocessing.active_children():
+        child.join(5)
+
+
+def bench_manager_async(address, remote_dir, files, local_dir, options):
+    bench_manager(address, remote_dir, files, local_dir, options, is_async=True)
+
+
+def bench_manager_process(address, remote_dir, files, local_dir, options):
+    bench_manager(address, remote_dir, files, local_dir, options, processes=options.processes)
+
+
+BENCHES = {
+    'downloader': bench_downloader,
+    'segmented': bench_segmented,
+    'mirror': bench_mirror,
+    'manager': bench_manager,
+    'manager-async': bench_manager_async,
+    'manager-process': bench_manager_process,
+}
+
+
+def bench_listing(address, list_address, remote_dir, repeat):
+    """分别用 MLSD 和 LIST 列出大目录，取最快一次 (毫秒)"""
+    import ftplib
+
+    result = {}
+    for method, (host, port) in (('mlsd', address), ('list', list_address)):
+        with ftplib.FTP() as ftp:
+            ftp.connect(host, port, 30)
+            ftp.login('bench', 'bench')
+            engine = ListingEngine(ftp)
+            best = None
+            for _ in range(repeat):
+                start = time.perf_counter()
+                entries = engine.list_dir(remote_dir)
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            if engine.last_method.lower() != method:
+                raise RuntimeError(f"期望 {method.upper()}，实际使用了 {engine.last_method}")
+        result['entries'] = len(entries)
+        result[f'{method}_ms'] = round(best * 1000, 1)
+    return result
+
+
+def _peak_rss_mb(who):
+    if resource is None:
+        return None
+    rss = resource.getrusage(who).ru_maxrss
+    # Linux 上单位为 KB，macOS 上为字节
+    return round(rss / (MB if sys.platform == 'darwin' else KB), 1)
+
+
+def _child(pipe, bench, args):
+    """子进程入口：客户端的进度输出丢弃，测量结果经管道返回"""
+    sys.stdout = sys.stderr = open(os.devnull, 'w', encoding='utf-8')
+    try:
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        result = bench(*args) or {}
+        result['seconds'] = time.perf_counter() - wall
+        result['cpu_seconds'] = round(time.process_time() - cpu, 3)
+        result['peak_rss_mb'] = _peak_rss_mb(resource.RUSAGE_SELF) if resource else None
+        if bench is bench_manager_process and resource is not None:
+            result['children_peak_rss_mb'] = _peak_rss_mb(resource.RUSAGE_CHILDREN)
+    except Exception as e:
+        result = {'error': f"{type(e).__name__}: {e}"}
+    pipe.send(result)
+    pipe.close()
+
+
+def run_child(bench, args, timeout):
+    """在子进程中运行 bench(*args) (模块级函数，返回附加结果的字典或 None)，超时后结束子进程"""
+    receiver, sender = CONTEXT.Pipe(duplex=False)
+    process = CONTEXT.Process(target=_child, args=(sender, bench, args))
+    process.start()
+    sender.close()
+    if receiver.poll(timeout):
+        try:
+            result = receiver.recv()
+        except EOFError:
+            result = {'error': f"子进程异常退出 (退出码 {process.exitcode})"}
+    else:
+        process.terminate()
+        result = {'error': f"超时 ({timeout}秒)"}
+    process.join()
+    return result
+
+
+def _check_files(local_dir: Path, files):
+    """返回 (大小与远程不一致或缺失的文件数, 完整下载的字节数)"""
+    failed = done = 0
+    for rel, size in files:
+        try:
+            if (local_dir / rel).stat().st_size == size:
+                done += size
+                continue
+        except OSError:
+            pass
+        failed += 1
+    return failed, done
+
+
+def run_case(server, client, mix, files, workdir: Path, options):
+    local_dir = workdir / 'out' / f'{client}-{mix}'
+    before = dict(server.stats)
+    result = run_child(BENCHES[client], (server.address, f'/{mix}', files, local_dir, options), options.timeout)
+    total = sum(size for _, size in files)
+    failed, done = _check_files(local_dir, files)
+    result.update({
+        'client': client,
+        'mix': mix,
+        'files': len(files),
+        'bytes': total,
+        'failed': failed,
+        'server_sessions': server.stats['sessions'] - before['sessions'],
+        'server_rejected': server.stats['rejected'] - before['rejected'],
+        'server_commands': server.stats['commands'] - before['commands'],
+    })
+    shutil.rmtree(local_dir, ignore_errors=True)
+    if 'seconds' in result:
+        seconds = result['seconds']
+        result['seconds'] = round(seconds, 4)
+        # 只按完整下载的文件计算吞吐量，失败的文件不计入
+        result['mb_per_s'] = round(done / seconds / MB, 1)
+        result['ms_per_file'] = round(seconds / len(files) * 1000, 2)
+    return result
+
+
+def add_overhead(results):
+    """按同一客户端在 large 组合中的吞吐量扣除传输时间，估算每个文件的固定开销 (毫秒)"""
+    rates = {r['client']: r['bytes'] / r['seconds'] for r in results
+             if r.get('mix') == 'large' and r.get('seconds') and not r.get('failed')}
+    for r in results:
+        rate = rates.get(r.get('client'))
+        if rate and r.get('seconds') and r['mix'] != 'large':
+            r['overhead_ms_per_file'] = round(max(0.0, r['seconds'] - r['bytes'] / rate) / r['files'] * 1000, 2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='本机FTP基准测试 (下载客户端、下载管理器和目录列表)')
+    parser.add_argument('--mixes', default=','.join(MIXES), help=f"文件大小组合，逗号分隔: {','.join(MIXES)}")
+    parser.add_argument('--clients', default=','.join(CLIENTS), help='要测试的客户端，逗号分隔')
+    parser.add_argument('--scale', type=float, default=1.0, help='文件大小的缩放比例 (默认1.0，large 组合共256MB)')
+    parser.add_argument('-n', '--repeat', type=int, default=1, help='每个组合重复次数，取最快一次 (默认1)')
+    parser.add_argument('-j', '--jobs', type=int, default=4, help='镜像和下载管理器的并发数 (默认4)')
+    parser.add_argument('-s', '--segments', type=int, default=4, help='分段下载的段数 (默认4)')
+    parser.add_argument('--processes', type=int, default=min(4, os.cpu_count() or 1),
+                        help='manager-process 的工作进程数')
+    parser.add_argument('-c', '--chunk-size', type=parse_chunk_size,
+                        help='接收缓冲区大小，同 ftp_downloader -c (默认各客户端自己的默认值)')
+    parser.add_argument('--auto-concurrency', action='store_true',
+                        help='下载管理器自动调节并发数 (会话数受限时减少并发后重试)')
+    parser.add_argument('--verify', action='store_true', help='下载时校验哈希 (服务器提供 HASH)')
+    parser.add_argument('--latency', type=float, default=0.0, help='模拟的往返延迟 (毫秒)')
+    parser.add_argument('--bandwidth', default='0', help='服务器合计发送速度上限，如 100M (默认不限速)')
+    parser.add_argument('--max-sessions', type=int, default=0, help='服务器同时连接的会话数上限 (默认不限制)')
+    parser.add_argument('--listing-entries', type=int, default=10000, help='列表测试的目录项数 (0 表示不测试)')
+    parser.add_argument('--timeout', type=int, default=600, help='每个测试的超时时间 (秒)')
+    parser.add_argument('--json', metavar='FILE', help='结果写入JSON文件')
+    args = parser.parse_args()
+
+    mixes = [m for m in args.mixes.split(',') if m]
+    clients = [c for c in args.clients.split(',') if c]
+    for name in mixes + clients:
+        if name not in MIXES and name not in BENCHES:
+            parser.error(f"未知的组合或客户端: {name}")
+    limits = {'latency_ms': args.latency, 'bandwidth': parse_rate(args.bandwidth), 'max_sessions': args.max_sessions}
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix='bench_ftp_') as tmp:
+        workdir = Path(tmp)
+        root = workdir / 'root'
+        block = os.urandom(MB)
+        datasets = {mix: make_dataset(root, mix, args.scale, block) for mix in mixes}
+        listing = make_listing(root, args.listing_entries) if args.listing_entries else None
+
+        server = LocalFTPServer(root, latency=args.latency / 1000, bandwidth=limits['bandwidth'],
+                                max_sessions=args.max_sessions).start()
+        print(f"📡 测试服务器 {server.address[0]}:{server.address[1]} "
+              f"(延迟 {args.latency}ms, 带宽 {args.bandwidth}, 会话上限 {args.max_sessions or '不限'})")
+        print(f"{'客户端':<18}{'组合':<8}{'文件':>6}{'MB/s':>10}{'ms/文件':>10}{'内存MB':>9}{'失败':>6}")
+        try:
+            for mix in mixes:
+                for client in clients:
+                    runs = [run_case(server, client, mix, datasets[mix], workdir, args) for _ in range(args.repeat)]
+                    ok = [r for r in runs if 'seconds' in r] or runs
+                    best = min(ok, key=lambda r: r.get('seconds', 0))
+                    results.append(best)
+                    if 'error' in best:
+                        print(f"{client:<18}{mix:<8}{best['files']:>6}  ✗ {best['error']}")
+                    else:
+                        print(f"{client:<18}{mix:<8}{best['files']:>6}{best['mb_per_s']:>10.1f}"
+                              f"{best['ms_per_file']:>10.2f}{best['peak_rss_mb'] or 0:>9.1f}{best['failed']:>6}")
+
+            if listing:
+                with LocalFTPServer(root, latency=args.latency / 1000, bandwidth=limits['bandwidth'],
+                                    mlsd=False) as list_server:
+                    result = run_child(bench_listing, (server.address, list_server.address, listing, 3),
+                                       args.timeout)
+                result['client'] = 'listing'
+                results.append(result)
+                if 'error' in result:
+                    print(f"📂 列表测试失败: {result['error']}")
+                else:
+                    result['seconds'] = round(result['seconds'], 4)
+                    print(f"📂 列出 {result['entries']} 项: MLSD {result['mlsd_ms']}ms, LIST {result['list_ms']}ms")
+        finally:
+            server.stop()
+
+    add_overhead(results)
+    if args.json:
+        report = {
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'server': dict(limits, **server.stats),
+            'options': {'scale': args.scale, 'repeat': args.repeat, 'jobs': args.jobs, 'segments': args.segments,
+                        'processes': args.processes, 'chunk_size': args.chunk_size, 'verify': args.verify,
+                        'auto_concurrency': args.auto_concurrency},
+            'results': results,
+        }
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    return 1 if any('error' in r or r.get('failed') for r in results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+断线重试基准测试
+在 ftp_testserver.LocalFTPServer 前面放一个 ftp_faultproxy.FaultProxy，按几种故障场景注入数据连接重置、
+停止转发、延迟和抖动，分别测量各个客户端在不同重试策略下的表现：
+  downloader       FTPDownloader.download_with_resume，出错后按策略等待、重连并续传
+  manager          GUI 的下载管理器 DownloadManager，出错的任务按策略等待后重新排队
+  manager-async    DownloadManager + AsyncFTPConnection
+重试策略除 ftp_retry.POLICIES 中的几种外，none 表示不重试 (出错即失败)，作为对照。
+同一场景下每次运行前重置代理，各策略遇到的故障序列相同。记录完成的文件数、有效吞吐量 (只计完整下载的文件)、
+代理实际转发的字节数、注入的故障数和每次故障到同一文件重新开始传输的恢复时间；结果写入JSON (--json)
+"""
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import statistics
+import tempfile
+from dataclasses import asdict
+from pathlib import Path
+
+from bench_ftp import MB, _check_files, run_child
+from ftp_downloader import FTPDownloader, parse_chunk_size, parse_limit_rate
+from ftp_faultproxy import FaultProfile, FaultProxy
+from ftp_ratelimit import parse_rate
+from ftp_retry import POLICIES
+from ftp_testserver import LocalFTPServer
+from ftp_transfer import DEFAULT_BUFFER_SIZE
+
+# 故障场景: 名称 -> FaultProfile 参数 (故障位置在文件大小范围内随机选择)
+SCENARIOS = {
+    'reset': {'reset_rate': 0.3},
+    'stall': {'stall_rate': 0.2},
+    'flaky': {'delay': 0.005, 'jitter': 0.005, 'reset_rate': 0.15, 'stall_rate': 0.1},
+}
+CLIENTS = ('downloader', 'manager', 'manager-async')
+REMOTE_DIR = '/retry'
+
+
+def make_dataset(root: Path, count: int, size: int):
+    """在 root/retry 下生成 count 个大小为 size 的文件；返回 [(相对路径, 大小)]"""
+    path = root / REMOTE_DIR.lstrip('/')
+    path.mkdir(parents=True, exist_ok=True)
+    block = os.urandom(min(size, MB))
+    files = []
+    for i in range(count):
+        rel = f"f{i:04d}.bin"
+        with open(path / rel, 'wb') as f:
+            left = size
+            while left:
+                left -= f.write(block[:min(left, len(block))])
+        files.append((rel, size))
+    return files
+
+
+# ---------- 客户端 (在子进程中运行) ----------
+
+def bench_downloader(address, files, local_dir, options, policy):
+    host, port = address
+    downloader = FTPDownloader(host, 'bench', 'bench', port, timeout=options.client_timeout,
+                               retry_policy=POLICIES.get(policy))
+    if not downloader.connect():
+        raise ConnectionError(f"无法连接 {host}:{port}")
+    # max_retries 是总尝试次数
+    attempts = 1 if policy == 'none' else options.retries + 1
+    chunk_size = options.chunk_size or DEFAULT_BUFFER_SIZE
+    try:
+        for rel, _ in files:
+            if not downloader.download_with_resume(f"{REMOTE_DIR}/{rel}", local_dir / rel, chunk_size, attempts):
+                # 放弃的文件可能留下未读完的回复，重新连接后再下载下一个
+                downloader.disconnect()
+                if not downloader.connect():
+                    raise ConnectionError(f"无法连接 {host}:{port}")
+    finally:
+        downloader.disconnect()
+
+
+def bench_manager(address, files, local_dir, options, policy, is_async=False):
+    # 导入 ftp_gui 需要 tkinter，只在测试下载管理器时导入
+    from ftp_async import AsyncConnectionPool
+    from ftp_gui import AsyncFTPConnection, DownloadManager, FTPConnection
+    from ftp_pool import FTPConnectionPool
+
+    pool = FTPConnectionPool(timeout=options.client_timeout)
+    if is_async:
+        conn = AsyncFTPConnection(pool, AsyncConnectionPool(timeout=options.client_timeout))
+    else:
+        conn = FTPConnection(pool)
+    conn.connect(*address, 'bench', 'bench', options.client_timeout)
+    manager = DownloadManager(conn)
+    manager.max_retries = 0 if policy == 'none' else options.retries
+    if policy != 'none':
+        manager.retry_policy = POLICIES[policy]
+    if options.chunk_size:
+        manager.chunk_size = options.chunk_size
+    manager.set_max_concurrent(options.jobs)
+    try:
+        for rel, size in files:
+            manager.add_task(f"{REMOTE_DIR}/{rel}", str(local_dir / rel), size)
+        manager.start_downloads()
+        while any(task.status in ("等待中", "下载中") for task in manager.tasks):
+            time.sleep(0.05)
+        return {'retries': sum(task.retries for task in manager.tasks)}
+    finally:
+        manager.shutdown()
+        conn.disconnect()
+
+
+def bench_manager_async(address, files, local_dir, options, policy):
+    return bench_manager(address, files, local_dir, options, policy, is_async=True)
+
+
+BENCHES = {
+    'downloader': bench_downloader,
+    'manager': bench_manager,
+    'manager-async': bench_manager_async,
+}
+
+
+def run_case(proxy, profile, scenario, client, policy, files, workdir: Path, options):
+    local_dir = workdir / 'out' / f'{scenario}-{client}-{policy}'
+    proxy.reset(profile)
+    result = run_child(BENCHES[client], (proxy.address, files, local_dir, options, policy), options.timeout)
+    failed, done = _check_files(local_dir, files)
+    events = list(proxy.events)
+    recovered = [e.recovered for e in events if e.recovered is not None]
+    result.update({
+        'scenario': scenario,
+        'client': client,
+        'policy': policy,
+        'files': len(files),
+        'bytes': sum(size for _, size in files),
+        'failed': failed,
+        'transferred': proxy.stats['bytes'],
+        'resets': proxy.stats['resets'],
+        'stalls': proxy.stats['stalls'],
+        'recovered': len(recovered),
+        'unrecovered': len(events) - len(recovered),
+    })
+    if recovered:
+        result['recover_mean_s'] = round(statistics.mean(recovered), 3)
+        result['recover_p50_s'] = round(statistics.median(recovered), 3)
+        result['recover_max_s'] = round(max(recovered), 3)
+    if proxy.stats['bytes']:
+        # 完整下载的字节占实际转发字节的比例，重复传输和放弃的部分越多越低
+        result['efficiency'] = round(done / proxy.stats['bytes'], 3)
+    if 'seconds' in result:
+        seconds = result['seconds']
+        result['seconds'] = round(seconds, 3)
+        result['goodput_mb_s'] = round(done / seconds / MB, 1)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='断线重试基准测试 (故障注入代理 + 本机FTP服务器)')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help=f"故障场景，逗号分隔: {','.join(SCENARIOS)}")
+    parser.add_argument('--clients', default=','.join(CLIENTS), help='要测试的客户端，逗号分隔')
+    parser.add_argument('--policies', default=','.join(['none'] + sorted(POLICIES)),
+                        help='重试策略，逗号分隔 (none 表示不重试)')
+    parser.add_argument('--files', type=int, default=8, help='测试文件数 (默认8)')
+    parser.add_argument('--size', type=parse_limit_rate, default=8 * MB, help='每个文件的大小，如 8M (默认8M)')
+    parser.add_argument('-j', '--jobs', type=int, default=4, help='下载管理器的并发数 (默认4)')
+    parser.add_argument('-r', '--retries', type=int, default=5, help='每个文件最多重试次数 (默认5)')
+    parser.add_argument('-c', '--chunk-size', type=parse_chunk_size,
+                        help='接收缓冲区大小，同 ftp_downloader -c (默认各客户端自己的默认值)')
+    parser.add_argument('--client-timeout', type=float, default=5.0,
+                        help='客户端的套接字超时 (秒)，停止转发的连接要等这么久才会被发现 (默认5)')
+    parser.add_argument('--bandwidth', default='0', help='代理转发下载数据的合计速度上限，如 100M (默认不限速)')
+    parser.add_argument('--seed', type=int, default=1, help='故障序列的随机种子 (默认1)')
+    parser.add_argument('--timeout', type=int, default=600, help='每个测试的超时时间 (秒)')
+    parser.add_argument('--json', metavar='FILE', help='结果写入JSON文件')
+    args = parser.parse_args()
+
+    scenarios = [s for s in args.scenarios.split(',') if s]
+    clients = [c for c in args.clients.split(',') if c]
+    policies = [p for p in args.policies.split(',') if p]
+    for name in scenarios + clients + policies:
+        if name not in SCENARIOS and name not in BENCHES and name not in POLICIES and name != 'none':
+            parser.error(f"未知的场景、客户端或重试策略: {name}")
+    profiles = {name: FaultProfile(bandwidth=parse_rate(args.bandwidth), fault_after=args.size, seed=args.seed,
+                                   **SCENARIOS[name])
+                for name in scenarios}
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix='bench_retry_') as tmp:
+        workdir = Path(tmp)
+        root = workdir / 'root'
+        files = make_dataset(root, args.files, args.size)
+        with LocalFTPServer(root) as server, FaultProxy(server.address) as proxy:
+            print(f"📡 测试服务器 {server.address[0]}:{server.address[1]}，"
+                  f"故障注入代理 {proxy.address[0]}:{proxy.address[1]}")
+            print(f"{'场景':<8}{'客户端':<16}{'策略':<11}{'秒':>8}{'完成':>6}{'MB/s':>8}"
+                  f"{'故障':>6}{'恢复':>6}{'平均恢复s':>10}{'最长恢复s':>10}")
+            for scenario in scenarios:
+                for client in clients:
+                    for policy in policies:
+                        r = run_case(proxy, profiles[scenario], scenario, client, policy, files, workdir, args)
+                        results.append(r)
+                        faults = r['resets'] + r['stalls']
+                        if 'error' in r:
+                            print(f"{scenario:<8}{client:<16}{policy:<11}  ✗ {r['error']}")
+                        else:
+                            print(f"{scenario:<8}{client:<16}{policy:<11}{r['seconds']:>8.2f}"
+                                  f"{r['files'] - r['failed']:>6}{r['goodput_mb_s']:>8.1f}{faults:>6}"
+                                  f"{r['recovered']:>6}{r.get('recover_mean_s', 0):>10.2f}"
+                                  f"{r.get('recover_max_s', 0):>10.2f}")
+
+    if args.json:
+        report = {
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'scenarios': {name: asdict(profile) for name, profile in profiles.items()},
+            'policies': {name: asdict(POLICIES[name]) for name in policies if name in POLICIES},
+            'options': {'files': args.files, 'size': args.size, 'jobs': args.jobs, 'retries': args.retries,
+                        'chunk_size': args.chunk_size, 'client_timeout': args.client_timeout},
+            'results': results,
+        }
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    return 1 if any('error' in r for r in results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+接收通道基准测试
+发送端在独立进程中经本机回环 TCP 连接发送数据，接收端分别用以下方式写入临时文件：
+  retrbinary  ftplib.retrbinary 的做法，每 8KB 一个 bytes 对象，回调中 f.write
+  recv_into   ftp_transfer.receive_into，大缓冲区整块写入 (当前默认路径)
+  splice      ftp_transfer.splice_into，数据经管道在内核中移入文件 (仅 Linux)
+每种方式再分别测试不计算哈希、只计算分块CRC (默认下载都会计算)、分块CRC + SHA-256 (--verify)。
+输出吞吐量和接收进程的CPU时间
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import tempfile
+import multiprocessing
+
+from ftp_integrity import BlockLog, StreamHash, combine
+from ftp_transfer import DEFAULT_BUFFER_SIZE, SPLICE, receive_into
+
+HASH_MODES = ('none', 'blocks', 'sha256')
+
+
+def _sender(listener, size, rounds):
+    """发送端进程：每个连接发送 size 字节后关闭"""
+    chunk = os.urandom(DEFAULT_BUFFER_SIZE)
+    for _ in range(rounds):
+        conn, _ = listener.accept()
+        with conn:
+            left = size
+            while left:
+                n = conn.send(memoryview(chunk)[:min(left, len(chunk))])
+                left -= n
+    listener.close()
+
+
+def _receive(method, conn, f, hasher):
+    if method == 'retrbinary':
+        received = 0
+        while True:
+            data = conn.recv(8192)
+            if not data:
+                break
+            f.write(data)
+            if hasher is not None:
+                hasher.update(data)
+            received += len(data)
+        return received
+    return receive_into(conn, f, SPLICE if method == 'splice' else DEFAULT_BUFFER_SIZE, hasher=hasher)
+
+
+def run_case(address, method, hash_mode, size, workdir):
+    path = os.path.join(workdir, f'{method}-{hash_mode}.bin')
+    blocks = None
+    hasher = None
+    if hash_mode != 'none':
+        blocks = BlockLog(path, size)
+        blocks.start([])
+        hasher = StreamHash('sha256') if hash_mode == 'sha256' else None
+    with socket.create_connection(address) as conn, open(path, 'wb', buffering=0) as f:
+        conn.settimeout(30)
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        received = _receive(method, conn, f, combine(hasher, blocks))
+        cpu = time.process_time() - cpu
+        wall = time.perf_counter() - wall
+    if blocks is not None:
+        blocks.remove()
+    os.remove(path)
+    if received != size:
+        raise IOError(f"{method}: 收到 {received}/{size} 字节")
+    return {
+        'method': method,
+        'hash': hash_mode,
+        'bytes': size,
+        'seconds': round(wall, 4),
+        'mb_per_s': round(size / wall / 1024 ** 2, 1),
+        'cpu_seconds': round(cpu, 4),
+        'cpu_ms_per_gb': round(cpu / size * 1024 ** 3 * 1000, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='接收通道基准测试 (recv_into 与 splice 对比)')
+    parser.add_argument('-s', '--size', type=int, default=512, help='每次传输的数据量 (MB，默认512)')
+    parser.add_argument('-n', '--repeat', type=int, default=3, help='每种组合重复次数，取最快一次 (默认3)')
+    parser.add_argument('--methods', default='retrbinary,recv_into,splice', help='要测试的接收方式，逗号分隔')
+    parser.add_argument('--hash', default=','.join(HASH_MODES), help='哈希组合: none,blocks,sha256')
+    parser.add_argument('--json', metavar='FILE', help='结果写入JSON文件')
+    args = parser.parse_args()
+
+    size = args.size * 1024 * 1024
+    methods = [m for m in args.methods.split(',') if m]
+    hash_modes = [h for h in args.hash.split(',') if h]
+    if 'splice' in methods and not hasattr(os, 'splice'):
+        print("⚠️ 当前平台不支持 os.splice，跳过 splice", file=sys.stderr)
+        methods.remove('splice')
+
+    listener = socket.create_server(('127.0.0.1', 0))
+    rounds = len(methods) * len(hash_modes) * args.repeat
+    sender = multiprocessing.get_context('spawn').Process(target=_sender, args=(listener, size, rounds),
+                                                          daemon=True)
+    sender.start()
+    address = listener.getsockname()
+
+    results = []
+    print(f"{'方式':<12}{'哈希':<8}{'MB/s':>10}{'CPU ms/GB':>12}")
+    with tempfile.TemporaryDirectory() as workdir:
+        for hash_mode in hash_modes:
+            for method in methods:
+                runs = [run_case(address, method, hash_mode, size, workdir) for _ in range(args.repeat)]
+                best = min(runs, key=lambda r: r['seconds'])
+                results.append(best)
+                print(f"{method:<12}{hash_mode:<8}{best['mb_per_s']:>10.1f}{best['cpu_ms_per_gb']:>12.1f}")
+    sender.join()
+    listener.close()
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'size': size, 'repeat': args.repeat, 'results': results}, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
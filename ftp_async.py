@@ -0,0 +1,636 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+异步FTP客户端
+用 asyncio 在一个事件循环里驱动成千上万个并发会话，每个会话只占一个协程和两个套接字，不占线程。
+接口与 ftplib.FTP 对应 (connect/login/sendcmd/voidcmd/transfercmd/size/cwd/pwd/nlst)，错误类型也相同；
+另外提供流水线SIZE、MLSD/LIST目录列表，以及把数据写入异步文件写入器的 retrieve。
+文件写入和哈希计算在线程池中执行，事件循环只做网络读写
+"""
+
+import time
+import socket
+import ftplib
+import asyncio
+import threading
+from concurrent.futures import Future
+from contextlib import asynccontextmanager
+from typing import Callable, Dict, List, Optional
+
+from ftp_listing import RemoteEntry, feature_params, parse_list_line, parse_mlsd_line
+from ftp_pool import FTPConnectionPool
+from ftp_storage import preallocate
+from ftp_transfer import PROGRESS_INTERVAL, _write_all
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+ASYNC_READ_SIZE = 256 * 1024    # 每次从数据连接读取的上限
+ASYNC_FLUSH_SIZE = 1024 * 1024  # 写入器缓冲满这么多数据后交给线程池写入文件
+FD_LIMIT = 65536                # 每个并发传输占用控制连接、数据连接和本地文件三个描述符
+CRLF = '\r\n'
+
+
+class AsyncFTP:
+    """一个异步FTP会话 (只用被动模式)
+
+    一个会话同一时间只能执行一条命令，与 ftplib.FTP 相同；并发靠多个会话实现
+    """
+
+    encoding = 'utf-8'
+
+    def __init__(self, timeout: float = 30, encoding: Optional[str] = None):
+        self.timeout = timeout
+        if encoding:
+            self.encoding = encoding
+        self.host = ''
+        self.port = 21
+        self.welcome = ''
+        self.epsv = True  # 服务器拒绝EPSV后本会话改用PASV
+        self.last_method = ''
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._features = None
+        self._mlsd_ok = None
+
+    # ---------- 控制连接 ----------
+
+    async def connect(self, host: str, port: int = 21, timeout: Optional[float] = None) -> str:
+        if timeout is not None:
+            self.timeout = timeout
+        self.host, self.port = host, int(port)
+        self._reader, self._writer = await self._wait(asyncio.open_connection(self.host, self.port))
+        self.welcome = await self.getresp()
+        return self.welcome
+
+    async def login(self, user: str = '', passwd: str = '', acct: str = '') -> str:
+        user = user or 'anonymous'
+        if user == 'anonymous' and passwd in ('', '-'):
+            passwd = 'anonymous@'
+        resp = await self.sendcmd('USER ' + user)
+        if resp[0] == '3':
+            resp = await self.sendcmd('PASS ' + passwd)
+        if resp[0] == '3':
+            resp = await self.sendcmd('ACCT ' + acct)
+        if resp[0] != '2':
+            raise ftplib.error_reply(resp)
+        return resp
+
+    def putcmd(self, line: str):
+        """只写入命令不等待回复 (流水线发送时使用)"""
+        if '\r' in line or '\n' in line:
+            raise ValueError('an illegal newline character should not be contained')
+        self._writer.write((line + CRLF).encode(self.encoding, 'surrogateescape'))
+
+    async def getresp(self) -> str:
+        """读取一个 (可能跨多行的) 回复，4xx/5xx 抛出与 ftplib 相同的异常"""
+        line = await self._getline()
+        if line[3:4] == '-':
+            code = line[:3]
+            lines = [line]
+            while True:
+                next_line = await self._getline()
+                lines.append(next_line)
+                if next_line[:3] == code and next_line[3:4] != '-':
+                    break
+            line = '\n'.join(lines)
+        kind = line[:1]
+        if kind in ('1', '2', '3'):
+            return line
+        if kind == '4':
+            raise ftplib.error_temp(line)
+        if kind == '5':
+            raise ftplib.error_perm(line)
+        raise ftplib.error_proto(line)
+
+    async def voidresp(self) -> str:
+        resp = await self.getresp()
+        if resp[:1] != '2':
+            raise ftplib.error_reply(resp)
+        return resp
+
+    async def sendcmd(self, cmd: str) -> str:
+        self.putcmd(cmd)
+        await self._wait(self._writer.drain())
+        return await self.getresp()
+
+    async def voidcmd(self, cmd: str) -> str:
+        self.putcmd(cmd)
+        await self._wait(self._writer.drain())
+        return await self.voidresp()
+
+    async def quit(self) -> str:
+        try:
+            return await self.voidcmd('QUIT')
+        finally:
+            self.close()
+
+    def close(self):
+        writer, self._writer, self._reader = self._writer, None, None
+        if writer is not None:
+            writer.close()
+
+    @property
+    def connected(self) -> bool:
+        return self._writer is not None and not self._writer.is_closing()
+
+    async def _getline(self) -> str:
+        line = await self._wait(self._reader.readline())
+        if not line:
+            raise EOFError
+        return line.decode(self.encoding, 'surrogateescape').rstrip('\r\n')
+
+    async def _wait(self, awaitable):
+        """按会话超时等待，超时时抛出与 ftplib 相同的 socket.timeout"""
+        try:
+            return await asyncio.wait_for(awaitable, self.timeout)
+        except asyncio.TimeoutError:
+            raise socket.timeout('timed out') from None
+
+    # ---------- 数据连接 ----------
+
+    async def makepasv(self):
+        """优先EPSV (IPv6和NAT后的服务器也能用)，被拒绝时回退到PASV"""
+        peer = self._writer.get_extra_info('peername')
+        if self.epsv:
+            try:
+                return ftplib.parse229(await self.sendcmd('EPSV'), peer)
+            except ftplib.error_perm:
+                self.epsv = False
+        _, port = ftplib.parse227(await self.sendcmd('PASV'))
+        # 与 ftplib 默认行为一致，不用PASV返回的地址 (NAT后的服务器常返回内网地址)
+        return peer[0], port
+
+    async def transfercmd(self, cmd: str, rest=None):
+        """建立数据连接并发送命令，返回数据连接的 (reader, writer)"""
+        host, port = await self.makepasv()
+        reader, writer = await self._wait(asyncio.open_connection(host, port, limit=ASYNC_READ_SIZE))
+        try:
+            if rest is not None:
+                await self.sendcmd(f'REST {rest}')
+            resp = await self.sendcmd(cmd)
+            # 部分服务器先回复2xx再回复1xx
+            if resp[0] == '2':
+                resp = await self.getresp()
+            if resp[0] != '1':
+                raise ftplib.error_reply(resp)
+        except BaseException:
+            writer.close()
+            raise
+        return reader, writer
+
+    async def retrlines(self, cmd: str, callback: Callable[[str], None]) -> str:
+        await self.voidcmd('TYPE A')
+        reader, conn = await self.transfercmd(cmd)
+        try:
+            while True:
+                line = await self._wait(reader.readline())
+                if not line:
+                    break
+                callback(line.decode(self.encoding, 'surrogateescape').rstrip('\r\n'))
+        finally:
+            conn.close()
+        return await self.voidresp()
+
+    async def retrbytes(self, cmd: str, max_size: Optional[int] = None) -> bytes:
+        """以二进制模式读取一个小文件，只保留前 max_size 字节
+
+        中途断开数据连接会让控制连接的应答错位，所以总会读完
+        """
+        await self.voidcmd('TYPE I')
+        reader, conn = await self.transfercmd(cmd)
+        chunks = []
+        total = 0
+        try:
+            while True:
+                data = await self._wait(reader.read(ASYNC_READ_SIZE))
+                if not data:
+                    break
+                if max_size is None or total < max_size:
+                    chunks.append(data)
+                    total += len(data)
+        finally:
+            conn.close()
+        await self.voidresp()
+        data = b''.join(chunks)
+        return data if max_size is None else data[:max_size]
+
+    async def retrieve(self, remote_path: str, writer: 'AsyncFileWriter', rest=None, limit=None,
+                       progress=None, interval=PROGRESS_INTERVAL, limiter=None,
+                       read_size=ASYNC_READ_SIZE) -> int:
+        """以二进制模式下载 remote_path 写入 writer，rest 为续传起点；返回本次写入的字节数
+
+        limit 限制最多读取的字节数 (修复指定范围用)；
+        progress(已写入字节数) 按 interval 采样调用，调用前先等待缓冲区写入文件，
+        因此回调看到的字节数一定已经落盘；回调返回 False 时停止接收；
+        limiter 为 ftp_ratelimit.RateLimiter 时按限速用 asyncio.sleep 等待，不阻塞事件循环
+        """
+        await self.voidcmd('TYPE I')
+        reader, conn = await self.transfercmd(f'RETR {remote_path}', rest)
+        received = 0
+        stopped = False
+        last_report = time.monotonic()
+        try:
+            while limit is None or received < limit:
+                want = read_size if limit is None else min(read_size, limit - received)
+                if limiter is not None:
+                    want = limiter.chunk_size(want)
+                data = await self._wait(reader.read(want))
+                if not data:
+                    break
+                received += len(data)
+                await writer.write(data)
+                if limiter is not None:
+                    wait = limiter.reserve(len(data))
+                    if wait > 0:
+                        await asyncio.sleep(wait)
+
+                if progress is not None:
+                    now = time.monotonic()
+                    if now - last_report >= interval:
+                        last_report = now
+                        await writer.flush()
+                        if progress(received) is False:
+                            stopped = True
+                            break
+        finally:
+            conn.close()
+        await writer.flush()
+        if progress is not None:
+            progress(received)
+
+        try:
+            await self.voidresp()
+        except ftplib.error_temp:
+            # 提前关闭数据连接时服务器会回复426
+            if not stopped and (limit is None or received < limit):
+                raise
+        return received
+
+    # ---------- 文件和目录 ----------
+
+    async def size(self, path: str) -> Optional[int]:
+        resp = await self.sendcmd(f'SIZE {path}')
+        if resp[:3] == '213':
+            return int(resp[3:].strip())
+        return None
+
+    async def sizes(self, paths: List[str]) -> Dict[str, Optional[int]]:
+        """流水线发送SIZE命令，一次往返取回整批文件大小 (同 ftp_pool.fetch_sizes)"""
+        await self.voidcmd('TYPE I')
+        for path in paths:
+            self.putcmd(f'SIZE {path}')
+        await self._wait(self._writer.drain())
+
+        sizes = {}
+        for path in paths:
+            try:
+                resp = await self.getresp()
+            except (ftplib.error_perm, ftplib.error_temp):
+                sizes[path] = None
+                continue
+            try:
+                sizes[path] = int(resp[3:].strip()) if resp[:3] == '213' else None
+            except ValueError:
+                sizes[path] = None
+        return sizes
+
+    async def cwd(self, dirname: str) -> str:
+        if dirname == '..':
+            try:
+                return await self.voidcmd('CDUP')
+            except ftplib.error_perm as e:
+                if e.args[0][:3] != '500':
+                    raise
+        elif dirname == '':
+            dirname = '.'
+        return await self.voidcmd('CWD ' + dirname)
+
+    async def pwd(self) -> str:
+        resp = await self.voidcmd('PWD')
+        return ftplib.parse257(resp) if resp[:3] == '257' else ''
+
+    async def nlst(self, path: str = '') -> List[str]:
+        names = []
+        await self.retrlines(f'NLST {path}' if path else 'NLST', names.append)
+        return names
+
+    async def features(self) -> Dict[str, str]:
+        """查询服务器FEAT (每个会话只查询一次)，返回命令名 -> 参数"""
+        if self._features is None:
+            try:
+                self._features = feature_params(await self.sendcmd('FEAT'))
+            except ftplib.all_errors:
+                self._features = {}
+        return self._features
+
+    async def list_dir(self, path: str = '') -> List[RemoteEntry]:
+        """列出目录，依次尝试 MLSD -> LIST -> NLST (同 ftp_listing.ListingEngine)"""
+        if self._mlsd_ok is None:
+            features = await self.features()
+            self._mlsd_ok = 'MLST' in features or 'MLSD' in features
+        if self._mlsd_ok:
+            try:
+                entries = []
+                await self.retrlines(f'MLSD {path}' if path else 'MLSD',
+                                     lambda line: _append(entries, parse_mlsd_line(line)))
+                self.last_method = 'MLSD'
+                return entries
+            except ftplib.error_perm:
+                self._mlsd_ok = False
+
+        try:
+            entries = []
+            now = time.time()
+            await self.retrlines(f'LIST {path}' if path else 'LIST',
+                                 lambda line: _append(entries, parse_list_line(line, now)))
+            self.last_method = 'LIST'
+            return entries
+        except ftplib.error_perm:
+            names = await self.nlst(path)
+            self.last_method = 'NLST'
+            return [RemoteEntry(name=n.rsplit('/', 1)[-1], size=0, is_dir=False, mtime=None)
+                    for n in names if n not in ('.', '..')]
+
+
+def _append(entries, entry):
+    if entry:
+        entries.append(entry)
+
+
+class AsyncFileWriter:
+    """异步文件写入器：数据先进入内存缓冲区，满 flush_size 后由线程池写入文件
+
+    hasher 为 ftp_integrity.StreamHash 等对象时，写入文件后的数据同时计入哈希 (也在线程池中计算)；
+    offset 不为 None 时以 r+b 打开并定位到该位置 (修复指定范围)，否则按 mode 打开；
+    allocate 大于0时打开后为文件预先分配这么多字节的磁盘空间 (不改变文件长度)
+    """
+
+    def __init__(self, path, mode: str = 'ab', flush_size: int = ASYNC_FLUSH_SIZE,
+                 hasher=None, offset: Optional[int] = None, executor=None, allocate: int = 0):
+        self.path = path
+        self.mode = mode
+        self.allocate = allocate
+        self.flush_size = flush_size
+        self.hasher = hasher
+        self.offset = offset
+        self.executor = executor  # None 时使用事件循环的默认线程池
+        self.written = 0          # 已写入文件的字节数
+        self._file = None
+        self._chunks: List[bytes] = []
+        self._buffered = 0
+
+    async def open(self) -> 'AsyncFileWriter':
+        self._file = await self._run(self._open)
+        return self
+
+    def _open(self):
+        if self.offset is None:
+            f = open(self.path, self.mode, buffering=0)
+            try:
+                preallocate(f, self.allocate)
+            except OSError:
+                f.close()
+                raise
+            return f
+        f = open(self.path, 'r+b', buffering=0)
+        f.seek(self.offset)
+        return f
+
+    async def write(self, data: bytes):
+        self._chunks.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self.flush_size:
+            await self.flush()
+
+    async def flush(self):
+        """把缓冲区写入文件，返回后数据已交给操作系统"""
+        if not self._buffered:
+            return
+        data = self._chunks[0] if len(self._chunks) == 1 else b''.join(self._chunks)
+        self._chunks = []
+        self._buffered = 0
+        await self._run(_write_all, self._file, data, self.hasher)
+        self.written += len(data)
+
+    async def close(self):
+        if self._file is None:
+            return
+        try:
+            await self.flush()
+        finally:
+            f, self._file = self._file, None
+            await self._run(f.close)
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def _run(self, func, *args):
+        return asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+
+class AsyncConnectionPool:
+    """FTPConnectionPool 的异步版本，按 (主机, 端口, 用户名) 复用已登录的 AsyncFTP 会话
+
+    只能在一个事件循环内使用，除 latency/get_stats/format_stats 外都要在事件循环线程中调用
+    """
+
+    def __init__(self, max_per_key: int = 1000, idle_timeout: float = 60, timeout: float = 30):
+        self.max_per_key = max_per_key
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+
+        self._idle = {}       # key -> [(client, 归还时间), ...]
+        self._in_use = {}     # key -> 已借出的会话数
+        self._owners = {}     # id(client) -> key
+        self._rtt = {}        # key -> 健康检查NOOP往返时间 (指数平滑，秒)
+        self._cond: Optional[asyncio.Condition] = None  # 在事件循环内首次使用时创建
+
+        # 统计信息
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    make_key = staticmethod(FTPConnectionPool.make_key)
+
+    async def acquire(self, host, port, username, password) -> AsyncFTP:
+        """借出一个已登录的会话，池满时等待其他协程归还"""
+        key = self.make_key(host, port, username)
+        cond = self._condition()
+
+        while True:
+            client = None
+            async with cond:
+                while True:
+                    self._evict_expired(key)
+                    idle = self._idle.get(key)
+                    if idle:
+                        client, _ = idle.pop()
+                        self._checkout(key, client)
+                        break
+                    if self._in_use.get(key, 0) < self.max_per_key:
+                        # 先占位，登录时不持有锁
+                        self._in_use[key] = self._in_use.get(key, 0) + 1
+                        self.misses += 1
+                        break
+                    await cond.wait()
+
+            if client is None:
+                break
+
+            # 复用前用NOOP做健康检查，顺便测量控制连接往返时间
+            started = time.monotonic()
+            if await self._is_alive(client):
+                rtt = time.monotonic() - started
+                self.hits += 1
+                last = self._rtt.get(key)
+                self._rtt[key] = rtt if last is None else last + 0.3 * (rtt - last)
+                return client
+            self.evictions += 1
+            await self.release(client, discard=True)
+
+        client = AsyncFTP(self.timeout)
+        try:
+            await client.connect(host, int(port))
+            await client.login(username, password)
+        except BaseException:
+            client.close()
+            async with cond:
+                self._in_use[key] -= 1
+                cond.notify()
+            raise
+
+        self._owners[id(client)] = key
+        return client
+
+    async def release(self, client: AsyncFTP, discard: bool = False):
+        """归还会话；传输出错时应 discard=True，直接关闭而不放回池中"""
+        key = self._owners.pop(id(client), None)
+        if key is None:
+            return
+        if discard or not client.connected:
+            client.close()
+        else:
+            self._idle.setdefault(key, []).append((client, time.time()))
+        async with self._condition():
+            self._in_use[key] -= 1
+            self._cond.notify()
+
+    @asynccontextmanager
+    async def connection(self, host, port, username, password):
+        """async with 形式的借出/归还，块内抛出异常时丢弃该会话"""
+        client = await self.acquire(host, port, username, password)
+        try:
+            yield client
+        except BaseException:
+            await self.release(client, discard=True)
+            raise
+        else:
+            await self.release(client)
+
+    def latency(self, host, port, username) -> Optional[float]:
+        """最近的控制连接往返时间 (秒)，还没有复用过会话时返回 None"""
+        return self._rtt.get(self.make_key(host, port, username))
+
+    def clear(self, host=None, port=None, username=None):
+        """关闭空闲会话；指定主机时只关闭该服务器的会话"""
+        keys = list(self._idle) if host is None else [self.make_key(host, port, username)]
+        for key in keys:
+            for client, _ in self._idle.pop(key, []):
+                client.close()
+
+    def get_stats(self):
+        idle = sum(len(v) for v in list(self._idle.values()))
+        in_use = sum(list(self._in_use.values()))
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / total if total else 0.0,
+            'idle': idle,
+            'in_use': in_use,
+        }
+
+    def format_stats(self):
+        stats = self.get_stats()
+        return (f"异步连接池: 命中 {stats['hits']}, 未命中 {stats['misses']}, "
+                f"回收 {stats['evictions']}, 空闲 {stats['idle']}, 使用中 {stats['in_use']}")
+
+    def _condition(self) -> asyncio.Condition:
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        return self._cond
+
+    def _checkout(self, key, client):
+        self._in_use[key] = self._in_use.get(key, 0) + 1
+        self._owners[id(client)] = key
+
+    def _evict_expired(self, key):
+        idle = self._idle.get(key)
+        if not idle:
+            return
+        now = time.time()
+        fresh = []
+        for client, released_at in idle:
+            if now - released_at > self.idle_timeout:
+                self.evictions += 1
+                client.close()
+            else:
+                fresh.append((client, released_at))
+        self._idle[key] = fresh
+
+    @staticmethod
+    async def _is_alive(client: AsyncFTP) -> bool:
+        try:
+            await client.voidcmd('NOOP')
+            return True
+        except Exception:
+            return False
+
+
+class EventLoopThread:
+    """在后台守护线程中运行的事件循环，界面线程和工作线程通过它提交协程"""
+
+    def __init__(self, name: str = 'ftp-asyncio'):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coro) -> Future:
+        """提交协程，返回 concurrent.futures.Future"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro, timeout: Optional[float] = None):
+        """提交协程并等待结果 (不能在事件循环线程内调用)"""
+        return self.submit(coro).result(timeout)
+
+    def call_soon(self, callback, *args):
+        self.loop.call_soon_threadsafe(callback, *args)
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+def raise_fd_limit(wanted: int = FD_LIMIT) -> Optional[int]:
+    """把打开文件数的软限制提高到 wanted (不超过硬限制)，返回当前软限制；不支持时返回 None"""
+    if resource is None:
+        return None
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    target = wanted if hard == resource.RLIM_INFINITY else min(wanted, hard)
+    if soft != resource.RLIM_INFINITY and soft < target:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+            soft = target
+        except (ValueError, OSError):
+            pass
+    return soft
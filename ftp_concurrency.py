@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+并发数自动调节
+下载过程中按总吞吐量逐步增加并发连接数，吞吐量不再提升时退回；
+服务器返回421/530 (会话数超限) 或控制连接往返时间明显上升时立即减少并发。
+每台主机学到的最佳并发数保存在 concurrency_profiles.json 中，下次直接从该值开始
+"""
+
+import os
+import json
+import time
+import ftplib
+import threading
+from pathlib import Path
+from typing import Callable, Dict, Optional
+
+CONCURRENCY_FILE = "concurrency_profiles.json"
+SESSION_LIMIT_CODES = ('421', '530')
+
+
+def is_session_limit(error) -> bool:
+    """服务器是否因会话数超限拒绝了连接 (421 连接过多 / 530 用户数已满)"""
+    return isinstance(error, ftplib.Error) and str(error)[:3] in SESSION_LIMIT_CODES
+
+
+class ConcurrencyStore:
+    """按主机保存学到的并发数: {host: {optimum, ceiling, rate, time}}"""
+
+    def __init__(self, path=CONCURRENCY_FILE):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+
+    def load(self) -> Dict[str, dict]:
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def get(self, host: str) -> dict:
+        return self.load().get(host, {})
+
+    def save(self, host: str, optimum: int, ceiling: Optional[int], rate: float):
+        """原子写入，多个下载管理器同时保存时不会损坏文件"""
+        with self._lock:
+            data = self.load()
+            data[host] = {'optimum': optimum, 'ceiling': ceiling,
+                          'rate': round(rate), 'time': time.time()}
+            tmp = self.path.with_suffix('.tmp')
+            try:
+                with open(tmp, 'w', encoding='utf-8') as f:
+                    json.dump(data, f, ensure_ascii=False, indent=2)
+                os.replace(tmp, self.path)
+            except OSError:
+                pass
+
+
+class ConcurrencyTuner:
+    """按吞吐量调整一台主机的并发数
+
+    apply(n) 设置并发数；total_bytes() 返回累计接收字节数；
+    busy() 为 False (等待队列已空、连接没有跑满) 时该周期的吞吐量不能说明问题，跳过；
+    latency() 返回最近的控制连接往返时间 (秒)，None 表示还没有数据。
+
+    调节过程：每次并发数变化后先等一个周期让新连接进入稳定传输，再测一个周期；
+    比低一级的吞吐量高出 GAIN 就继续加，否则退回低一级并保持，
+    保持 REPROBE 个周期后再试探一次，适应服务器负载的变化
+    """
+
+    GAIN = 1.10
+    LATENCY_FACTOR = 3.0
+    REPROBE = 20
+
+    def __init__(self, host: str, apply: Callable[[int], None],
+                 total_bytes: Callable[[], int], busy: Callable[[], bool] = lambda: True,
+                 latency: Optional[Callable[[], Optional[float]]] = None,
+                 initial: int = 3, minimum: int = 1, maximum: int = 16,
+                 interval: float = 3.0, store: Optional[ConcurrencyStore] = None,
+                 log: Optional[Callable[[str], None]] = None):
+        self.host = host
+        self.apply = apply
+        self.total_bytes = total_bytes
+        self.busy = busy
+        self.latency = latency
+        self.minimum = minimum
+        self.maximum = maximum
+        self.interval = interval
+        self.store = store
+        self.log = log
+
+        learned = store.get(host) if store else {}
+        self.ceiling: Optional[int] = learned.get('ceiling')
+        self.level = self._clamp(learned.get('optimum') or initial)
+        self.rates: Dict[int, float] = {}   # 并发数 -> 实测吞吐量 (字节/秒)
+        self.probing = not learned          # 没有历史数据时从当前值开始向上试探
+        self._hold = 0
+        self._settling = True
+        self._last_bytes = None
+        self._last_time = None
+        self._base_latency = None
+        self._backoff_at = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    # ---------- 生命周期 ----------
+
+    def start(self):
+        """应用初始并发数并启动后台调节线程"""
+        self.apply(self.level)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.tick()
+            except Exception as e:
+                self._emit(f"并发调节出错: {e}")
+
+    # ---------- 调节 ----------
+
+    def tick(self, now: Optional[float] = None):
+        """一个采样周期结束"""
+        now = time.monotonic() if now is None else now
+        total = self.total_bytes()
+        with self._lock:
+            last_bytes, last_time = self._last_bytes, self._last_time
+            self._last_bytes, self._last_time = total, now
+            if last_time is None or now <= last_time or not self.busy():
+                return
+            if self._settling:
+                self._settling = False
+                return
+            rate = (total - last_bytes) / (now - last_time)
+            previous = self.rates.get(self.level)
+            self.rates[self.level] = rate if previous is None else (previous + rate) / 2
+
+            if self._latency_rising():
+                self._change(self.level - 1, "往返时间上升")
+                self.probing = False
+                return
+
+            if self.probing:
+                lower = self.rates.get(self.level - 1)
+                if lower is not None and self.rates[self.level] < lower * self.GAIN:
+                    # 多开一个连接没有带来明显提升，退回并记住这个结果
+                    self.probing = False
+                    self._change(self.level - 1, "吞吐量不再提升")
+                    self._save()
+                elif self.level < self._limit():
+                    self._change(self.level + 1, "吞吐量提升")
+                else:
+                    self.probing = False
+                    self._save()
+            else:
+                self._hold += 1
+                if self._hold >= self.REPROBE and self.level < self._limit():
+                    self.probing = True
+                    self._change(self.level + 1, "重新试探")
+
+    def report_error(self, error) -> bool:
+        """报告传输错误；会话数超限时立即减少并发并记住上限
+
+        返回 True 表示已经减少了并发，出错的任务可以重新排队
+        """
+        if not is_session_limit(error):
+            return False
+        with self._lock:
+            now = time.monotonic()
+            if self._backoff_at is not None and now - self._backoff_at < self.interval:
+                # 同一批连接先后被拒绝，只算一次
+                return True
+            if self.level <= self.minimum:
+                return False
+            self._backoff_at = now
+            self.ceiling = self.level - 1
+            self.probing = False
+            self._change(self.level - 1, f"服务器拒绝会话 ({str(error)[:3]})")
+            self._save()
+        return True
+
+    def _latency_rising(self) -> bool:
+        if self.latency is None:
+            return False
+        value = self.latency()
+        if value is None:
+            return False
+        if self._base_latency is None or value < self._base_latency:
+            self._base_latency = value
+            return False
+        return (self.level > self.minimum and
+                value > max(self._base_latency * self.LATENCY_FACTOR, self._base_latency + 0.05))
+
+    def _change(self, level: int, reason: str):
+        level = self._clamp(level)
+        if level == self.level:
+            return
+        old = self.level
+        self.level = level
+        self._hold = 0
+        self._settling = True
+        self.apply(level)
+        rate = self.rates.get(old)
+        rate_text = f"，{rate / (1024 * 1024):.1f}MB/s" if rate else ""
+        self._emit(f"并发数 {old} -> {level} ({reason}{rate_text})")
+
+    def _limit(self) -> int:
+        return min(self.maximum, self.ceiling) if self.ceiling else self.maximum
+
+    def _clamp(self, level: int) -> int:
+        return max(self.minimum, min(self._limit(), int(level)))
+
+    def _save(self):
+        if self.store is not None:
+            self.store.save(self.host, self.level, self.ceiling, self.rates.get(self.level, 0.0))
+
+    def _emit(self, message: str):
+        if self.log is not None:
+            self.log(f"[{self.host}] {message}")
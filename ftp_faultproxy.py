@@ -0,0 +1,378 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+故障注入代理
+位于客户端和FTP服务器 (通常是 ftp_testserver) 之间的 TCP 代理。转发控制连接时改写 PASV/EPSV 回复，
+让数据连接也经过代理，从而可以在数据通道上注入故障：
+  delay / jitter   两个方向的单向延迟和随机抖动 (按到达时间排队转发，不会因为延迟降低吞吐量)
+  bandwidth        所有下载数据连接合计的带宽上限 (字节/秒)
+  reset_rate       下载的数据连接在传输途中被重置 (RST) 的概率
+  stall_rate       下载的数据连接在传输途中停止转发、但不关闭的概率，客户端只能靠超时发现
+故障位置在数据连接的前 fault_after 字节内随机选择。每次注入记录为一个 FaultEvent，
+同一文件的下一次下载开始收到数据时记为恢复，recovered 为从故障到恢复的秒数
+"""
+
+import time
+import queue
+import random
+import socket
+import struct
+import ftplib
+import threading
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+from ftp_ratelimit import RateLimiter, TokenBucket
+
+CHUNK = 64 * 1024
+QUEUE_CHUNKS = 256      # 延迟队列最多缓存的数据块 (每个方向)
+ACCEPT_TIMEOUT = 30
+
+
+@dataclass
+class FaultProfile:
+    """要模拟的网络状况，seed 固定时每次运行注入的故障序列相同"""
+    delay: float = 0.0
+    jitter: float = 0.0
+    bandwidth: int = 0
+    reset_rate: float = 0.0
+    stall_rate: float = 0.0
+    fault_after: int = 1024 * 1024
+    max_faults: int = 0               # 最多注入的故障次数，0 表示不限
+    seed: Optional[int] = None
+
+
+@dataclass
+class FaultEvent:
+    """一次注入的故障"""
+    kind: str                         # 'reset' 或 'stall'
+    path: str
+    offset: int                       # 这次下载的起点 (REST)
+    sent: int                         # 故障前已转发的字节数
+    time: float = field(default_factory=time.monotonic)
+    recovered: Optional[float] = None  # 同一文件再次开始收到数据时距故障的秒数，None 表示没有恢复
+
+
+class _Session:
+    """一个控制连接上最近的传输命令，数据连接收到第一块数据时据此判断传输的是哪个文件"""
+
+    def __init__(self):
+        self.rest = 0
+        self.command = None           # (命令, 路径, 起点)
+
+    def client_line(self, line: bytes):
+        cmd, _, arg = line.decode('utf-8', 'replace').rstrip('\r\n').partition(' ')
+        cmd = cmd.upper()
+        if cmd == 'REST':
+            try:
+                self.rest = int(arg)
+            except ValueError:
+                pass
+        elif cmd in ('RETR', 'STOR', 'APPE', 'LIST', 'NLST', 'MLSD'):
+            self.command = (cmd, arg, self.rest)
+            self.rest = 0
+
+
+class _Connection:
+    """一对转发的套接字 (客户端一侧, 服务器一侧)，关闭时两边一起关闭"""
+
+    def __init__(self, proxy: 'FaultProxy', client: socket.socket, server: socket.socket):
+        self.proxy = proxy
+        self.client = client
+        self.server = server
+        self.closed = threading.Event()
+        self._open = 2
+
+    def half_done(self, dst: socket.socket):
+        """一个方向读到结束：通知对端不会再有数据，两个方向都结束后关闭连接"""
+        try:
+            dst.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+        with self.proxy._lock:
+            self._open -= 1
+            done = self._open == 0
+        if done:
+            self.close()
+
+    def close(self, reset: bool = False):
+        # 只关闭一次：重置时唤醒的另一个线程也会调用 close，不能让它先发出 FIN
+        with self.proxy._lock:
+            if self.closed.is_set():
+                return
+            self.closed.set()
+        if reset:
+            # SO_LINGER 为0时关闭直接发送 RST，客户端的 recv 得到 ConnectionResetError
+            try:
+                self.client.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+            except OSError:
+                pass
+        for sock in (self.client, self.server):
+            self.proxy._forget(sock)
+            # 另一个线程阻塞在 recv 时 close 不会真正关闭套接字，先 shutdown 唤醒它；
+            # 重置时只关闭读方向，避免先发出 FIN
+            try:
+                sock.shutdown(socket.SHUT_RD if reset and sock is self.client else socket.SHUT_RDWR)
+            except OSError:
+                pass
+            try:
+                sock.close()
+            except OSError:
+                pass
+
+
+class FaultProxy:
+    """转发到 upstream (主机, 端口) 的故障注入代理
+
+    with LocalFTPServer(root) as server, FaultProxy(server.address, FaultProfile(reset_rate=0.3)) as proxy:
+        host, port = proxy.address   # 客户端连接代理而不是服务器
+    """
+
+    def __init__(self, upstream, profile: Optional[FaultProfile] = None, host: str = '127.0.0.1', port: int = 0):
+        self.upstream = tuple(upstream)
+        self.host = host
+        self.bucket = TokenBucket()
+        self.events: List[FaultEvent] = []
+        self.stats = {}
+        self._lock = threading.Lock()
+        self._sockets = set()
+        self._closing = threading.Event()
+        self._listener = socket.create_server((host, port), backlog=128)
+        self._thread: Optional[threading.Thread] = None
+        self.reset(profile or FaultProfile())
+
+    @property
+    def address(self):
+        return self._listener.getsockname()[:2]
+
+    def reset(self, profile: Optional[FaultProfile] = None):
+        """换用新的网络状况 (或重新开始当前的故障序列)，清空事件和统计"""
+        with self._lock:
+            if profile is not None:
+                self.profile = profile
+            self.random = random.Random(self.profile.seed)
+            self._jitter = random.Random(self.profile.seed)  # 抖动单独取随机数，不打乱故障序列
+            self.bucket.set_rate(self.profile.bandwidth)
+            self.events = []
+            self.stats = {'sessions': 0, 'transfers': 0, 'bytes': 0, 'resets': 0, 'stalls': 0}
+
+    def start(self) -> 'FaultProxy':
+        self._thread = threading.Thread(target=self._accept_loop, daemon=True, name='ftp-faultproxy')
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._closing.set()
+        self._listener.close()
+        with self._lock:
+            sockets, self._sockets = list(self._sockets), set()
+        for sock in sockets:
+            try:
+                sock.close()
+            except OSError:
+                pass
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    # ---------- 连接 ----------
+
+    def _track(self, sock: socket.socket) -> socket.socket:
+        with self._lock:
+            self._sockets.add(sock)
+        return sock
+
+    def _forget(self, sock: socket.socket):
+        with self._lock:
+            self._sockets.discard(sock)
+
+    def _accept_loop(self):
+        while not self._closing.is_set():
+            try:
+                client, _ = self._listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._control, args=(self._track(client),), daemon=True).start()
+
+    def _control(self, client: socket.socket):
+        try:
+            server = self._track(socket.create_connection(self.upstream, ACCEPT_TIMEOUT))
+        except OSError:
+            self._forget(client)
+            client.close()
+            return
+        server.settimeout(None)
+        with self._lock:
+            self.stats['sessions'] += 1
+        conn = _Connection(self, client, server)
+        session = _Session()
+
+        def client_lines():
+            for line in client.makefile('rb'):
+                session.client_line(line)
+                yield line
+
+        def server_lines():
+            for line in server.makefile('rb'):
+                yield self._rewrite(line, session)
+
+        self._pump(conn, client_lines(), server)
+        self._pump(conn, server_lines(), client)
+
+    def _rewrite(self, line: bytes, session: _Session) -> bytes:
+        """把 PASV/EPSV 回复中的数据端口换成代理上的端口"""
+        if not (line.startswith(b'227 ') or line.startswith(b'229 ')):
+            return line
+        text = line.decode('ascii', 'replace').rstrip('\r\n')
+        try:
+            if text.startswith('227'):
+                _, port = ftplib.parse227(text)
+            else:
+                _, port = ftplib.parse229(text, self.upstream)
+        except ftplib.Error:
+            return line
+        listener = self._track(socket.create_server((self.host, 0), backlog=1))
+        listener.settimeout(ACCEPT_TIMEOUT)
+        threading.Thread(target=self._data, args=(listener, port, session), daemon=True).start()
+        local = listener.getsockname()[1]
+        if text.startswith('227'):
+            return (f"227 Entering Passive Mode ({self.host.replace('.', ',')},{local >> 8},{local & 255})\r\n"
+                    .encode('ascii'))
+        return f"229 Entering Extended Passive Mode (|||{local}|)\r\n".encode('ascii')
+
+    def _data(self, listener: socket.socket, port: int, session: _Session):
+        try:
+            client, _ = listener.accept()
+        except OSError:
+            return
+        finally:
+            self._forget(listener)
+            listener.close()
+        self._track(client)
+        try:
+            server = self._track(socket.create_connection((self.upstream[0], port), ACCEPT_TIMEOUT))
+        except OSError:
+            self._forget(client)
+            client.close()
+            return
+        client.settimeout(None)
+        server.settimeout(None)
+        conn = _Connection(self, client, server)
+
+        def receive(sock):
+            while True:
+                try:
+                    block = sock.recv(CHUNK)
+                except OSError:
+                    return
+                if not block:
+                    return
+                yield block
+
+        # 客户端关闭数据连接 (下载中止或上传结束) 后整个连接关闭，停止转发的连接也在这时结束
+        self._pump(conn, receive(client), server, final=True)
+        self._pump(conn, self._download(conn, receive(server), session), client)
+
+    def _download(self, conn: _Connection, blocks, session: _Session):
+        """服务器发往客户端的数据：下载时按设定的概率在途中重置或停止转发"""
+        kind = None
+        at = sent = 0
+        command = None
+        limiter = RateLimiter(self.bucket)
+        for block in blocks:
+            if command is None:
+                command = session.command or ('', '', 0)
+                if command[0] == 'RETR':
+                    kind, at = self._plan(command[1])
+            if command[0] == 'RETR':
+                limiter.throttle(len(block))
+                with self._lock:
+                    self.stats['bytes'] += len(block)
+            if kind is not None and sent + len(block) >= at:
+                yield block[:at - sent]
+                self._inject(conn, kind, command, at)
+                return
+            sent += len(block)
+            yield block
+
+    def _plan(self, path: str):
+        """新的下载开始：记录之前同一文件故障的恢复时间，决定这次是否注入故障"""
+        now = time.monotonic()
+        with self._lock:
+            self.stats['transfers'] += 1
+            for event in self.events:
+                if event.path == path and event.recovered is None:
+                    event.recovered = now - event.time
+            profile = self.profile
+            if profile.max_faults and len(self.events) >= profile.max_faults:
+                return None, 0
+            roll = self.random.random()
+            at = self.random.randrange(max(1, profile.fault_after))
+        if roll < profile.reset_rate:
+            return 'reset', at
+        if roll < profile.reset_rate + profile.stall_rate:
+            return 'stall', at
+        return None, 0
+
+    def _inject(self, conn: _Connection, kind: str, command, sent: int):
+        with self._lock:
+            self.events.append(FaultEvent(kind, command[1], command[2], sent))
+            self.stats[kind + 's'] += 1
+        if kind == 'reset':
+            conn.close(reset=True)
+        else:
+            # 停止转发但保持连接，直到客户端超时关闭数据连接
+            conn.closed.wait()
+
+    def _pump(self, conn: _Connection, blocks, dst: socket.socket, final: bool = False):
+        """把 blocks 中的数据写入 dst；设置了延迟时由两个线程经队列转发，读取不等待写入
+
+        final 为 True 时这个方向结束后关闭整个连接，否则只关闭 dst 的写入方向
+        """
+        profile = self.profile
+        if not profile.delay and not profile.jitter:
+            threading.Thread(target=self._write, args=(conn, blocks, dst, final), daemon=True).start()
+            return
+
+        line = queue.Queue(QUEUE_CHUNKS)
+
+        def read():
+            last = 0.0
+            try:
+                for block in blocks:
+                    # 到达时间 + 延迟，保持顺序：抖动不会让后到的数据先发出
+                    last = max(last, time.monotonic() + profile.delay + self._jitter.uniform(0, profile.jitter))
+                    line.put((last, block))
+            except (OSError, ValueError):
+                pass
+            finally:
+                line.put(None)
+
+        def delayed():
+            while True:
+                item = line.get()
+                if item is None:
+                    return
+                due, block = item
+                wait = due - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+                yield block
+
+        threading.Thread(target=read, daemon=True).start()
+        threading.Thread(target=self._write, args=(conn, delayed(), dst, final), daemon=True).start()
+
+    def _write(self, conn: _Connection, blocks, dst: socket.socket, final: bool):
+        try:
+            for block in blocks:
+                dst.sendall(block)
+        except (OSError, ValueError):
+            conn.close()
+            return
+        if final:
+            conn.close()
+        elif not conn.closed.is_set():
+            conn.half_done(dst)
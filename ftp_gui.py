@@ -7,20 +7,37 @@ FTP断点续传下载工具 - GUI版本
 
 import os
 import sys
-import time
 import json
 import ftplib
+import argparse
+import multiprocessing
+import asyncio
 import threading
+from collections import deque
 from pathlib import Path
 from datetime import datetime
 from urllib.parse import urlparse
-from dataclasses import dataclass
-from typing import List, Optional, Dict, Any
+from dataclasses import dataclass, field
+from typing import Callable, List, Optional, Dict, Any
 
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox, simpledialog
 from tkinter.scrolledtext import ScrolledText
 
+from ftp_async import AsyncConnectionPool, AsyncFileWriter, EventLoopThread, raise_fd_limit
+from ftp_concurrency import ConcurrencyStore, ConcurrencyTuner
+from ftp_integrity import BlockResume, IntegrityChecker, StreamHash, combine
+from ftp_journal import TransferJournal
+from ftp_listing import ListingCache, ListingEngine, RemoteEntry
+from ftp_pool import FTPConnectionPool, SizePrefetcher, default_pool, fetch_sizes
+from ftp_process import ProcessBackend, ProcessJob
+from ftp_ratelimit import BandwidthManager, SharedTokenBucket, SpeedMeter, TokenBucket
+from ftp_retry import POLICIES, RetryPolicy, retryable
+from ftp_storage import PartResult, download_part, finish_part, part_path, resume_size
+from ftp_transfer import ADAPTIVE, DEFAULT_BUFFER_SIZE, SPLICE, AdaptiveBlockSizer
+from ftp_treeview import VirtualTreeview
+from ftp_uploader import supports_rest_stor, upload_file
+
 @dataclass
 class FTPFileInfo:
     """FTP文件信息"""
@@ -30,6 +47,7 @@ class FTPFileInfo:
     modified: str
     permissions: str
     full_path: str
+    mtime: Optional[float] = None  # UTC时间戳，MLSD或LIST解析得到
 
 @dataclass
 class DownloadTask:
@@ -42,12 +60,24 @@ class DownloadTask:
     speed: float = 0.0
     progress: float = 0.0
     error_msg: str = ""
+    bucket: TokenBucket = field(default_factory=TokenBucket, compare=False, repr=False)  # 单个任务的限速
+    journal_id: Optional[int] = field(default=None, compare=False, repr=False)  # 传输日志中的编号
+    upload: bool = False  # 上传任务：local_path 上传到 remote_path，与下载任务共用队列和并发数
+    retries: int = 0  # 网络错误后已自动重试的次数
+    queued: bool = field(default=False, compare=False, repr=False)  # 是否在等待队列中 (由 _cond 保护)
 
 class FTPConnection:
     """FTP连接管理器"""
     
-    def __init__(self):
+    is_async = False   # 下载任务是否在事件循环中以协程运行
+    max_transfers = 32  # 界面上允许设置的最大并发数
+    
+    def __init__(self, pool: Optional[FTPConnectionPool] = None):
         self.ftp = None
+        self.lister: Optional[ListingEngine] = None
+        self.listing_cache = ListingCache()
+        self.server_path = "/"  # 服务器端实际的工作目录，命中缓存时可能落后于 current_path
+        self.pool = pool or default_pool
         self.host = ""
         self.port = 21
         self.username = ""
@@ -62,12 +92,15 @@ class FTPConnection:
             self.ftp.connect(host, port, timeout)
             self.ftp.login(username, password)
             self.ftp.set_pasv(True)
+            self.lister = ListingEngine(self.ftp)
             
             self.host = host
             self.port = port
             self.username = username
             self.password = password
             self.current_path = self.ftp.pwd()
+            self.server_path = self.current_path
+            self.listing_cache.invalidate()
             self.connected = True
             return True
         except Exception as e:
@@ -82,91 +115,72 @@ class FTPConnection:
             except:
                 pass
             self.ftp = None
+        self.lister = None
+        if self.host:
+            self.pool.clear(self.host, self.port, self.username)
         self.connected = False
     
-    def list_directory(self, path=None) -> List[FTPFileInfo]:
-        """列出目录内容"""
+    def transfer_connection(self):
+        """从连接池借出一个用于数据传输的会话 (with 语句使用)"""
+        return self.pool.connection(self.host, self.port, self.username, self.password)
+    
+    def list_directory(self, path=None, refresh=False) -> List[FTPFileInfo]:
+        """列出目录内容 (优先MLSD，不支持时回退LIST)；refresh 为 True 时跳过缓存"""
         if not self.connected:
             return []
         
-        if path:
-            original_path = self.ftp.pwd()
-            try:
-                self.ftp.cwd(path)
-            except:
-                return []
+        base = ListingCache.normalize(path or self.current_path)
+        if refresh:
+            self.listing_cache.invalidate(base)
+        else:
+            entries = self.listing_cache.get(base)
+            if entries is not None:
+                return [self._to_file_info(entry, base) for entry in entries]
         
-        files = []
         try:
-            # 获取详细列表
-            lines = []
-            self.ftp.retrlines('LIST', lines.append)
-            
-            for line in lines:
-                file_info = self._parse_list_line(line)
-                if file_info:
-                    files.append(file_info)
-                    
+            if self.server_path != base:
+                self.ftp.cwd(base)
+                self.server_path = base
+            entries = self.lister.list_dir()
         except Exception as e:
             print(f"列出目录失败: {e}")
+            return []
         
-        if path:
-            try:
-                self.ftp.cwd(original_path)
-            except:
-                pass
-        
-        return files
+        self.listing_cache.put(base, entries)
+        return [self._to_file_info(entry, base) for entry in entries]
     
-    def _parse_list_line(self, line: str) -> Optional[FTPFileInfo]:
-        """解析LIST命令返回的行"""
-        try:
-            parts = line.split()
-            if len(parts) < 9:
-                return None
-            
-            permissions = parts[0]
-            is_dir = permissions.startswith('d')
-            
-            # 尝试获取文件大小
-            try:
-                size = int(parts[4]) if not is_dir else 0
-            except:
-                size = 0
-            
-            # 文件名可能包含空格
-            name = ' '.join(parts[8:])
-            
-            # 修改时间
-            modified = f"{parts[5]} {parts[6]} {parts[7]}"
-            
-            # 构建完整路径
-            current_dir = self.ftp.pwd()
-            if current_dir.endswith('/'):
-                full_path = current_dir + name
-            else:
-                full_path = current_dir + '/' + name
-            
-            return FTPFileInfo(
-                name=name,
-                size=size,
-                is_dir=is_dir,
-                modified=modified,
-                permissions=permissions,
-                full_path=full_path
-            )
-        except Exception as e:
-            print(f"解析文件信息失败: {line} - {e}")
-            return None
+    def _to_file_info(self, entry: RemoteEntry, base: str) -> FTPFileInfo:
+        """将列表引擎的目录项转换为FTPFileInfo"""
+        if base.endswith('/'):
+            full_path = base + entry.name
+        else:
+            full_path = base + '/' + entry.name
+        
+        return FTPFileInfo(
+            name=entry.name,
+            size=entry.size,
+            is_dir=entry.is_dir,
+            modified=entry.modified,
+            permissions=entry.permissions,
+            full_path=full_path,
+            mtime=entry.mtime
+        )
     
     def change_directory(self, path: str) -> bool:
         """切换目录"""
         if not self.connected:
             return False
         
+        # 目标目录已缓存时只在本地切换，列表时再按需发送CWD
+        target = ListingCache.normalize(path)
+        if target in self.listing_cache:
+            self.current_path = target
+            return True
+        
         try:
             self.ftp.cwd(path)
             self.current_path = self.ftp.pwd()
+            self.server_path = self.current_path
             return True
         except:
             return False
@@ -181,134 +195,685 @@ class FTPConnection:
         except:
             return None
 
+class AsyncFTPConnection(FTPConnection):
+    """下载走 asyncio 的FTP连接管理器
+
+    浏览目录、创建目录和后台查询大小仍使用 ftplib 会话；下载任务在一个事件循环里以协程运行，
+    每个并发下载只占一个异步会话而不占线程，并发数可以开到上千
+    """
+    
+    is_async = True
+    max_transfers = 2000
+    
+    def __init__(self, pool: Optional[FTPConnectionPool] = None,
+                 async_pool: Optional[AsyncConnectionPool] = None):
+        super().__init__(pool)
+        self.loop = EventLoopThread()
+        self.async_pool = async_pool or AsyncConnectionPool()
+        raise_fd_limit()
+    
+    def disconnect(self):
+        """断开连接，同时关闭异步连接池中该服务器的空闲会话"""
+        host, port, username = self.host, self.port, self.username
+        super().disconnect()
+        if host:
+            self.loop.call_soon(self.async_pool.clear, host, port, username)
+    
+    def async_connection(self):
+        """从异步连接池借出一个会话 (在事件循环中以 async with 使用)"""
+        return self.async_pool.connection(self.host, self.port, self.username, self.password)
+
 class DownloadManager:
     """下载管理器"""
     
-    def __init__(self, ftp_conn: FTPConnection):
+    def __init__(self, ftp_conn: FTPConnection, journal: Optional[TransferJournal] = None,
+                 processes: int = 0):
         self.ftp_conn = ftp_conn
+        self.journal = journal  # 传输日志，崩溃或重启后据此恢复任务队列
         self.tasks: List[DownloadTask] = []
         self.active_downloads = 0
         self.max_concurrent = 3
-        self.chunk_size = 8192
+        # 接收缓冲区大小，与命令行默认值相同；ADAPTIVE 为按吞吐量自适应，SPLICE 为经管道在内核中写入文件
+        self.chunk_size = DEFAULT_BUFFER_SIZE
+        
+        # processes 大于 0 时下载在多个工作进程中进行 (异步模式下不使用)，
+        # 限速的令牌桶放在共享内存中，所有工作进程共用
+        self.processes = 0 if ftp_conn.is_async else processes
+        self.backend: Optional[ProcessBackend] = None
+        bucket_factory = SharedTokenBucket if self.processes else TokenBucket
+        self.bandwidth = BandwidthManager(bucket_factory=bucket_factory)  # 全局和按主机限速，任务限速见 DownloadTask.bucket
+        self.verify = False  # 下载时边收边算哈希，与服务器端校验值或校验文件比较
+        self.integrity = IntegrityChecker()
+        # 网络错误后按 retry_policy 等待并重新排队，最多 max_retries 次；默认不重试，直接标记为失败
+        self.max_retries = 0
+        self.retry_policy = RetryPolicy()
         self.running = False
         
-    def add_task(self, remote_path: str, local_path: str, size: int = 0):
-        """添加下载任务"""
-        if size == 0:
-            size = self.ftp_conn.get_file_size(remote_path) or 0
-        
+        # 并发数自动调节：按主机学习最佳并发数，结果保存在 concurrency_profiles.json
+        self.auto_concurrency = True
+        self.concurrency_store = ConcurrencyStore()
+        self.tuner: Optional[ConcurrencyTuner] = None
+        self.bytes_received = 0  # 累计接收字节数，调节器据此计算总吞吐量
+        self.on_concurrency_change: Optional[Callable[[int], None]] = None
+        
+        # 等待队列与工作线程，队列和计数都由 _cond 保护
+        self._pending = deque()
+        self._workers: List[threading.Thread] = []
+        self._cond = threading.Condition()
+        # 异步模式下由事件循环中的调度协程代替工作线程，_wake 唤醒调度协程
+        self._dispatching = False
+        self._wake: Optional[Callable[[], None]] = None
+        self._jobs = set()
+        # 异步模式的进度检查点先记在这里 (传输日志编号 -> 偏移)，由线程池中的一个任务按顺序提交
+        self._checkpoints: Dict[int, int] = {}
+        self._flushing = False
+        self._rest_stor: Optional[bool] = None  # 服务器是否支持 REST+STOR 续传上传
+        
+        # 未知大小的任务交给后台批量查询，不阻塞界面线程
+        self.size_prefetcher = SizePrefetcher(ftp_conn.transfer_connection)
+        
+    def add_task(self, remote_path: str, local_path: str, size: int = 0, mtime: Optional[float] = None):
+        """添加下载任务，size 为 0 时在后台查询文件大小"""
         task = DownloadTask(
             remote_path=remote_path,
             local_path=local_path,
             size=size
         )
-        self.tasks.append(task)
+        if self.journal is not None:
+            task.journal_id = self.journal.add(self._session(), remote_path, local_path, size, mtime)
+        with self._cond:
+            self.tasks.append(task)
+            self._enqueue(task)
+            self._notify()
+        if size == 0:
+            self.size_prefetcher.submit([task])
         return task
     
+    def add_upload(self, local_path: str, remote_path: str):
+        """添加上传任务，按远程已有的长度续传 (上传任务不写入传输日志)"""
+        task = DownloadTask(
+            remote_path=remote_path,
+            local_path=local_path,
+            size=os.path.getsize(local_path),
+            upload=True
+        )
+        with self._cond:
+            self.tasks.append(task)
+            self._enqueue(task)
+            self._notify()
+        return task
+    
+    def _enqueue(self, task: DownloadTask):
+        """(持有 _cond 时调用) 放入等待队列；按任务对象而不是字段值判断是否已在队列中，O(1)"""
+        if not task.queued:
+            task.queued = True
+            self._pending.append(task)
+    
+    def _dequeue(self) -> DownloadTask:
+        """(持有 _cond 时调用) 取出队首任务"""
+        task = self._pending.popleft()
+        task.queued = False
+        return task
+    
+    def requeue(self, task: DownloadTask):
+        """将任务重新放回等待队列 (用于重试失败的任务)"""
+        with self._cond:
+            task.status = "等待中"
+            task.error_msg = ""
+            self._enqueue(task)
+            self._notify()
+        self._journal_status(task)
+    
+    def clear_tasks(self, completed_only: bool = False):
+        """清除任务；completed_only 为 True 时只清除已完成的任务"""
+        with self._cond:
+            if completed_only:
+                keep = [t for t in self.tasks if t.status != "已完成"]
+            else:
+                keep = [t for t in self.tasks if t.status == "下载中"]
+                for t in self._pending:
+                    t.queued = False
+                self._pending.clear()
+            kept = {id(t) for t in keep}
+            removed = [t.journal_id for t in self.tasks
+                       if id(t) not in kept and t.journal_id is not None]
+            self.tasks = keep
+        if self.journal is not None and removed:
+            self.journal.remove(removed)
+    
+    def restore_tasks(self) -> int:
+        """从传输日志恢复当前服务器上次未清除的任务，返回恢复的任务数
+
+        日志中已有大小，不需要重新查询；未完成的任务重新排队，启动后从核对过的偏移续传
+        """
+        if self.journal is None or not self.ftp_conn.host:
+            return 0
+        entries = self.journal.entries(self._session())
+        with self._cond:
+            known = {t.journal_id for t in self.tasks}
+            restored = []
+            for entry in entries:
+                if entry.id in known:
+                    continue
+                finished = entry.status == "已完成"
+                task = DownloadTask(
+                    remote_path=entry.remote_path,
+                    local_path=entry.local_path,
+                    size=entry.size,
+                    downloaded=entry.size if finished else entry.offset,
+                    status=entry.status if entry.status in ("已完成", "失败") else "等待中",
+                    progress=100.0 if finished else (entry.offset / entry.size * 100 if entry.size else 0.0),
+                    error_msg=entry.error,
+                    journal_id=entry.id
+                )
+                restored.append(task)
+            self.tasks.extend(restored)
+            for t in restored:
+                if t.status == "等待中":
+                    self._enqueue(t)
+            self._notify()
+        unsized = [t for t in restored if t.status == "等待中" and t.size <= 0]
+        if unsized:
+            self.size_prefetcher.submit(unsized)
+        return len(restored)
+    
+    def _session(self):
+        conn = self.ftp_conn
+        return FTPConnectionPool.make_key(conn.host, conn.port, conn.username)
+    
+    def _journal_status(self, task: DownloadTask):
+        if self.journal is not None and task.journal_id is not None:
+            # 还没提交的检查点已经过时，状态记录中带有最新的偏移
+            with self._cond:
+                self._checkpoints.pop(task.journal_id, None)
+            self.journal.set_status(task.journal_id, task.status, task.error_msg, task.downloaded)
+    
+    def set_max_concurrent(self, value: int):
+        """运行时调整最大并发数，多余的工作线程在完成当前任务后退出"""
+        with self._cond:
+            self.max_concurrent = max(1, int(value))
+            # 连接池上限不能小于并发数，否则多出的线程只能等待会话
+            pool = self._transfer_pool()
+            pool.max_per_key = max(pool.max_per_key, self.max_concurrent)
+            if self.running:
+                self._spawn_workers()
+            self._notify()
+        if self.on_concurrency_change:
+            self.on_concurrency_change(self.max_concurrent)
+    
+    def set_auto_concurrency(self, enabled: bool):
+        """开启或关闭并发数自动调节，关闭后保持当前并发数"""
+        self.auto_concurrency = enabled
+        if not enabled:
+            self._stop_tuner()
+    
+    def _ensure_tuner(self):
+        """为当前主机启动并发调节器 (主机变化时重新创建)"""
+        host = self.ftp_conn.host
+        if not self.auto_concurrency or not host:
+            return
+        with self._cond:
+            if self.tuner is not None and self.tuner.host == host:
+                return
+            if self.tuner is not None:
+                self.tuner.stop()
+            tuner = self.tuner = ConcurrencyTuner(
+                host, self.set_max_concurrent, lambda: self.bytes_received, self._busy,
+                self._latency, initial=self.max_concurrent, store=self.concurrency_store, log=print,
+                # 异步模式下并发不占线程，允许试探到更高的并发数
+                maximum=self.ftp_conn.max_transfers if self.ftp_conn.is_async else 16
+            )
+        tuner.start()
+    
+    def _stop_tuner(self):
+        with self._cond:
+            tuner, self.tuner = self.tuner, None
+        if tuner is not None:
+            tuner.stop()
+    
+    def _busy(self) -> bool:
+        """队列中还有任务或连接已跑满时，吞吐量才能反映并发数的效果"""
+        with self._cond:
+            return bool(self._pending) or self.active_downloads >= self.max_concurrent
+    
+    def _latency(self) -> Optional[float]:
+        conn = self.ftp_conn
+        return self._transfer_pool().latency(conn.host, conn.port, conn.username)
+    
+    def _transfer_pool(self):
+        """下载任务使用的连接池"""
+        return self.ftp_conn.async_pool if self.ftp_conn.is_async else self.ftp_conn.pool
+    
+    def _notify(self):
+        """唤醒等待任务的工作线程或调度协程 (调用方需持有 _cond)"""
+        self._cond.notify_all()
+        if self._wake is not None:
+            self._wake()
+    
     def start_downloads(self):
         """开始下载"""
-        self.running = True
-        threading.Thread(target=self._download_worker, daemon=True).start()
+        with self._cond:
+            self.running = True
+            self._spawn_workers()
+            self._notify()
     
     def stop_downloads(self):
         """停止下载"""
-        self.running = False
+        with self._cond:
+            self.running = False
+            self._notify()
+        self._stop_tuner()
+    
+    def _spawn_workers(self):
+        """补足工作线程到 max_concurrent 个，异步模式下启动调度协程 (调用方需持有 _cond)"""
+        if self.ftp_conn.is_async:
+            if not self._dispatching:
+                self._dispatching = True
+                self.ftp_conn.loop.submit(self._dispatch())
+            return
+        self._workers = [w for w in self._workers if w.is_alive()]
+        while len(self._workers) < self.max_concurrent:
+            worker = threading.Thread(target=self._download_worker, daemon=True)
+            self._workers.append(worker)
+            worker.start()
     
     def _download_worker(self):
-        """下载工作线程"""
-        while self.running:
-            # 查找等待中的任务
-            pending_tasks = [t for t in self.tasks if t.status == "等待中"]
-            
-            if not pending_tasks:
-                time.sleep(1)
-                continue
-            
-            if self.active_downloads >= self.max_concurrent:
-                time.sleep(1)
-                continue
-            
-            task = pending_tasks[0]
-            self.active_downloads += 1
+        """下载工作线程：阻塞等待队列中的任务，完成后立即取下一个"""
+        me = threading.current_thread()
+        while True:
+            with self._cond:
+                while self.running and not self._pending and len(self._workers) <= self.max_concurrent:
+                    self._cond.wait()
+                
+                # 已停止或并发数被调小时退出
+                if not self.running or len(self._workers) > self.max_concurrent:
+                    if me in self._workers:
+                        self._workers.remove(me)
+                    return
+                
+                task = self._dequeue()
+                if task.status != "等待中":
+                    continue
+                self.active_downloads += 1
             
-            # 在新线程中下载
-            threading.Thread(
-                target=self._download_file,
-                args=(task,),
-                daemon=True
-            ).start()
+            try:
+                if task.upload:
+                    self._upload_file(task)
+                elif self.processes:
+                    self._download_file_process(task)
+                else:
+                    self._download_file(task)
+            finally:
+                with self._cond:
+                    self.active_downloads -= 1
     
     def _download_file(self, task: DownloadTask):
         """下载单个文件"""
         try:
             task.status = "下载中"
+            self._ensure_tuner()
             
-            # 创建本地目录
-            local_path = Path(task.local_path)
-            local_path.parent.mkdir(parents=True, exist_ok=True)
-            
-            # 检查本地文件
-            local_size = 0
-            if local_path.exists():
-                local_size = local_path.stat().st_size
-                if local_size == task.size:
-                    task.status = "已完成"
-                    task.progress = 100.0
-                    return
-                elif local_size > task.size:
-                    local_path.unlink()
-                    local_size = 0
-            
-            task.downloaded = local_size
+            self._fetch_size(task)
+            local_size = self._check_local(task)
+            if local_size is None:
+                self._journal_status(task)
+                return
             
-            # 创建新的FTP连接用于下载
-            ftp = ftplib.FTP()
-            ftp.connect(self.ftp_conn.host, self.ftp_conn.port, 30)
-            ftp.login(self.ftp_conn.username, self.ftp_conn.password)
-            ftp.set_pasv(True)
+            entry = None
+            if self.journal is not None and task.journal_id is not None:
+                entry = self.journal.get(task.journal_id)
+            # 从连接池借出已登录的会话
+            with self.ftp_conn.transfer_connection() as ftp:
+                limiter = self.bandwidth.limiter(self.ftp_conn.host, task.bucket)
+                tuner = AdaptiveBlockSizer() if self.chunk_size == ADAPTIVE else None
+                result = download_part(ftp, task.remote_path, task.local_path, task.size, local_size,
+                                       lambda offset: self._progress(task, offset), entry,
+                                       self.integrity if self.verify else None, self.chunk_size,
+                                       tuner, limiter, log=print)
+            if tuner and tuner.history:
+                print(f"{task.remote_path} {tuner.summary()}")
             
-            # 设置断点续传
-            if local_size > 0:
-                ftp.sendcmd(f'REST {local_size}')
+            self._finish(task, result)
+                
+        except Exception as e:
+            if self._requeue_on_limit(task, e) or self._retry_later(task, e):
+                return
+            task.status = "失败"
+            task.error_msg = str(e)
+        self._journal_status(task)
+    
+    def _download_file_process(self, task: DownloadTask):
+        """下载单个文件 (多进程模式)：由工作进程下载，本线程转发进度、记录日志"""
+        try:
+            task.status = "下载中"
+            self._ensure_tuner()
+            self._fetch_size(task)
+            local_size = self._check_local(task)
+            if local_size is None:
+                self._journal_status(task)
+                return
             
-            # 开始下载
-            mode = 'ab' if local_size > 0 else 'wb'
-            start_time = time.time()
+            entry = None
+            if self.journal is not None and task.journal_id is not None:
+                entry = self.journal.get(task.journal_id)
+            backend = self._ensure_backend()
+            slot = backend.acquire()
+            bucket = backend.task_buckets[slot]
+            report = None
             
-            with open(local_path, mode) as f:
-                def callback(data):
-                    f.write(data)
-                    task.downloaded += len(data)
-                    
-                    # 计算进度和速度
-                    if task.size > 0:
-                        task.progress = (task.downloaded / task.size) * 100
-                    
-                    elapsed = time.time() - start_time
-                    if elapsed > 0:
-                        task.speed = (task.downloaded - local_size) / elapsed
-                
-                ftp.retrbinary(f'RETR {task.remote_path}', callback, self.chunk_size)
+            def progress(offset, written):
+                nonlocal report
+                if report is None:
+                    report = self._progress(task, offset)
+                # 任务限速在界面上修改后同步到工作进程
+                if bucket.rate != task.bucket.rate:
+                    bucket.set_rate(task.bucket.rate)
+                report(written)
             
-            ftp.quit()
+            try:
+                bucket.set_rate(task.bucket.rate)
+                result = backend.download(ProcessJob(slot, task.remote_path, task.local_path, task.size,
+                                                     local_size, entry, self.verify, self.chunk_size),
+                                          progress)
+            finally:
+                backend.release(slot)
             
-            if task.downloaded == task.size:
-                task.status = "已完成"
+            if result.error is not None and (self._requeue_on_limit(task, result.error) or
+                                             self._retry_later(task, result.error)):
+                return
+            if result.downloaded is not None:
+                task.downloaded = result.downloaded
+            task.status = result.status
+            task.error_msg = result.error_msg
+            if task.status == "已完成":
                 task.progress = 100.0
+            elif result.downloaded == 0:
+                task.progress = 0.0
+        
+        except Exception as e:
+            if self._requeue_on_limit(task, e) or self._retry_later(task, e):
+                return
+            task.status = "失败"
+            task.error_msg = str(e)
+        self._journal_status(task)
+    
+    def _ensure_backend(self) -> ProcessBackend:
+        """为当前会话启动工作进程 (服务器或用户变化时重新启动)"""
+        conn = self.ftp_conn
+        session = (conn.host, int(conn.port), conn.username, conn.password)
+        with self._cond:
+            backend = self.backend
+            if backend is not None and backend.session == session:
+                return backend
+            if backend is not None:
+                backend.shutdown()
+            # 槽位总数不小于界面允许的最大并发数
+            per_process = -(-conn.max_transfers // self.processes)
+            self.backend = ProcessBackend(session, self.bandwidth.global_bucket,
+                                          self.bandwidth.host_bucket(conn.host),
+                                          self.processes, per_process)
+            return self.backend
+    
+    def shutdown(self):
+        """停止下载并结束工作进程 (程序退出时调用)"""
+        self.stop_downloads()
+        with self._cond:
+            backend, self.backend = self.backend, None
+        if backend is not None:
+            backend.shutdown()
+    
+    async def _dispatch(self):
+        """异步模式的调度协程：并发数未满时为队列中的任务启动下载协程，否则等待唤醒"""
+        loop = asyncio.get_running_loop()
+        wakeup = asyncio.Event()
+        try:
+            while True:
+                with self._cond:
+                    if not self.running:
+                        self._dispatching = False
+                        self._wake = None
+                        return
+                    self._wake = lambda: loop.call_soon_threadsafe(wakeup.set)
+                    wakeup.clear()
+                    started = []
+                    while self._pending and self.active_downloads < self.max_concurrent:
+                        task = self._dequeue()
+                        if task.status != "等待中":
+                            continue
+                        self.active_downloads += 1
+                        started.append(task)
+                for task in started:
+                    # 事件循环只保留任务的弱引用，运行中的下载协程要自己保存
+                    job = loop.create_task(self._run_async(task))
+                    self._jobs.add(job)
+                    job.add_done_callback(self._jobs.discard)
+                await wakeup.wait()
+        except BaseException:
+            with self._cond:
+                self._dispatching = False
+                self._wake = None
+            raise
+    
+    async def _run_async(self, task: DownloadTask):
+        try:
+            if task.upload:
+                # 上传用 sendfile 阻塞发送，放在线程池中进行
+                await asyncio.get_running_loop().run_in_executor(None, self._upload_file, task)
             else:
-                task.status = "失败"
-                task.error_msg = "下载不完整"
+                await self._download_file_async(task)
+        finally:
+            with self._cond:
+                self.active_downloads -= 1
+                self._notify()
+    
+    async def _download_file_async(self, task: DownloadTask):
+        """下载单个文件 (异步模式)，步骤与 _download_file 相同；读写本地文件、计算校验和写传输日志在线程池中进行"""
+        loop = asyncio.get_running_loop()
+        try:
+            task.status = "下载中"
+            self._ensure_tuner()
+            
+            async with self.ftp_conn.async_connection() as client:
+                if task.size <= 0:
+                    task.size = (await client.sizes([task.remote_path]))[task.remote_path] or 0
+                    if self.journal is not None and task.journal_id is not None:
+                        await loop.run_in_executor(None, self.journal.set_size, task.journal_id, task.size)
+                
+                part = part_path(task.local_path)
+                local_size = await loop.run_in_executor(None, self._check_local, task)
+                if local_size is None:
+                    await loop.run_in_executor(None, self._journal_status, task)
+                    return
+                
+                if self.journal is not None and task.journal_id is not None and local_size:
+                    local_size = await self.journal.resume_point_async(task.journal_id, client, part)
                 
+                # 分块核对在线程池中进行，中间损坏的块用REST单独重新下载
+                limiter = self.bandwidth.limiter(self.ftp_conn.host, task.bucket)
+                plan = await loop.run_in_executor(None, BlockResume, part, task.size, local_size, False, print)
+                for start, length in plan.repairs:
+                    async with AsyncFileWriter(part, offset=start) as writer:
+                        await client.retrieve(task.remote_path, writer, start, length, limiter=limiter)
+                local_size, blocks = await loop.run_in_executor(None, plan.finish)
+                task.downloaded = local_size
+                
+                checksum = hasher = None
+                if self.verify:
+                    checksum = await self.integrity.expected_async(client, task.remote_path)
+                    if checksum is not None:
+                        hasher = await loop.run_in_executor(
+                            None, StreamHash(checksum.algorithm).resume, part, local_size)
+                mode = 'ab' if local_size > 0 else 'wb'
+                
+                try:
+                    async with AsyncFileWriter(part, mode, hasher=combine(hasher, blocks),
+                                               allocate=task.size) as writer:
+                        await client.retrieve(task.remote_path, writer, local_size or None,
+                                              progress=self._progress(task, local_size, deferred=True),
+                                              limiter=limiter)
+                finally:
+                    if blocks is not None:
+                        blocks.close()
+            
+            self._finish(task, await loop.run_in_executor(None, finish_part, task.local_path, task.size,
+                                                          task.downloaded, blocks, hasher, checksum))
+        
         except Exception as e:
+            # 重新排队和记录状态都要写传输日志，放在线程池中进行
+            if await loop.run_in_executor(None, self._requeue_on_limit, task, e) or self._retry_later(task, e):
+                return
+            task.status = "失败"
+            task.error_msg = str(e) or type(e).__name__
+        await loop.run_in_executor(None, self._journal_status, task)
+    
+    def _upload_file(self, task: DownloadTask):
+        """上传单个文件：远程已有部分内容时从远程长度续传，限速与下载任务相同"""
+        try:
+            task.status = "下载中"
+            self._ensure_tuner()
+            task.size = os.path.getsize(task.local_path)
+            report = None
+            
+            def progress(offset, sent):
+                nonlocal report
+                if report is None:
+                    report = self._progress(task, offset)
+                report(sent)
+            
+            with self.ftp_conn.transfer_connection() as ftp:
+                if self._rest_stor is None:
+                    self._rest_stor = supports_rest_stor(ftp)
+                limiter = self.bandwidth.limiter(self.ftp_conn.host, task.bucket)
+                upload_file(ftp, task.local_path, task.remote_path, self._rest_stor,
+                            progress=progress, limiter=limiter)
+            task.downloaded = task.size
+            task.status = "已完成"
+            task.progress = 100.0
+        except Exception as e:
+            if self._requeue_on_limit(task, e) or self._retry_later(task, e):
+                return
             task.status = "失败"
             task.error_msg = str(e)
-        finally:
-            self.active_downloads -= 1
+    
+    def _fetch_size(self, task: DownloadTask):
+        """后台查询还没轮到该任务时，在工作线程中补查大小"""
+        if task.size <= 0:
+            with self.ftp_conn.transfer_connection() as ftp:
+                task.size = fetch_sizes(ftp, [task.remote_path])[task.remote_path] or 0
+            if self.journal is not None and task.journal_id is not None:
+                self.journal.set_size(task.journal_id, task.size)
+    
+    def _check_local(self, task: DownloadTask) -> Optional[int]:
+        """创建本地目录并检查本地文件，返回 .part 文件的续传起点；目标文件已完整时标记完成并返回 None"""
+        # 大小未知时不续传，也不动已有的目标文件，下载完成后才替换
+        if task.size <= 0:
+            Path(task.local_path).parent.mkdir(parents=True, exist_ok=True)
+            task.downloaded = 0
+            return 0
+        local_size = resume_size(task.local_path, task.size)
+        if local_size is None:
+            task.status = "已完成"
+            task.progress = 100.0
+            task.downloaded = task.size
+            return None
+        
+        task.downloaded = local_size
+        return local_size
+    
+    def _progress(self, task: DownloadTask, local_size: int, deferred: bool = False):
+        """进度回调：进度和速度按时间间隔采样计算，速度取最近几次采样，反映限速后的实际速率
+
+        deferred 为 True 时 (在事件循环线程中调用) 检查点不直接写传输日志，交给 _defer_checkpoint
+        """
+        meter = SpeedMeter()
+        reported = 0
+        task.downloaded = local_size
+        
+        def progress(written):
+            nonlocal reported
+            task.downloaded = local_size + written
+            if task.size > 0:
+                task.progress = (task.downloaded / task.size) * 100
+            task.speed = meter.update(written)
+            with self._cond:
+                self.bytes_received += written - reported
+            reported = written
+            if self.journal is not None and task.journal_id is not None:
+                if deferred:
+                    self._defer_checkpoint(task.journal_id, task.downloaded)
+                else:
+                    self.journal.checkpoint(task.journal_id, task.downloaded)
+        
+        return progress
+    
+    def _defer_checkpoint(self, journal_id: int, offset: int):
+        """在事件循环线程中记录检查点：只更新内存中的偏移，没有提交任务在运行时在线程池中启动一个"""
+        with self._cond:
+            self._checkpoints[journal_id] = offset
+            if self._flushing:
+                return
+            self._flushing = True
+        asyncio.get_running_loop().run_in_executor(None, self._flush_checkpoints)
+    
+    def _flush_checkpoints(self):
+        """在线程池中把积累的检查点写入传输日志，直到没有新的检查点"""
+        try:
+            while True:
+                with self._cond:
+                    checkpoints, self._checkpoints = self._checkpoints, {}
+                    if not checkpoints:
+                        self._flushing = False
+                        return
+                for journal_id, offset in checkpoints.items():
+                    self.journal.checkpoint(journal_id, offset)
+        except BaseException:
+            with self._cond:
+                self._flushing = False
+            raise
+    
+    def _finish(self, task: DownloadTask, result: PartResult):
+        """按下载结果设置任务状态"""
+        task.downloaded = result.downloaded
+        task.status = result.status
+        task.error_msg = result.error_msg
+        if task.status == "已完成":
+            task.progress = 100.0
+        elif result.downloaded == 0:
+            task.progress = 0.0
+    
+    def _requeue_on_limit(self, task: DownloadTask, error) -> bool:
+        """服务器会话数超限：调节器减少并发后任务重新排队，已下载的部分稍后续传"""
+        tuner = self.tuner
+        if tuner is not None and tuner.report_error(error):
+            self.requeue(task)
+            return True
+        return False
+    
+    def _retry_later(self, task: DownloadTask, error) -> bool:
+        """网络错误：按重试策略等待后重新排队，已下载的部分稍后续传；次数用完或不值得重试时返回 False"""
+        if task.retries >= self.max_retries or not retryable(error):
+            return False
+        task.retries += 1
+        wait = self.retry_policy.wait(task.retries)
+        task.status = "等待中"
+        task.error_msg = f"{wait:.1f}秒后重试 ({task.retries}/{self.max_retries}): {error}"
+        timer = threading.Timer(wait, self._retry, (task,))
+        timer.daemon = True
+        timer.start()
+        return True
+    
+    def _retry(self, task: DownloadTask):
+        """等待结束，任务还在列表中且没有被手动改变状态时重新排队"""
+        with self._cond:
+            if task.status != "等待中" or not any(t is task for t in self.tasks):
+                return
+            self._enqueue(task)
+            self._notify()
 
 class FTPClientGUI:
     """FTP客户端GUI主界面"""
     
-    def __init__(self):
+    def __init__(self, async_transfers: bool = False, processes: int = 0):
         self.root = tk.Tk()
         self.root.title("FTP断点续传下载工具 v2.0")
         self.root.geometry("1200x800")
@@ -318,9 +883,14 @@ class FTPClientGUI:
         self.setup_styles()
         
         # 初始化组件
-        self.ftp_conn = FTPConnection()
-        self.download_manager = DownloadManager(self.ftp_conn)
+        # async_transfers 为 True 时下载任务在事件循环中以协程运行 (命令行参数 --async)
+        self.ftp_conn = AsyncFTPConnection() if async_transfers else FTPConnection()
+        self.journal = self.open_journal()
+        # processes 大于 0 时下载在多个工作进程中进行 (命令行参数 --processes)
+        self.download_manager = DownloadManager(self.ftp_conn, self.journal, processes)
         self.config_file = "ftp_config.json"
+        self.remote_files: Dict[str, FTPFileInfo] = {}  # 当前目录列表，按文件名索引
+        self.remote_file_list: List[FTPFileInfo] = []   # 当前目录列表，按显示顺序
         
         # 创建界面
         self.create_widgets()
@@ -442,7 +1012,7 @@ class FTPClientGUI:
         path_entry.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=(5, 0))
         
         ttk.Button(nav_frame, text="上级", command=self.go_parent).pack(side=tk.RIGHT, padx=(5, 0))
-        ttk.Button(nav_frame, text="刷新", command=self.refresh_remote).pack(side=tk.RIGHT, padx=(5, 0))
+        ttk.Button(nav_frame, text="刷新", command=lambda: self.refresh_remote(force=True)).pack(side=tk.RIGHT, padx=(5, 0))
         
         # 文件列表
         list_frame = ttk.Frame(browser_frame)
@@ -466,8 +1036,8 @@ class FTPClientGUI:
         self.remote_tree.column("权限", width=100, minwidth=80)
         
         # 滚动条
-        remote_scroll = ttk.Scrollbar(list_frame, orient=tk.VERTICAL, command=self.remote_tree.yview)
-        self.remote_tree.configure(yscrollcommand=remote_scroll.set)
+        remote_scroll = ttk.Scrollbar(list_frame, orient=tk.VERTICAL)
+        self.remote_view = VirtualTreeview(self.remote_tree, remote_scroll, self.remote_row)
         
         self.remote_tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
         remote_scroll.pack(side=tk.RIGHT, fill=tk.Y)
@@ -482,6 +1052,7 @@ class FTPClientGUI:
         
         ttk.Button(btn_frame, text="下载选中", command=self.download_selected).pack(side=tk.LEFT, padx=(0, 5))
         ttk.Button(btn_frame, text="下载目录", command=self.download_directory).pack(side=tk.LEFT, padx=(0, 5))
+        ttk.Button(btn_frame, text="上传文件", command=self.upload_files).pack(side=tk.LEFT, padx=(0, 5))
         ttk.Button(btn_frame, text="新建目录", command=self.create_directory).pack(side=tk.LEFT, padx=(0, 5))
     
     def create_download_panel(self, parent):
@@ -500,6 +1071,34 @@ class FTPClientGUI:
         
         ttk.Button(settings_frame, text="浏览", command=self.browse_download_path).pack(side=tk.RIGHT, padx=(5, 0))
         
+        # 并发数，修改后立即生效；勾选"自动"时按吞吐量自动调节
+        self.auto_concurrent_var = tk.BooleanVar(value=self.download_manager.auto_concurrency)
+        ttk.Checkbutton(settings_frame, text="自动", variable=self.auto_concurrent_var,
+                        command=self.on_auto_concurrent_change).pack(side=tk.RIGHT, padx=(5, 0))
+        self.concurrent_var = tk.StringVar(value=str(self.download_manager.max_concurrent))
+        ttk.Spinbox(settings_frame, from_=1, to=self.ftp_conn.max_transfers, width=5, textvariable=self.concurrent_var,
+                    command=self.on_concurrent_change).pack(side=tk.RIGHT, padx=(5, 0))
+        ttk.Label(settings_frame, text="并发:").pack(side=tk.RIGHT, padx=(5, 0))
+        
+        # 总限速 (KB/s，0为不限速)，修改后对正在进行的下载立即生效
+        self.rate_limit_var = tk.StringVar(value="0")
+        rate_box = ttk.Spinbox(settings_frame, from_=0, to=1024 * 1024, increment=100, width=7,
+                               textvariable=self.rate_limit_var, command=self.on_rate_limit_change)
+        rate_box.pack(side=tk.RIGHT, padx=(5, 0))
+        rate_box.bind('<Return>', lambda e: self.on_rate_limit_change())
+        rate_box.bind('<FocusOut>', lambda e: self.on_rate_limit_change())
+        ttk.Label(settings_frame, text="限速KB/s:").pack(side=tk.RIGHT, padx=(5, 0))
+        
+        # 完整性校验：服务器支持 HASH/XMD5 等命令或有 .sha256/.md5 校验文件时生效
+        self.verify_var = tk.BooleanVar(value=self.download_manager.verify)
+        ttk.Checkbutton(settings_frame, text="校验", variable=self.verify_var,
+                        command=self.on_verify_change).pack(side=tk.RIGHT, padx=(5, 0))
+        
+        # 按实测吞吐量自适应调整接收块大小，默认使用固定大小的缓冲区
+        self.adaptive_var = tk.BooleanVar(value=self.download_manager.chunk_size == ADAPTIVE)
+        ttk.Checkbutton(settings_frame, text="自适应块", variable=self.adaptive_var,
+                        command=self.on_adaptive_change).pack(side=tk.RIGHT, padx=(5, 0))
+        
         # 下载任务列表
         task_frame = ttk.Frame(download_frame)
         task_frame.pack(fill=tk.BOTH, expand=True, pady=(5, 0))
@@ -518,11 +1117,12 @@ class FTPClientGUI:
         self.task_tree.column("状态", width=80, minwidth=60)
         
         # 滚动条
-        task_scroll = ttk.Scrollbar(task_frame, orient=tk.VERTICAL, command=self.task_tree.yview)
-        self.task_tree.configure(yscrollcommand=task_scroll.set)
+        task_scroll = ttk.Scrollbar(task_frame, orient=tk.VERTICAL)
+        self.task_view = VirtualTreeview(self.task_tree, task_scroll, self.task_row)
         
         self.task_tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
         task_scroll.pack(side=tk.RIGHT, fill=tk.Y)
+        self.task_tree.bind('<Button-3>', self.show_task_context_menu)
         
         # 下载控制按钮
         control_frame = ttk.Frame(download_frame)
@@ -598,6 +1198,11 @@ class FTPClientGUI:
         self.path_var.set(self.ftp_conn.current_path)
         self.refresh_remote()
         self.save_config()
+        
+        # 恢复上次 (包括崩溃前) 未清除的下载任务
+        restored = self.download_manager.restore_tasks()
+        if restored:
+            self.status_var.set(f"连接成功，已从传输日志恢复 {restored} 个任务")
     
     def on_connect_error(self, error_msg):
         """连接失败回调"""
@@ -608,25 +1213,31 @@ class FTPClientGUI:
     def disconnect_ftp(self):
         """断开FTP连接"""
         self.ftp_conn.disconnect()
+        self.remote_files = {}
+        self.remote_file_list = []
         self.status_var.set("已断开连接")
         self.conn_status_var.set("未连接")
         self.connect_btn.config(state=tk.NORMAL)
         self.disconnect_btn.config(state=tk.DISABLED)
         
         # 清空远程文件列表
-        for item in self.remote_tree.get_children():
-            self.remote_tree.delete(item)
+        self.remote_view.clear()
     
-    def refresh_remote(self):
-        """刷新远程文件列表"""
+    def refresh_remote(self, force=False):
+        """刷新远程文件列表；force 为 True 时使缓存失效并重新获取"""
         if not self.ftp_conn.connected:
             return
         
+        # 命中缓存时直接在界面线程渲染
+        if not force and self.ftp_conn.current_path in self.ftp_conn.listing_cache:
+            self.update_remote_list(self.ftp_conn.list_directory())
+            return
+        
         self.status_var.set("正在获取文件列表...")
         
         def refresh_thread():
             try:
-                files = self.ftp_conn.list_directory()
+                files = self.ftp_conn.list_directory(refresh=force)
                 self.root.after(0, lambda: self.update_remote_list(files))
             except Exception as e:
                 self.root.after(0, lambda: self.on_refresh_error(str(e)))
@@ -634,46 +1245,38 @@ class FTPClientGUI:
         threading.Thread(target=refresh_thread, daemon=True).start()
     
     def update_remote_list(self, files: List[FTPFileInfo]):
-        """更新远程文件列表"""
-        # 清空现有列表
-        for item in self.remote_tree.get_children():
-            self.remote_tree.delete(item)
-        
-        # 添加文件
-        for file_info in files:
-            icon = "📁" if file_info.is_dir else "📄"
-            size_str = self.format_size(file_info.size) if not file_info.is_dir else ""
-            type_str = "目录" if file_info.is_dir else "文件"
-            
-            self.remote_tree.insert("", tk.END, 
-                                  text=icon,
-                                  values=(file_info.name, size_str, type_str, 
-                                         file_info.modified, file_info.permissions),
-                                  tags=("directory" if file_info.is_dir else "file",))
+        """更新远程文件列表 (只渲染可见区域的行)"""
+        self.remote_files = {f.name: f for f in files}
+        self.remote_file_list = files
+        self.remote_view.set_row_count(len(files), reset=True)
         
         self.path_var.set(self.ftp_conn.current_path)
-        self.status_var.set(f"找到 {len(files)} 个项目")
+        self.status_var.set(f"找到 {len(files)} 个项目 | {self.ftp_conn.listing_cache.format_stats()}")
     
     def on_refresh_error(self, error_msg):
         """刷新失败回调"""
         self.status_var.set("获取文件列表失败")
         messagebox.showerror("错误", f"获取文件列表失败:\n{error_msg}")
     
+    def remote_row(self, row):
+        """远程文件列表第 row 行的显示内容"""
+        file_info = self.remote_file_list[row]
+        icon = "📁" if file_info.is_dir else "📄"
+        size_str = self.format_size(file_info.size) if not file_info.is_dir else ""
+        type_str = "目录" if file_info.is_dir else "文件"
+        return (icon, (file_info.name, size_str, type_str, file_info.modified, file_info.permissions),
+                ("directory" if file_info.is_dir else "file",))
+    
     def on_remote_double_click(self, event):
         """远程文件双击事件"""
-        selection = self.remote_tree.selection()
-        if not selection:
+        row = self.remote_view.row_at(event.y)
+        if row is None:
             return
         
-        item = selection[0]
-        values = self.remote_tree.item(item, "values")
-        if not values:
-            return
-        
-        filename = values[0]
-        is_dir = values[2] == "目录"
+        file_info = self.remote_file_list[row]
+        filename = file_info.name
         
-        if is_dir:
+        if file_info.is_dir:
             # 进入目录
             new_path = self.ftp_conn.current_path
             if new_path.endswith('/'):
@@ -707,15 +1310,15 @@ class FTPClientGUI:
     
     def download_selected(self):
         """下载选中的文件"""
-        selection = self.remote_tree.selection()
-        if not selection:
+        rows = self.remote_view.selected_rows()
+        if not rows:
             messagebox.showwarning("提示", "请选择要下载的文件")
             return
         
-        for item in selection:
-            values = self.remote_tree.item(item, "values")
-            if values and values[2] == "文件":
-                self.download_file(values[0])
+        for row in rows:
+            file_info = self.remote_file_list[row]
+            if not file_info.is_dir:
+                self.download_file(file_info.name)
     
     def download_file(self, filename):
         """下载单个文件"""
@@ -727,11 +1330,13 @@ class FTPClientGUI:
         
         local_path = Path(self.download_path_var.get()) / filename
         
-        # 获取文件大小
-        size = self.ftp_conn.get_file_size(remote_path) or 0
+        # 优先使用LIST已解析的大小，未知时由下载管理器在后台查询
+        file_info = self.remote_files.get(filename)
+        size = file_info.size if file_info and not file_info.is_dir else 0
+        mtime = file_info.mtime if file_info else None
         
         # 添加下载任务
-        task = self.download_manager.add_task(remote_path, str(local_path), size)
+        task = self.download_manager.add_task(remote_path, str(local_path), size, mtime)
         self.status_var.set(f"已添加下载任务: {filename}")
     
     def download_directory(self):
@@ -744,11 +1349,7 @@ class FTPClientGUI:
             return
         
         # 获取所有文件
-        files = []
-        for item in self.remote_tree.get_children():
-            values = self.remote_tree.item(item, "values")
-            if values and values[2] == "文件":
-                files.append(values[0])
+        files = [f.name for f in self.remote_file_list if not f.is_dir]
         
         if not files:
             messagebox.showinfo("提示", "当前目录没有文件")
@@ -760,6 +1361,85 @@ class FTPClientGUI:
         
         self.status_var.set(f"已添加 {len(files)} 个下载任务")
     
+    def upload_files(self):
+        """上传本地文件到当前远程目录，与下载任务共用同一个队列"""
+        if not self.ftp_conn.connected:
+            return
+        
+        paths = filedialog.askopenfilenames(title="选择要上传的文件")
+        if not paths:
+            return
+        
+        base = self.ftp_conn.current_path.rstrip('/')
+        for path in paths:
+            self.download_manager.add_upload(path, f"{base}/{Path(path).name}")
+        self.status_var.set(f"已添加 {len(paths)} 个上传任务")
+    
+    def on_concurrent_change(self):
+        """并发数变化时的回调 (手动设置后关闭自动调节)"""
+        try:
+            value = int(self.concurrent_var.get())
+        except ValueError:
+            return
+        self.auto_concurrent_var.set(False)
+        self.download_manager.set_auto_concurrency(False)
+        self.download_manager.set_max_concurrent(value)
+        self.status_var.set(f"最大并发数: {self.download_manager.max_concurrent}")
+    
+    def on_auto_concurrent_change(self):
+        """切换并发数自动调节"""
+        enabled = self.auto_concurrent_var.get()
+        self.download_manager.set_auto_concurrency(enabled)
+        self.status_var.set("并发数: 自动调节" if enabled else
+                            f"最大并发数: {self.download_manager.max_concurrent}")
+    
+    def on_verify_change(self):
+        """切换下载完整性校验"""
+        self.download_manager.verify = self.verify_var.get()
+    
+    def on_adaptive_change(self):
+        """切换自适应接收块大小，关闭时回到固定缓冲区 (--splice 设置的 SPLICE 不受影响)"""
+        if self.adaptive_var.get():
+            self.download_manager.chunk_size = ADAPTIVE
+        elif self.download_manager.chunk_size == ADAPTIVE:
+            self.download_manager.chunk_size = DEFAULT_BUFFER_SIZE
+    
+    def on_rate_limit_change(self):
+        """总限速变化时的回调"""
+        try:
+            rate = max(0, int(float(self.rate_limit_var.get())))
+        except ValueError:
+            return
+        self.download_manager.bandwidth.set_global_rate(rate * 1024)
+        self.status_var.set(f"总限速: {rate} KB/s" if rate else "总限速: 不限速")
+    
+    def show_task_context_menu(self, event):
+        """任务列表右键菜单：设置所选任务的限速"""
+        row = self.task_view.row_at(event.y)
+        rows = self.task_view.selected_rows()
+        if row is not None and row not in rows:
+            rows = [row]
+        tasks = [self.download_manager.tasks[r] for r in rows if r < len(self.download_manager.tasks)]
+        if not tasks:
+            return
+        
+        menu = tk.Menu(self.root, tearoff=0)
+        menu.add_command(label="设置限速...", command=lambda: self.set_task_rate_limit(tasks))
+        menu.add_command(label="取消限速", command=lambda: self.set_task_rate_limit(tasks, 0))
+        menu.tk_popup(event.x_root, event.y_root)
+    
+    def set_task_rate_limit(self, tasks, rate=None):
+        """设置任务限速 (KB/s)，rate 为 None 时弹窗输入"""
+        if rate is None:
+            rate = simpledialog.askinteger("任务限速", "限速 (KB/s，0为不限速):",
+                                           initialvalue=tasks[0].bucket.rate // 1024, minvalue=0)
+            if rate is None:
+                return
+        for task in tasks:
+            task.bucket.set_rate(rate * 1024)
+        self.status_var.set(f"已设置 {len(tasks)} 个任务的限速: {rate} KB/s" if rate else
+                            f"已取消 {len(tasks)} 个任务的限速")
+    
     def browse_download_path(self):
         """浏览下载路径"""
         path = filedialog.askdirectory(initialdir=self.download_path_var.get())
@@ -769,8 +1449,9 @@ class FTPClientGUI:
     def start_all_downloads(self):
         """开始所有下载"""
         for task in self.download_manager.tasks:
-            if task.status in ["等待中", "失败"]:
-                task.status = "等待中"
+            if task.status == "失败":
+                self.download_manager.requeue(task)
+        self.download_manager.start_downloads()
         self.status_var.set("已开始所有下载任务")
     
     def pause_all_downloads(self):
@@ -782,14 +1463,14 @@ class FTPClientGUI:
     
     def clear_completed(self):
         """清除已完成的任务"""
-        self.download_manager.tasks = [t for t in self.download_manager.tasks if t.status != "已完成"]
+        self.download_manager.clear_tasks(completed_only=True)
         self.status_var.set("已清除完成的任务")
     
     def clear_all_tasks(self):
         """清除所有任务"""
         result = messagebox.askyesno("确认", "是否清除所有下载任务？")
         if result:
-            self.download_manager.tasks.clear()
+            self.download_manager.clear_tasks()
             self.status_var.set("已清除所有任务")
     
     def create_directory(self):
@@ -801,9 +1482,10 @@ class FTPClientGUI:
         if not dirname:
             return
         
+        remote_dir = self.ftp_conn.current_path.rstrip('/') + '/' + dirname
         try:
-            self.ftp_conn.ftp.mkd(dirname)
-            self.refresh_remote()
+            self.ftp_conn.ftp.mkd(remote_dir)
+            self.refresh_remote(force=True)
             self.status_var.set(f"已创建目录: {dirname}")
         except Exception as e:
             messagebox.showerror("错误", f"创建目录失败:\n{str(e)}")
@@ -821,24 +1503,33 @@ class FTPClientGUI:
         # 更新统计信息
         self.update_stats()
         
+        # 自动调节时显示调节器选择的并发数
+        if self.download_manager.auto_concurrency:
+            current = str(self.download_manager.max_concurrent)
+            if self.concurrent_var.get() != current:
+                self.concurrent_var.set(current)
+        
+        # 提交传输日志中尚未提交的进度
+        if self.journal is not None:
+            self.journal.commit()
+        
         # 每秒更新一次
         self.root.after(1000, self.update_ui)
     
     def update_task_list(self):
-        """更新下载任务列表"""
-        # 清空现有列表
-        for item in self.task_tree.get_children():
-            self.task_tree.delete(item)
-        
-        # 添加任务
-        for task in self.download_manager.tasks:
-            filename = Path(task.remote_path).name
-            size_str = self.format_size(task.size)
-            progress_str = f"{task.progress:.1f}%"
-            speed_str = self.format_size(task.speed) + "/s" if task.speed > 0 else ""
-            
-            self.task_tree.insert("", tk.END, 
-                                values=(filename, size_str, progress_str, speed_str, task.status))
+        """更新下载任务列表 (只刷新可见区域中内容有变化的行)"""
+        self.task_view.set_row_count(len(self.download_manager.tasks))
+    
+    def task_row(self, row):
+        """任务列表第 row 行的显示内容"""
+        task = self.download_manager.tasks[row]
+        filename = Path(task.remote_path).name
+        if task.upload:
+            filename = "↑ " + filename
+        size_str = self.format_size(task.size)
+        progress_str = f"{task.progress:.1f}%"
+        speed_str = self.format_size(task.speed) + "/s" if task.speed > 0 else ""
+        return ("", (filename, size_str, progress_str, speed_str, task.status), ())
     
     def update_stats(self):
         """更新统计信息"""
@@ -868,6 +1559,16 @@ class FTPClientGUI:
                 self.port_var.set(config.get('port', '21'))
                 self.username_var.set(config.get('username', ''))
                 self.download_path_var.set(config.get('download_path', str(Path.home() / "Downloads")))
+                
+                # 限速单位为 KB/s；host_rate_limits 按主机名单独限速
+                self.rate_limit_var.set(str(config.get('rate_limit', 0)))
+                self.on_rate_limit_change()
+                bandwidth = self.download_manager.bandwidth
+                for host, rate in config.get('host_rate_limits', {}).items():
+                    bandwidth.set_host_rate(int(rate) * 1024, host)
+                
+                self.verify_var.set(config.get('verify', False))
+                self.on_verify_change()
         except Exception as e:
             print(f"加载配置失败: {e}")
     
@@ -878,7 +1579,11 @@ class FTPClientGUI:
                 'host': self.host_var.get(),
                 'port': self.port_var.get(),
                 'username': self.username_var.get(),
-                'download_path': self.download_path_var.get()
+                'download_path': self.download_path_var.get(),
+                'rate_limit': self.download_manager.bandwidth.global_bucket.rate // 1024,
+                'host_rate_limits': {host: rate // 1024 for host, rate in
+                                     self.download_manager.bandwidth.host_rates().items()},
+                'verify': self.download_manager.verify
             }
             
             with open(self.config_file, 'w', encoding='utf-8') as f:
@@ -896,15 +1601,45 @@ class FTPClientGUI:
     
     def on_closing(self):
         """关闭程序"""
-        self.download_manager.stop_downloads()
+        self.download_manager.shutdown()
         self.ftp_conn.disconnect()
         self.save_config()
+        if self.journal is not None:
+            self.journal.commit()
         self.root.destroy()
+    
+    def open_journal(self) -> Optional[TransferJournal]:
+        """打开传输日志，失败时不记录日志，下载功能不受影响"""
+        try:
+            return TransferJournal()
+        except Exception as e:
+            print(f"打开传输日志失败: {e}")
+            return None
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='FTP断点续传下载工具 - GUI版本')
+    parser.add_argument('--async', dest='async_transfers', action='store_true',
+                        help='下载任务在一个事件循环中以协程运行，支持上千个并发下载')
+    parser.add_argument('--processes', type=int, default=0,
+                        help='下载在指定数量的工作进程中进行，开启校验时可以用满多个CPU核心 (不能与 --async 同时使用)')
+    parser.add_argument('--splice', action='store_true',
+                        help='Linux上用 splice 把接收的数据在内核中直接写入文件 (异步模式下不使用)')
+    parser.add_argument('--retries', type=int, default=0,
+                        help='网络错误后自动重试的次数，从已下载的位置续传 (默认0，直接标记为失败)')
+    parser.add_argument('--retry-policy', choices=sorted(POLICIES), default='fixed',
+                        help='重试前的等待: fixed 固定2秒，immediate 立即重连，backoff 指数退避')
+    return parser.parse_args(argv)
 
 def main():
     """主函数"""
+    multiprocessing.freeze_support()
+    args = parse_args()
     try:
-        app = FTPClientGUI()
+        app = FTPClientGUI(async_transfers=args.async_transfers, processes=args.processes)
+        if args.splice:
+            app.download_manager.chunk_size = SPLICE
+        app.download_manager.max_retries = args.retries
+        app.download_manager.retry_policy = POLICIES[args.retry_policy]
         app.run()
     except Exception as e:
         messagebox.showerror("错误", f"程序启动失败:\n{str(e)}")
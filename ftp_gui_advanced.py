@@ -10,12 +10,12 @@ import sys
 import time
 import json
 import ftplib
-import hashlib
 import threading
+import multiprocessing
 from pathlib import Path
 from datetime import datetime
 from urllib.parse import urlparse
-from dataclasses import dataclass, asdict
+from dataclasses import dataclass
 from typing import List, Optional, Dict, Any, Callable
 
 import tkinter as tk
@@ -23,7 +23,12 @@ from tkinter import ttk, filedialog, messagebox, simpledialog
 from tkinter.scrolledtext import ScrolledText
 
 # 导入基础GUI类
-from ftp_gui import FTPClientGUI, FTPConnection, DownloadManager, DownloadTask, FTPFileInfo
+from ftp_gui import FTPClientGUI, FTPConnection, DownloadManager, DownloadTask, FTPFileInfo, parse_args
+from ftp_integrity import StreamHash
+from ftp_sync import SyncEngine, SyncPlan, load_history
+from ftp_transfer import SPLICE
+
+SYNC_PROFILES_FILE = "sync_profiles.json"
 
 class SyncProfile:
     """同步配置文件"""
@@ -41,7 +46,7 @@ class SyncProfile:
         self.sync_interval = 300  # 5分钟
         
     def to_dict(self):
-        return asdict(self)
+        return dict(self.__dict__)
     
     @classmethod
     def from_dict(cls, data):
@@ -61,6 +66,10 @@ class TransferQueue:
         self.max_concurrent = 3
         self.active_transfers = 0
         self.paused = False
+    
+    def set_max_concurrent(self, value: int):
+        """设置最大并发数 (由下载管理器的并发调节器同步)"""
+        self.max_concurrent = max(1, int(value))
         
     def add_task(self, task: DownloadTask):
         """添加任务到队列"""
@@ -87,19 +96,31 @@ class TransferQueue:
         if task in self.queue:
             self.queue.remove(task)
         self.failed.append(task)
+    
+    def restore(self, tasks: List[DownloadTask]):
+        """按状态重建队列 (从传输日志恢复任务后调用)"""
+        self.queue = [t for t in tasks if t.status not in ("已完成", "失败")]
+        self.completed = [t for t in tasks if t.status == "已完成"]
+        self.failed = [t for t in tasks if t.status == "失败"]
 
 class AdvancedFTPGUI(FTPClientGUI):
     """高级FTP GUI客户端"""
     
-    def __init__(self):
+    def __init__(self, async_transfers: bool = False, processes: int = 0):
         # 初始化高级功能
         self.sync_profiles: List[SyncProfile] = []
         self.transfer_queue = TransferQueue()
         self.log_messages: List[str] = []
         self.bookmarks: Dict[str, Dict] = {}
+        self.current_profile: Optional[SyncProfile] = None
+        self.sync_running = False
         
         # 调用父类初始化
-        super().__init__()
+        super().__init__(async_transfers, processes)
+        
+        # 传输队列的并发数跟随下载管理器 (手动设置或自动调节)
+        self.transfer_queue.set_max_concurrent(self.download_manager.max_concurrent)
+        self.download_manager.on_concurrency_change = self.transfer_queue.set_max_concurrent
         
         # 添加高级功能界面
         self.create_advanced_widgets()
@@ -113,6 +134,11 @@ class AdvancedFTPGUI(FTPClientGUI):
         # 在主界面添加标签页
         self.create_tabbed_interface()
     
+    def on_connect_success(self):
+        """连接成功回调：传输日志恢复的任务同步到传输队列"""
+        super().on_connect_success()
+        self.transfer_queue.restore(self.download_manager.tasks)
+    
     def create_menu_bar(self):
         """创建菜单栏"""
         menubar = tk.Menu(self.root)
@@ -235,8 +261,9 @@ class AdvancedFTPGUI(FTPClientGUI):
         ttk.Label(left_frame, text="同步配置", font=('Arial', 12, 'bold')).pack(anchor=tk.W)
         
         # 配置列表
-        profile_listbox = tk.Listbox(left_frame, width=25)
+        profile_listbox = tk.Listbox(left_frame, width=25, exportselection=False)
         profile_listbox.pack(fill=tk.BOTH, expand=True, pady=(5, 0))
+        profile_listbox.bind('<<ListboxSelect>>', lambda e: self.on_sync_profile_select(profile_listbox))
         
         # 配置按钮
         btn_frame = ttk.Frame(left_frame)
@@ -463,6 +490,273 @@ FTP断点续传下载工具 v2.0
         
         messagebox.showinfo("关于", about_text)
     
+    # ---------- 同步 ----------
+    
+    def start_sync(self):
+        """依次同步所有配置"""
+        if not self.sync_profiles:
+            messagebox.showinfo("提示", "请先在“同步配置”中创建配置")
+            return
+        self.run_sync(list(self.sync_profiles))
+    
+    def compare_files(self):
+        """对比当前远程目录与下载目录，只显示差异不传输"""
+        profile = self.current_profile
+        if profile is None:
+            profile = SyncProfile("当前目录")
+            profile.remote_path = self.ftp_conn.current_path
+            profile.local_path = self.download_path_var.get()
+        self.run_sync([profile], dry_run=True)
+    
+    def run_sync(self, profiles: List[SyncProfile], dry_run: bool = False):
+        """在后台线程中扫描、对比并执行同步"""
+        if not self.ftp_conn.connected:
+            messagebox.showwarning("警告", "请先连接FTP服务器")
+            return
+        if self.sync_running:
+            messagebox.showinfo("提示", "同步正在进行中")
+            return
+        self.sync_running = True
+        
+        def sync_thread():
+            try:
+                for profile in profiles:
+                    engine = SyncEngine(
+                        profile, self.ftp_conn.transfer_connection,
+                        workers=self.download_manager.max_concurrent,
+                        log=lambda msg: self.add_log_message(msg, "SYNC")
+                    )
+                    self.root.after(0, lambda p=profile: self.status_var.set(f"正在扫描: {p.name}"))
+                    plan = engine.plan()
+                    self.add_log_message(f"同步对比 [{profile.name}]: {plan.summary()}", "SYNC")
+                    
+                    if dry_run:
+                        self.root.after(0, lambda p=profile, pl=plan: self.show_sync_plan(p, pl))
+                        continue
+                    
+                    def progress(done, total, path, name=profile.name):
+                        self.root.after(0, lambda: self.status_var.set(f"同步 {name}: {done}/{total} {path}"))
+                    
+                    record = engine.execute(plan, progress)
+                    self.add_log_message(f"同步完成 [{profile.name}]: 失败 {record['failed']}, 用时 {record['duration']}秒", "SYNC")
+                    self.root.after(0, lambda p=profile, pl=plan: self.status_var.set(f"同步完成 {p.name}: {pl.summary()}"))
+            except Exception as e:
+                self.add_log_message(f"同步失败: {e}", "ERROR")
+                self.root.after(0, lambda msg=str(e): messagebox.showerror("错误", f"同步失败: {msg}"))
+            finally:
+                self.sync_running = False
+        
+        threading.Thread(target=sync_thread, daemon=True).start()
+    
+    def calculate_checksums(self):
+        """校验已完成的下载：用 mmap 计算本地文件的哈希，与服务器端校验值或校验文件比较"""
+        if not self.ftp_conn.connected:
+            messagebox.showwarning("警告", "请先连接FTP服务器")
+            return
+        tasks = [t for t in self.download_manager.tasks if t.status == "已完成"]
+        if not tasks:
+            messagebox.showinfo("提示", "没有已完成的下载任务")
+            return
+        
+        def checksum_thread():
+            matched, mismatched, unknown = 0, [], 0
+            for done, task in enumerate(tasks, 1):
+                self.root.after(0, lambda d=done: self.status_var.set(f"正在校验: {d}/{len(tasks)}"))
+                try:
+                    with self.ftp_conn.transfer_connection() as ftp:
+                        checksum = self.download_manager.integrity.expected(ftp, task.remote_path)
+                    if checksum is None:
+                        unknown += 1
+                        continue
+                    digest = StreamHash(checksum.algorithm)
+                    digest.update_file(task.local_path)
+                    if digest.matches(checksum):
+                        matched += 1
+                    else:
+                        mismatched.append(task.remote_path)
+                        task.status = "失败"
+                        task.error_msg = f"校验失败 ({checksum.source} {checksum.algorithm})"
+                        self.add_log_message(f"校验失败: {task.remote_path} ({checksum.source})", "ERROR")
+                except Exception as e:
+                    unknown += 1
+                    self.add_log_message(f"校验出错: {task.remote_path} - {e}", "ERROR")
+            
+            summary = f"一致: {matched}\n不一致: {len(mismatched)}\n无法校验: {unknown}"
+            if mismatched:
+                summary += "\n\n" + "\n".join(mismatched[:20])
+            self.add_log_message(f"校验完成: 一致 {matched}, 不一致 {len(mismatched)}, 无法校验 {unknown}")
+            self.root.after(0, lambda: self.status_var.set("校验完成"))
+            self.root.after(0, lambda: messagebox.showinfo("校验和", summary))
+        
+        threading.Thread(target=checksum_thread, daemon=True).start()
+    
+    def show_sync_plan(self, profile: SyncProfile, plan: SyncPlan):
+        """显示对比结果"""
+        window = tk.Toplevel(self.root)
+        window.title(f"文件比较 - {profile.name}")
+        window.geometry("800x500")
+        window.transient(self.root)
+        
+        frame = ttk.Frame(window, padding=10)
+        frame.pack(fill=tk.BOTH, expand=True)
+        ttk.Label(frame, text=plan.summary()).pack(anchor=tk.W, pady=(0, 10))
+        
+        tree = ttk.Treeview(frame, columns=("操作", "路径"), show="headings")
+        tree.heading("操作", text="操作")
+        tree.heading("路径", text="路径")
+        tree.column("操作", width=100)
+        tree.column("路径", width=650)
+        scrollbar = ttk.Scrollbar(frame, orient=tk.VERTICAL, command=tree.yview)
+        tree.configure(yscrollcommand=scrollbar.set)
+        tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        
+        for label, paths in (("下载", plan.downloads), ("上传", plan.uploads),
+                             ("删除本地", plan.delete_local), ("删除远程", plan.delete_remote)):
+            for path in paths:
+                tree.insert("", tk.END, values=(label, path))
+    
+    def show_sync_history(self):
+        """显示同步历史"""
+        window = tk.Toplevel(self.root)
+        window.title("同步历史")
+        window.geometry("900x400")
+        window.transient(self.root)
+        
+        frame = ttk.Frame(window, padding=10)
+        frame.pack(fill=tk.BOTH, expand=True)
+        
+        columns = ("时间", "配置", "模式", "下载", "上传", "删除", "未变化", "失败", "大小", "用时")
+        tree = ttk.Treeview(frame, columns=columns, show="headings")
+        for col in columns:
+            tree.heading(col, text=col)
+            tree.column(col, width=140 if col == "时间" else 80)
+        scrollbar = ttk.Scrollbar(frame, orient=tk.VERTICAL, command=tree.yview)
+        tree.configure(yscrollcommand=scrollbar.set)
+        tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        
+        for record in reversed(load_history()):
+            tree.insert("", tk.END, values=(
+                record.get('time', ''), record.get('profile', ''), record.get('mode', ''),
+                record.get('downloaded', 0), record.get('uploaded', 0), record.get('deleted', 0),
+                record.get('unchanged', 0), record.get('failed', 0),
+                self.format_size(record.get('bytes', 0)), f"{record.get('duration', 0)}秒"
+            ))
+    
+    # ---------- 同步配置 ----------
+    
+    def populate_sync_profiles(self, listbox):
+        listbox.delete(0, tk.END)
+        for profile in self.sync_profiles:
+            listbox.insert(tk.END, profile.name)
+    
+    def on_sync_profile_select(self, listbox):
+        """选中配置后填充表单"""
+        selection = listbox.curselection()
+        if not selection:
+            return
+        profile = self.sync_profiles[selection[0]]
+        self.current_profile = profile
+        self.sync_name_var.set(profile.name)
+        self.sync_remote_var.set(profile.remote_path)
+        self.sync_local_var.set(profile.local_path)
+        self.sync_mode_var.set(profile.sync_mode)
+        self.sync_filters_var.set(";".join(profile.file_filters))
+        self.sync_exclude_var.set(";".join(profile.exclude_patterns))
+        self.delete_extra_var.set(profile.delete_extra)
+        self.preserve_timestamps_var.set(profile.preserve_timestamps)
+        self.auto_sync_var.set(profile.auto_sync)
+        self.sync_interval_var.set(str(profile.sync_interval))
+    
+    def new_sync_profile(self, listbox):
+        name = simpledialog.askstring("新建配置", "配置名称:", parent=self.root)
+        if not name:
+            return
+        profile = SyncProfile(name)
+        profile.remote_path = self.ftp_conn.current_path
+        profile.local_path = self.download_path_var.get()
+        self.sync_profiles.append(profile)
+        self.save_sync_profiles()
+        self.populate_sync_profiles(listbox)
+        listbox.selection_set(tk.END)
+        self.on_sync_profile_select(listbox)
+    
+    def delete_sync_profile(self, listbox):
+        selection = listbox.curselection()
+        if not selection:
+            return
+        profile = self.sync_profiles.pop(selection[0])
+        if profile is self.current_profile:
+            self.current_profile = None
+        self.save_sync_profiles()
+        self.populate_sync_profiles(listbox)
+    
+    def copy_sync_profile(self, listbox):
+        selection = listbox.curselection()
+        if not selection:
+            return
+        profile = SyncProfile.from_dict(self.sync_profiles[selection[0]].to_dict())
+        profile.name += " - 副本"
+        self.sync_profiles.append(profile)
+        self.save_sync_profiles()
+        self.populate_sync_profiles(listbox)
+    
+    def browse_sync_local_path(self):
+        path = filedialog.askdirectory(initialdir=self.sync_local_var.get() or None)
+        if path:
+            self.sync_local_var.set(path)
+    
+    def profile_from_form(self, profile: Optional[SyncProfile] = None) -> SyncProfile:
+        """把表单内容写入配置 (未指定时新建一个)"""
+        profile = profile or SyncProfile()
+        profile.name = self.sync_name_var.get().strip() or "未命名"
+        profile.remote_path = self.sync_remote_var.get().strip() or "/"
+        profile.local_path = self.sync_local_var.get().strip()
+        profile.sync_mode = self.sync_mode_var.get()
+        profile.file_filters = [p.strip() for p in self.sync_filters_var.get().split(';') if p.strip()] or ["*"]
+        profile.exclude_patterns = [p.strip() for p in self.sync_exclude_var.get().split(';') if p.strip()]
+        profile.delete_extra = self.delete_extra_var.get()
+        profile.preserve_timestamps = self.preserve_timestamps_var.get()
+        profile.auto_sync = self.auto_sync_var.get()
+        try:
+            profile.sync_interval = int(self.sync_interval_var.get())
+        except ValueError:
+            pass
+        return profile
+    
+    def save_sync_profile(self):
+        if self.current_profile is None:
+            self.current_profile = self.profile_from_form()
+            self.sync_profiles.append(self.current_profile)
+        else:
+            self.profile_from_form(self.current_profile)
+        self.save_sync_profiles()
+        messagebox.showinfo("成功", f"配置已保存: {self.current_profile.name}")
+    
+    def test_sync_profile(self):
+        """按表单内容只做对比，不传输"""
+        self.run_sync([self.profile_from_form()], dry_run=True)
+    
+    def execute_sync_profile(self):
+        self.run_sync([self.profile_from_form(self.current_profile)])
+    
+    def save_sync_profiles(self):
+        try:
+            with open(SYNC_PROFILES_FILE, 'w', encoding='utf-8') as f:
+                json.dump([p.to_dict() for p in self.sync_profiles], f, ensure_ascii=False, indent=2)
+        except Exception as e:
+            self.add_log_message(f"保存同步配置失败: {e}", "ERROR")
+    
+    def load_advanced_config(self):
+        """加载同步配置"""
+        try:
+            if Path(SYNC_PROFILES_FILE).exists():
+                with open(SYNC_PROFILES_FILE, 'r', encoding='utf-8') as f:
+                    self.sync_profiles = [SyncProfile.from_dict(d) for d in json.load(f)]
+        except Exception as e:
+            self.add_log_message(f"加载同步配置失败: {e}", "ERROR")
+    
     # 实现其他方法的占位符
     def new_connection(self): pass
     def save_session(self): pass
@@ -473,11 +767,7 @@ FTP断点续传下载工具 v2.0
     def pause_all_transfers(self): pass
     def resume_all_transfers(self): pass
     def cancel_all_transfers(self): pass
-    def start_sync(self): pass
-    def show_sync_history(self): pass
-    def compare_files(self): pass
     def batch_rename(self): pass
-    def calculate_checksums(self): pass
     def cleanup_temp_files(self): pass
     def show_shortcuts(self): pass
     def populate_queue_tree(self, tree): pass
@@ -485,23 +775,18 @@ FTP断点续传下载工具 v2.0
     def resume_selected_tasks(self, tree): pass
     def cancel_selected_tasks(self, tree): pass
     def clear_completed_tasks(self, tree): pass
-    def populate_sync_profiles(self, listbox): pass
-    def new_sync_profile(self, listbox): pass
-    def delete_sync_profile(self, listbox): pass
-    def copy_sync_profile(self, listbox): pass
-    def browse_sync_local_path(self): pass
-    def save_sync_profile(self): pass
-    def test_sync_profile(self): pass
-    def execute_sync_profile(self): pass
     def clear_log(self, text_widget): pass
     def save_log(self, text_widget): pass
     def refresh_log(self, text_widget): pass
-    def load_advanced_config(self): pass
 
 def main():
     """主函数"""
+    multiprocessing.freeze_support()
+    args = parse_args()
     try:
-        app = AdvancedFTPGUI()
+        app = AdvancedFTPGUI(args.async_transfers, args.processes)
+        if args.splice:
+            app.download_manager.chunk_size = SPLICE
         app.run()
     except Exception as e:
         messagebox.showerror("错误", f"程序启动失败:\n{str(e)}")
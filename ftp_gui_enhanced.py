@@ -14,9 +14,18 @@ import socket
 from pathlib import Path
 from datetime import datetime
 
+from ftp_integrity import IntegrityChecker
+from ftp_journal import TransferJournal
+from ftp_listing import ListingCache, ListingEngine, ListingTable
+from ftp_pool import FTPConnectionPool, SizePrefetcher, fetch_sizes
+from ftp_ratelimit import BandwidthManager, SpeedMeter, TokenBucket
+from ftp_storage import download_part, resume_size
+from ftp_transfer import AdaptiveBlockSizer
+from ftp_treeview import VirtualTreeview
+
 try:
     import tkinter as tk
-    from tkinter import ttk, filedialog, messagebox
+    from tkinter import ttk, filedialog, messagebox, simpledialog
 except ImportError:
     print("错误: 未找到tkinter模块")
     sys.exit(1)
@@ -32,6 +41,8 @@ class DownloadTask:
         self.status = "等待中"
         self.start_time = None
         self.error_msg = ""
+        self.bucket = TokenBucket()  # 单个任务的限速
+        self.journal_id = None  # 传输日志中的编号
 
 class EnhancedFTPGUI:
     """增强版FTP GUI客户端 - 优化连接兼容性"""
@@ -43,14 +54,32 @@ class EnhancedFTPGUI:
         
         # FTP连接
         self.ftp = None
+        self.lister = None
         self.connected = False
         self.current_path = "/"
+        self.server_path = "/"  # 服务器端实际的工作目录
+        
+        # 目录列表缓存，前进/后退时直接从缓存渲染
+        self.listing_cache = ListingCache()
         
         # 连接配置
         self.passive_mode = True
         self.encoding = 'utf-8'
         self.timeout = 30
         
+        # 下载连接池，复用已登录的会话
+        self.pool = FTPConnectionPool()
+        self.size_prefetcher = SizePrefetcher(self.pool_connection)
+        
+        # 全局和按主机限速，任务限速见 DownloadTask.bucket
+        self.bandwidth = BandwidthManager()
+        
+        # 传输日志，崩溃或重启后据此恢复下载列表
+        self.journal = self.open_journal()
+        
+        # 完整性校验：下载时边收边算哈希，与服务器端校验值或校验文件比较
+        self.integrity = IntegrityChecker()
+        
         # 下载任务
         self.download_tasks = []
         self.downloading = False
@@ -71,8 +100,9 @@ class EnhancedFTPGUI:
         self.show_hidden_var = None
         
         # 文件数据
-        self.file_data = []  # 存储原始文件数据
-        self.filtered_data = []  # 存储过滤后的数据
+        self.file_data = ListingTable([])  # 按列存储的原始文件数据
+        self.filtered_data = []  # 过滤排序后的行号
+        self.file_sizes = {}  # 文件名 -> LIST解析出的大小
         
         # 界面组件
         self.connect_btn = None
@@ -185,7 +215,7 @@ class EnhancedFTPGUI:
         
         ttk.Button(path_frame, text="🏠", command=self.go_home, width=3).pack(side=tk.RIGHT, padx=1)
         ttk.Button(path_frame, text="⬆️", command=self.go_up, width=3).pack(side=tk.RIGHT, padx=1)
-        ttk.Button(path_frame, text="🔄", command=self.refresh, width=3).pack(side=tk.RIGHT, padx=1)
+        ttk.Button(path_frame, text="🔄", command=lambda: self.refresh(force=True), width=3).pack(side=tk.RIGHT, padx=1)
         
         # 搜索和排序栏
         search_frame = ttk.Frame(parent)
@@ -235,8 +265,8 @@ class EnhancedFTPGUI:
         self.file_tree.column("date", width=120, minwidth=100)
         
         # 滚动条
-        scrollbar1 = ttk.Scrollbar(list_frame, orient=tk.VERTICAL, command=self.file_tree.yview)
-        self.file_tree.configure(yscrollcommand=scrollbar1.set)
+        scrollbar1 = ttk.Scrollbar(list_frame, orient=tk.VERTICAL)
+        self.file_view = VirtualTreeview(self.file_tree, scrollbar1, self.file_row)
         
         self.file_tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
         scrollbar1.pack(side=tk.RIGHT, fill=tk.Y)
@@ -263,6 +293,23 @@ class EnhancedFTPGUI:
         save_entry.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=5)
         ttk.Button(save_frame, text="浏览", command=self.browse_save_path).pack(side=tk.RIGHT)
         
+        # 总限速 (KB/s，0为不限速)，修改后对正在进行的下载立即生效
+        self.rate_limit_var = tk.StringVar(value="0")
+        rate_box = ttk.Spinbox(save_frame, from_=0, to=1024 * 1024, increment=100, width=7,
+                               textvariable=self.rate_limit_var, command=self.on_rate_limit_change)
+        rate_box.pack(side=tk.RIGHT, padx=5)
+        rate_box.bind('<Return>', lambda e: self.on_rate_limit_change())
+        rate_box.bind('<FocusOut>', lambda e: self.on_rate_limit_change())
+        ttk.Label(save_frame, text="限速KB/s:").pack(side=tk.RIGHT)
+        
+        # 完整性校验，服务器支持 HASH/XMD5 等命令或有 .sha256/.md5 校验文件时生效
+        self.verify_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(save_frame, text="校验", variable=self.verify_var).pack(side=tk.RIGHT, padx=5)
+        
+        # 按实测吞吐量自适应调整接收块大小，默认使用固定大小的缓冲区
+        self.adaptive_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(save_frame, text="自适应块", variable=self.adaptive_var).pack(side=tk.RIGHT, padx=5)
+        
         # 下载列表框架
         download_frame = ttk.Frame(parent)
         download_frame.pack(fill=tk.BOTH, expand=True)
@@ -282,10 +329,11 @@ class EnhancedFTPGUI:
         self.download_tree.column("status", width=80, minwidth=60)
         
         # 滚动条
-        scrollbar2 = ttk.Scrollbar(download_frame, orient=tk.VERTICAL, command=self.download_tree.yview)
-        self.download_tree.configure(yscrollcommand=scrollbar2.set)
+        scrollbar2 = ttk.Scrollbar(download_frame, orient=tk.VERTICAL)
+        self.download_view = VirtualTreeview(self.download_tree, scrollbar2, self.download_row)
         
         self.download_tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        self.download_tree.bind('<Button-3>', self.show_download_context_menu)
         scrollbar2.pack(side=tk.RIGHT, fill=tk.Y)
         
         # 下载控制按钮
@@ -377,6 +425,7 @@ class EnhancedFTPGUI:
         username = self.username_var.get() or "anonymous"
         password = self.password_var.get()
         passive = self.passive_var.get()
+        self.pool.timeout = timeout
         
         self.status_var.set("正在连接...")
         self.connect_btn.config(state=tk.DISABLED)
@@ -426,8 +475,11 @@ class EnhancedFTPGUI:
     def on_connect_success(self, ftp, current_path):
         """连接成功回调"""
         self.ftp = ftp
+        self.lister = ListingEngine(ftp, self.log_message)
         self.connected = True
         self.current_path = current_path
+        self.server_path = current_path
+        self.listing_cache.invalidate()
         
         self.status_var.set(f"已连接到 {self.host_var.get()}")
         self.connect_btn.config(text="断开", command=self.disconnect, state=tk.NORMAL)
@@ -435,6 +487,7 @@ class EnhancedFTPGUI:
         
         self.log_message("连接成功，开始获取文件列表")
         self.refresh()
+        self.restore_downloads()
     
     def on_connect_error(self, error_msg):
         """连接失败回调"""
@@ -451,14 +504,15 @@ class EnhancedFTPGUI:
             except:
                 self.log_message("强制断开FTP连接")
             self.ftp = None
+        self.lister = None
         
+        self.pool.clear()
         self.connected = False
         self.status_var.set("已断开连接")
         self.connect_btn.config(text="连接", command=self.connect)
         
         # 清空文件列表
-        for item in self.file_tree.get_children():
-            self.file_tree.delete(item)
+        self.file_view.clear()
     
     def show_connection_log(self):
         """显示连接日志"""
@@ -501,37 +555,36 @@ class EnhancedFTPGUI:
         log_text.config(state=tk.DISABLED)
         log_text.see(tk.END)
     
-    def refresh(self):
-        """刷新文件列表"""
+    def refresh(self, force=False):
+        """刷新文件列表；force 为 True 时使当前目录的缓存失效"""
         if not self.connected or not self.ftp:
             return
         
+        path = self.current_path
+        if force:
+            self.listing_cache.invalidate(path)
+        else:
+            cached = self.listing_cache.get(path)
+            if cached is not None:
+                self.log_message(f"列表缓存命中: {path} ({self.listing_cache.format_stats()})")
+                self.update_file_list(cached)
+                return
+        
         self.status_var.set("正在获取文件列表...")
         self.log_message("开始获取文件列表")
         
         def refresh_thread():
             try:
-                files = []
+                # 缓存导航只改变了本地路径，列表前先同步服务器工作目录
+                if self.server_path != path:
+                    self.ftp.cwd(path)
+                    self.server_path = path
                 
-                # 尝试不同的LIST命令
-                try:
-                    self.ftp.retrlines('LIST', files.append)
-                    self.log_message(f"使用LIST命令获取到 {len(files)} 行数据")
-                except Exception as e:
-                    self.log_message(f"LIST命令失败: {e}")
-                    # 尝试NLST命令
-                    try:
-                        files = self.ftp.nlst()
-                        self.log_message(f"使用NLST命令获取到 {len(files)} 个文件")
-                        # 转换为LIST格式
-                        formatted_files = []
-                        for filename in files:
-                            if filename not in ['.', '..']:
-                                formatted_files.append(f"-rw-r--r-- 1 user user 0 Jan 1 00:00 {filename}")
-                        files = formatted_files
-                    except Exception as e2:
-                        self.log_message(f"NLST命令也失败: {e2}")
-                        raise e
+                # 列表引擎自动选择 MLSD / LIST / NLST
+                files = self.lister.list_dir()
+                self.listing_cache.put(path, files)
+                self.log_message(f"使用{self.lister.last_method}命令获取到 {len(files)} 个文件项")
+                self.log_message(self.listing_cache.format_stats())
                 
                 self.root.after(0, lambda: self.update_file_list(files))
             except Exception as e:
@@ -543,64 +596,12 @@ class EnhancedFTPGUI:
     
     def update_file_list(self, files):
         """更新文件列表"""
-        self.log_message(f"解析 {len(files)} 个文件项")
-        
-        # 解析文件信息到内部数据结构
-        self.file_data = []
-        parsed_count = 0
-        
-        for line in files:
-            try:
-                if isinstance(line, str) and len(line.strip()) > 0:
-                    parts = line.split()
-                    if len(parts) >= 9:
-                        permissions = parts[0]
-                        is_dir = permissions.startswith('d')
-                        
-                        try:
-                            size = int(parts[4]) if not is_dir else 0
-                        except (ValueError, IndexError):
-                            size = 0
-                        
-                        filename = ' '.join(parts[8:])
-                        if filename in ['.', '..']:
-                            continue
-                        
-                        try:
-                            date_str = f"{parts[5]} {parts[6]} {parts[7]}"
-                        except IndexError:
-                            date_str = "未知"
-                        
-                        # 存储文件信息
-                        file_info = {
-                            'name': filename,
-                            'size': size,
-                            'is_dir': is_dir,
-                            'date': date_str,
-                            'permissions': permissions
-                        }
-                        self.file_data.append(file_info)
-                        parsed_count += 1
-                        
-                    elif len(parts) >= 1:
-                        # 简单文件名列表
-                        filename = parts[0]
-                        if filename not in ['.', '..']:
-                            file_info = {
-                                'name': filename,
-                                'size': 0,
-                                'is_dir': False,
-                                'date': "未知",
-                                'permissions': "-rw-r--r--"
-                            }
-                            self.file_data.append(file_info)
-                            parsed_count += 1
-            except Exception as e:
-                self.log_message(f"解析文件行失败: {line} - {e}")
-                continue
+        # 列表引擎已完成解析，这里只转换为内部数据结构
+        self.file_data = ListingTable(files)
         
+        self.file_sizes = {e.name: e.size for e in files if not e.is_dir}
         self.path_var.set(self.current_path)
-        self.log_message(f"成功解析 {parsed_count} 个文件项")
+        self.log_message(f"成功解析 {len(self.file_data)} 个文件项")
         
         # 应用搜索和排序
         self.apply_filter_and_sort()
@@ -610,24 +611,27 @@ class EnhancedFTPGUI:
         self.status_var.set("获取文件列表失败")
         messagebox.showerror("错误", f"获取文件列表失败:\n{error_msg}\n\n请检查连接日志获取详细信息")
     
+    def file_row(self, row):
+        """文件列表第 row 行的显示内容"""
+        table = self.file_data
+        i = self.filtered_data[row]
+        is_dir = table.is_dir[i]
+        icon = "📁" if is_dir else "📄"
+        size_str = self.format_size(table.sizes[i]) if not is_dir else ""
+        type_str = "目录" if is_dir else "文件"
+        return (f"{icon} {table.names[i]}", (size_str, type_str, table.entries[i].modified),
+                ("directory" if is_dir else "file",))
+    
     def on_double_click(self, event):
         """双击事件处理"""
-        selection = self.file_tree.selection()
-        if not selection:
-            return
-        
-        item = selection[0]
-        text = self.file_tree.item(item, "text")
-        values = self.file_tree.item(item, "values")
-        
-        if not values or len(values) < 2:
+        row = self.file_view.row_at(event.y)
+        if row is None:
             return
         
-        # 提取文件名
-        filename = text.split(" ", 1)[1] if " " in text else text.replace("📁 ", "").replace("📄 ", "")
-        is_dir = values[1] == "目录"
+        i = self.filtered_data[row]
+        filename = self.file_data.names[i]
         
-        if is_dir:
+        if self.file_data.is_dir[i]:
             # 进入目录
             self.change_directory(filename)
         else:
@@ -659,7 +663,7 @@ class EnhancedFTPGUI:
                     parent_path = '/'
                 
                 self.log_message(f"计算上级目录: {self.current_path} -> {parent_path}")
-                self.ftp.cwd(parent_path)
+                self.enter_directory(parent_path)
             else:
                 # 进入子目录
                 if self.current_path.endswith('/'):
@@ -668,10 +672,8 @@ class EnhancedFTPGUI:
                     new_path = self.current_path + '/' + dirname
                 
                 self.log_message(f"进入子目录: {self.current_path} -> {new_path}")
-                self.ftp.cwd(new_path)
+                self.enter_directory(new_path)
             
-            # 获取实际当前路径
-            self.current_path = self.ftp.pwd()
             self.log_message(f"目录切换成功，当前路径: {self.current_path}")
             
             # 清空搜索框
@@ -689,9 +691,20 @@ class EnhancedFTPGUI:
             try:
                 self.ftp.cwd(old_path)
                 self.current_path = self.ftp.pwd()
+                self.server_path = self.current_path
             except:
                 pass
     
+    def enter_directory(self, path):
+        """进入目录：已缓存时只在本地切换，否则发送CWD并取服务器返回的实际路径"""
+        path = ListingCache.normalize(path)
+        if path in self.listing_cache:
+            self.current_path = path
+            return
+        self.ftp.cwd(path)
+        self.current_path = self.ftp.pwd()
+        self.server_path = self.current_path
+    
     def go_up(self):
         """返回上级目录"""
         if not self.connected or not self.ftp:
@@ -705,8 +718,7 @@ class EnhancedFTPGUI:
             messagebox.showwarning("提示", "请先连接FTP服务器")
             return
         try:
-            self.ftp.cwd("/")
-            self.current_path = self.ftp.pwd()
+            self.enter_directory("/")
             self.log_message(f"返回根目录: {self.current_path}")
             self.refresh()
         except Exception as e:
@@ -723,78 +735,25 @@ class EnhancedFTPGUI:
         self.apply_filter_and_sort()
     
     def apply_filter_and_sort(self):
-        """应用搜索过滤和排序"""
-        if not hasattr(self, 'file_data'):
-            return
-        
-        # 获取搜索关键词
-        search_text = self.search_var.get().lower() if self.search_var else ""
+        """应用搜索过滤和排序 (只操作行号，大目录下输入搜索词也不卡顿)"""
+        search_text = self.search_var.get() if self.search_var else ""
         show_hidden = self.show_hidden_var.get() if self.show_hidden_var else False
-        
-        # 过滤文件
-        self.filtered_data = []
-        for file_info in self.file_data:
-            filename = file_info['name']
-            
-            # 隐藏文件过滤
-            if not show_hidden and filename.startswith('.'):
-                continue
-            
-            # 搜索过滤
-            if search_text and search_text not in filename.lower():
-                continue
-            
-            self.filtered_data.append(file_info)
-        
-        # 排序
         sort_key = self.sort_var.get() if self.sort_var else "name"
         sort_desc = self.sort_desc_var.get() if self.sort_desc_var else False
         
-        if sort_key == "name":
-            self.filtered_data.sort(key=lambda x: x['name'].lower(), reverse=sort_desc)
-        elif sort_key == "size":
-            self.filtered_data.sort(key=lambda x: x['size'], reverse=sort_desc)
-        elif sort_key == "date":
-            self.filtered_data.sort(key=lambda x: x['date'], reverse=sort_desc)
-        elif sort_key == "type":
-            # 目录优先，然后按文件名排序
-            self.filtered_data.sort(key=lambda x: (not x['is_dir'], x['name'].lower()), reverse=sort_desc)
-        
         # 目录始终在前面（除非按类型排序且降序）
-        if sort_key != "type" or not sort_desc:
-            dirs = [f for f in self.filtered_data if f['is_dir']]
-            files = [f for f in self.filtered_data if not f['is_dir']]
-            self.filtered_data = dirs + files
+        self.filtered_data = self.file_data.query(search_text, sort_key, sort_desc, show_hidden)
         
         # 更新显示
         self.update_tree_display()
     
     def update_tree_display(self):
-        """更新树形控件显示"""
-        # 清空现有列表
-        for item in self.file_tree.get_children():
-            self.file_tree.delete(item)
-        
-        # 添加过滤后的文件
-        for file_info in self.filtered_data:
-            filename = file_info['name']
-            size = file_info['size']
-            is_dir = file_info['is_dir']
-            date_str = file_info['date']
-            
-            size_str = self.format_size(size) if not is_dir else ""
-            type_str = "目录" if is_dir else "文件"
-            icon = "📁" if is_dir else "📄"
-            
-            self.file_tree.insert("", tk.END, 
-                                text=f"{icon} {filename}",
-                                values=(size_str, type_str, date_str),
-                                tags=("directory" if is_dir else "file",))
+        """更新树形控件显示 (只渲染可见区域的行)"""
+        table = self.file_data
+        self.file_view.set_row_count(len(self.filtered_data), reset=True)
         
         # 更新状态
-        total_files = len([f for f in self.filtered_data if not f['is_dir']])
-        total_dirs = len([f for f in self.filtered_data if f['is_dir']])
-        total_size = sum(f['size'] for f in self.filtered_data if not f['is_dir'])
+        total_dirs, total_files, total_size = table.totals(self.filtered_data)
         
         status_msg = f"目录: {total_dirs}, 文件: {total_files}"
         if total_size > 0:
@@ -808,29 +767,21 @@ class EnhancedFTPGUI:
     
     def download_selected(self):
         """下载选中文件"""
-        selection = self.file_tree.selection()
-        if not selection:
+        rows = self.file_view.selected_rows()
+        if not rows:
             messagebox.showwarning("提示", "请选择要下载的文件")
             return
         
-        for item in selection:
-            text = self.file_tree.item(item, "text")
-            values = self.file_tree.item(item, "values")
-            
-            if values and len(values) >= 2 and values[1] == "文件":
-                filename = text.split(" ", 1)[1] if " " in text else text.replace("📄 ", "")
-                self.add_download_task(filename)
+        table = self.file_data
+        for row in rows:
+            i = self.filtered_data[row]
+            if not table.is_dir[i]:
+                self.add_download_task(table.names[i])
     
     def download_all(self):
         """下载所有文件"""
-        files = []
-        for item in self.file_tree.get_children():
-            text = self.file_tree.item(item, "text")
-            values = self.file_tree.item(item, "values")
-            
-            if values and len(values) >= 2 and values[1] == "文件":
-                filename = text.split(" ", 1)[1] if " " in text else text.replace("📄 ", "")
-                files.append(filename)
+        table = self.file_data
+        files = [table.names[i] for i in self.filtered_data if not table.is_dir[i]]
         
         if not files:
             messagebox.showinfo("提示", "当前目录没有文件")
@@ -852,21 +803,56 @@ class EnhancedFTPGUI:
         local_path = Path(self.save_path_var.get()) / filename
         
         # 获取文件大小
-        size = 0
-        if self.ftp:
-            try:
-                size = self.ftp.size(remote_path) or 0
-                self.log_message(f"文件大小: {filename} = {size} 字节")
-            except Exception as e:
-                self.log_message(f"无法获取文件大小: {filename} - {e}")
-                size = 0
+        # 优先使用LIST已解析的大小，未知时交给后台批量查询
+        size = self.file_sizes.get(filename, 0)
         
         task = DownloadTask(remote_path, str(local_path), size)
+        if self.journal is not None:
+            task.journal_id = self.journal.add(self.journal_session(), remote_path, str(local_path), size)
         self.download_tasks.append(task)
+        if size == 0:
+            self.size_prefetcher.submit([task])
         
         self.status_var.set(f"已添加下载任务: {filename}")
         self.log_message(f"添加下载任务: {filename} -> {local_path}")
     
+    def on_rate_limit_change(self):
+        """总限速变化时的回调"""
+        try:
+            rate = max(0, int(float(self.rate_limit_var.get())))
+        except ValueError:
+            return
+        if rate * 1024 != self.bandwidth.global_bucket.rate:
+            self.bandwidth.set_global_rate(rate * 1024)
+            self.log_message(f"总限速: {rate} KB/s" if rate else "总限速: 不限速")
+    
+    def show_download_context_menu(self, event):
+        """下载列表右键菜单：设置所选任务的限速"""
+        row = self.download_view.row_at(event.y)
+        rows = self.download_view.selected_rows()
+        if row is not None and row not in rows:
+            rows = [row]
+        tasks = [self.download_tasks[r] for r in rows if r < len(self.download_tasks)]
+        if not tasks:
+            return
+        
+        menu = tk.Menu(self.root, tearoff=0)
+        menu.add_command(label="设置限速...", command=lambda: self.set_task_rate_limit(tasks))
+        menu.add_command(label="取消限速", command=lambda: self.set_task_rate_limit(tasks, 0))
+        menu.tk_popup(event.x_root, event.y_root)
+    
+    def set_task_rate_limit(self, tasks, rate=None):
+        """设置任务限速 (KB/s)，rate 为 None 时弹窗输入"""
+        if rate is None:
+            rate = simpledialog.askinteger("任务限速", "限速 (KB/s，0为不限速):",
+                                           initialvalue=tasks[0].bucket.rate // 1024, minvalue=0)
+            if rate is None:
+                return
+        for task in tasks:
+            task.bucket.set_rate(rate * 1024)
+        self.log_message(f"已设置 {len(tasks)} 个任务的限速: {rate} KB/s" if rate else
+                         f"已取消 {len(tasks)} 个任务的限速")
+    
     def browse_save_path(self):
         """浏览保存路径"""
         path = filedialog.askdirectory(initialdir=self.save_path_var.get())
@@ -903,6 +889,8 @@ class EnhancedFTPGUI:
             self.downloading = False
         
         self.download_tasks.clear()
+        if self.journal is not None:
+            self.journal.clear(self.journal_session())
         self.status_var.set("已清除下载列表")
         self.log_message("已清除下载列表")
     
@@ -921,10 +909,63 @@ class EnhancedFTPGUI:
                 task.status = "失败"
                 task.error_msg = str(e)
                 self.log_message(f"下载失败: {task.remote_path} - {e}")
+                self.journal_status(task)
         
         self.downloading = False
         self.root.after(0, lambda: self.status_var.set("下载完成"))
         self.log_message("所有下载任务完成")
+        self.log_message(self.pool.format_stats())
+    
+    def open_journal(self):
+        """打开传输日志，失败时不记录日志，下载功能不受影响"""
+        try:
+            return TransferJournal()
+        except Exception as e:
+            print(f"打开传输日志失败: {e}")
+            return None
+    
+    def journal_session(self):
+        return FTPConnectionPool.make_key(self.host_var.get(), int(self.port_var.get()),
+                                          self.username_var.get())
+    
+    def journal_status(self, task):
+        """把任务的最终状态写入传输日志"""
+        if self.journal is not None and task.journal_id is not None:
+            self.journal.set_status(task.journal_id, task.status, task.error_msg, task.downloaded)
+    
+    def restore_downloads(self):
+        """从传输日志恢复当前服务器上次未清除的下载任务 (大小已记录，无需重新查询)"""
+        if self.journal is None:
+            return
+        known = {task.journal_id for task in self.download_tasks}
+        restored = []
+        for entry in self.journal.entries(self.journal_session()):
+            if entry.id in known:
+                continue
+            task = DownloadTask(entry.remote_path, entry.local_path, entry.size)
+            task.journal_id = entry.id
+            task.error_msg = entry.error
+            if entry.status == "已完成":
+                task.status = "已完成"
+                task.downloaded = entry.size
+                task.progress = 100.0
+            else:
+                task.status = "失败" if entry.status == "失败" else "等待中"
+                task.downloaded = entry.offset
+                task.progress = entry.offset / entry.size * 100 if entry.size else 0.0
+            restored.append(task)
+        if restored:
+            self.download_tasks.extend(restored)
+            unsized = [task for task in restored if task.status == "等待中" and task.size <= 0]
+            if unsized:
+                self.size_prefetcher.submit(unsized)
+            self.log_message(f"已从传输日志恢复 {len(restored)} 个下载任务")
+    
+    def pool_connection(self):
+        """从连接池借出一个会话 (with 语句使用)"""
+        return self.pool.connection(self.host_var.get(), int(self.port_var.get()),
+                                    self.username_var.get(), self.password_var.get(),
+                                    self.passive_var.get())
     
     def download_file(self, task):
         """下载单个文件"""
@@ -933,71 +974,86 @@ class EnhancedFTPGUI:
         
         self.log_message(f"开始下载: {task.remote_path}")
         
+        # 后台查询还没轮到该任务时，在下载线程中补查大小
+        if task.size == 0:
+            with self.pool_connection() as ftp:
+                task.size = fetch_sizes(ftp, [task.remote_path])[task.remote_path] or 0
+            if self.journal is not None and task.journal_id is not None:
+                self.journal.set_size(task.journal_id, task.size)
+        
         # 创建本地目录
         local_path = Path(task.local_path)
         local_path.parent.mkdir(parents=True, exist_ok=True)
         
         # 检查本地文件
-        local_size = 0
-        if local_path.exists():
-            local_size = local_path.stat().st_size
-            if local_size == task.size and task.size > 0:
-                task.status = "已完成"
-                task.progress = 100.0
-                self.log_message(f"文件已存在且完整: {task.remote_path}")
-                return
-            elif local_size > task.size and task.size > 0:
-                local_path.unlink()
-                local_size = 0
-                self.log_message(f"本地文件大小异常，重新下载: {task.remote_path}")
+        # 未完成的数据在 .part 文件中，大小未知时不续传
+        local_size = resume_size(local_path, task.size) if task.size > 0 else 0
+        if local_size is None:
+            task.status = "已完成"
+            task.progress = 100.0
+            self.log_message(f"文件已存在且完整: {task.remote_path}")
+            task.downloaded = task.size
+            self.journal_status(task)
+            return
         
         task.downloaded = local_size
         
-        # 创建新的FTP连接用于下载
-        try:
-            ftp = ftplib.FTP()
-            ftp.connect(self.host_var.get(), int(self.port_var.get()), int(self.timeout_var.get()))
-            ftp.login(self.username_var.get(), self.password_var.get())
-            ftp.set_pasv(self.passive_var.get())
-            
+        entry = None
+        if self.journal is not None and task.journal_id is not None:
+            entry = self.journal.get(task.journal_id)
+        meter = SpeedMeter()
+        
+        def start(offset):
+            task.downloaded = offset
             # 设置断点续传
-            if local_size > 0:
-                ftp.sendcmd(f'REST {local_size}')
-                self.log_message(f"断点续传从 {local_size} 字节开始")
-            
-            # 开始下载
-            mode = 'ab' if local_size > 0 else 'wb'
+            if offset > 0:
+                self.log_message(f"断点续传从 {offset} 字节开始")
             
-            with open(local_path, mode) as f:
-                def callback(data):
-                    if not self.downloading:
-                        return
-                    
-                    f.write(data)
-                    task.downloaded += len(data)
-                    
-                    # 计算进度和速度
-                    if task.size > 0:
-                        task.progress = (task.downloaded / task.size) * 100
-                    
-                    elapsed = time.time() - task.start_time
-                    if elapsed > 0:
-                        task.speed = (task.downloaded - local_size) / elapsed
+            def progress(written):
+                task.downloaded = offset + written
                 
-                ftp.retrbinary(f'RETR {task.remote_path}', callback, 8192)
+                # 计算进度和速度 (按时间间隔采样)
+                if task.size > 0:
+                    task.progress = (task.downloaded / task.size) * 100
+                
+                # 速度取最近几次采样，反映限速后的实际速率
+                task.speed = meter.update(written)
+                if self.journal is not None and task.journal_id is not None:
+                    self.journal.checkpoint(task.journal_id, task.downloaded)
+                
+                # 暂停时停止接收，已写入的部分下次续传
+                return self.downloading
             
-            ftp.quit()
+            return progress
+        
+        # 从连接池借出已登录的会话用于下载
+        try:
+            with self.pool_connection() as ftp:
+                limiter = self.bandwidth.limiter(self.host_var.get(), task.bucket)
+                # 勾选"自适应块"时按实测吞吐量调整接收块大小
+                tuner = AdaptiveBlockSizer() if self.adaptive_var.get() else None
+                result = download_part(ftp, task.remote_path, local_path, task.size, local_size, start, entry,
+                                       self.integrity if self.verify_var.get() else None,
+                                       tuner=tuner, limiter=limiter, log=self.log_message)
+            if tuner is not None and tuner.history:
+                self.log_message(f"{task.remote_path} {tuner.summary()}")
             
             # 检查下载完整性
-            if task.size == 0 or task.downloaded >= task.size:
-                task.status = "已完成"
+            task.downloaded = result.downloaded
+            task.status = result.status
+            task.error_msg = result.error_msg
+            if result.status == "已完成":
                 task.progress = 100.0
-                self.log_message(f"下载完成: {task.remote_path}")
+                self.log_message(f"下载完成: {task.remote_path}" +
+                                 (f" (校验通过 {result.checksum.algorithm})" if result.checksum is not None else ""))
+            elif result.digest is not None:
+                task.progress = 0.0
+                self.log_message(f"校验失败: {task.remote_path} (期望 {result.checksum.value}，实际 {result.digest})")
             else:
-                task.status = "失败"
-                task.error_msg = "下载不完整"
                 self.log_message(f"下载不完整: {task.remote_path} ({task.downloaded}/{task.size})")
                 
+            self.journal_status(task)
+                
         except Exception as e:
             task.status = "失败"
             task.error_msg = str(e)
@@ -1010,24 +1066,22 @@ class EnhancedFTPGUI:
         self.root.after(1000, self.update_ui)
     
     def update_download_list(self):
-        """更新下载列表"""
-        # 清空现有列表
-        for item in self.download_tree.get_children():
-            self.download_tree.delete(item)
-        
-        # 添加任务
-        for task in self.download_tasks:
-            filename = Path(task.remote_path).name
-            progress_str = f"{task.progress:.1f}%"
-            speed_str = self.format_size(task.speed) + "/s" if task.speed > 0 else ""
-            
-            self.download_tree.insert("", tk.END, 
-                                    text=filename,
-                                    values=(progress_str, speed_str, task.status))
+        """更新下载列表 (只刷新可见区域中内容有变化的行)"""
+        self.download_view.set_row_count(len(self.download_tasks))
+    
+    def download_row(self, row):
+        """下载列表第 row 行的显示内容"""
+        task = self.download_tasks[row]
+        progress_str = f"{task.progress:.1f}%"
+        speed_str = self.format_size(task.speed) + "/s" if task.speed > 0 else ""
+        return (Path(task.remote_path).name, (progress_str, speed_str, task.status), ())
     
     def update_downloads(self):
         """定时更新下载状态"""
         self.update_download_list()
+        # 提交传输日志中尚未提交的进度
+        if self.journal is not None:
+            self.journal.commit()
         self.root.after(1000, self.update_downloads)
     
     def format_size(self, size):
@@ -1057,6 +1111,9 @@ class EnhancedFTPGUI:
                 self.ftp.quit()
             except:
                 pass
+        self.pool.clear()
+        if self.journal is not None:
+            self.journal.commit()
         self.root.destroy()
 
 def main():
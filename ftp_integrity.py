@@ -0,0 +1,470 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+完整性校验
+下载时在接收通道中边收边算哈希，下载完成后不需要再把文件读一遍；
+期望值优先用服务器端命令 (HASH，或 XSHA256/XSHA1/XMD5/XCRC，以 FEAT 中列出的为准)，
+服务器不支持时读取同目录下的 .sha256/.md5 校验文件；
+断点续传时用 mmap 对本地已有的前缀计算一次哈希，之后接着对新收到的数据计算。
+
+未完成的文件另有分块校验记录 (<文件名>.blk，每 1MB 一个 CRC32)，续传前核对末尾的若干块
+(或全部块)，只重新下载损坏的范围，不再直接相信本地文件长度
+"""
+
+import io
+import os
+import zlib
+import mmap
+import struct
+import ftplib
+import hashlib
+import threading
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+from ftp_journal import prepare_resume
+from ftp_listing import feature_params
+from ftp_transfer import retrieve_range
+
+MMAP_WINDOW = 64 * 1024 * 1024   # mmap 每次映射的长度，分配粒度的整数倍
+SIDECAR_MAX_SIZE = 64 * 1024      # 校验文件只保留开头这么多字节
+
+# 算法优先级，前面的更可靠
+ALGORITHMS = ('sha256', 'sha1', 'md5', 'crc32')
+
+# HASH 命令 (draft-bryan-ftpext-hash) 的算法名
+HASH_NAMES = {'SHA-256': 'sha256', 'SHA-1': 'sha1', 'MD5': 'md5', 'CRC32': 'crc32'}
+
+# 各服务器自定义的单一算法命令
+X_COMMANDS = {'sha256': 'XSHA256', 'sha1': 'XSHA1', 'md5': 'XMD5', 'crc32': 'XCRC'}
+
+# 校验文件后缀
+SIDECARS = (('.sha256', 'sha256'), ('.md5', 'md5'))
+
+BLOCK_SIZE = 1024 * 1024          # 分块校验的块大小，分配粒度的整数倍
+TAIL_CHECK_BLOCKS = 64            # 续传前默认核对的末尾块数 (断电时可能还在页缓存中的部分)
+BLOCK_SUFFIX = '.blk'
+_BLOCK_HEADER = struct.Struct('<8sIQ')  # 标识, 块大小, 远程文件大小
+_BLOCK_MAGIC = b'FTPBLK1\n'
+
+
+@dataclass
+class Checksum:
+    """期望的校验值，source 为来源 (服务器命令或校验文件名)"""
+    algorithm: str
+    value: str
+    source: str
+
+
+class _CRC32:
+    """与 hashlib 对象接口一致的 CRC32"""
+
+    def __init__(self):
+        self._value = 0
+
+    def update(self, data):
+        self._value = zlib.crc32(data, self._value)
+
+    def hexdigest(self) -> str:
+        return f"{self._value & 0xFFFFFFFF:08x}"
+
+
+def new_hash(algorithm: str):
+    if algorithm == 'crc32':
+        return _CRC32()
+    return hashlib.new(algorithm)
+
+
+class StreamHash:
+    """下载过程中增量计算的哈希
+
+    接收通道每写入一块数据就调用 update；length 记录已经计算过的字节数，
+    续传时 resume 对齐到续传位置，已经算过的部分直接沿用
+    """
+
+    def __init__(self, algorithm: str):
+        self.algorithm = algorithm
+        self.length = 0
+        self._hash = new_hash(algorithm)
+
+    def update(self, data):
+        self._hash.update(data)
+        self.length += len(data)
+
+    def update_file(self, path, length: Optional[int] = None):
+        """用 mmap 对文件的前 length 字节计算哈希 (默认整个文件)"""
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            length = size if length is None else min(length, size)
+            pos = 0
+            while pos < length:
+                window = min(MMAP_WINDOW, length - pos)
+                with mmap.mmap(f.fileno(), window, access=mmap.ACCESS_READ, offset=pos) as m:
+                    self.update(m)
+                pos += window
+
+    def resume(self, path, offset: int) -> 'StreamHash':
+        """续传前对齐到 offset：长度一致时继续使用，否则重新计算本地文件的前缀"""
+        if offset != self.length:
+            self._hash = new_hash(self.algorithm)
+            self.length = 0
+            if offset > 0:
+                self.update_file(path, offset)
+        return self
+
+    def hexdigest(self) -> str:
+        return self._hash.hexdigest()
+
+    def matches(self, checksum: Checksum) -> bool:
+        actual = self.hexdigest()
+        if self.algorithm == 'crc32':
+            # 部分服务器省略CRC32的前导零
+            try:
+                return int(actual, 16) == int(checksum.value, 16)
+            except ValueError:
+                return False
+        return actual == checksum.value.lower()
+
+
+class IntegrityChecker:
+    """查询文件的期望校验值
+
+    每台服务器只发送一次 FEAT，结果按 (主机, 端口) 缓存；
+    sidecar 为 False 时不尝试下载校验文件 (大量小文件时可省去每个文件的额外往返)
+    """
+
+    def __init__(self, sidecar: bool = True):
+        self.sidecar = sidecar
+        self._features: Dict[Tuple[str, int], Tuple[Optional[str], Tuple[str, ...]]] = {}
+        self._lock = threading.Lock()
+
+    def expected(self, ftp, remote_path: str) -> Optional[Checksum]:
+        """服务器端校验值，其次是校验文件；都没有时返回 None"""
+        hash_algorithm, x_algorithms = self._server_support(ftp)
+        if hash_algorithm:
+            checksum = _query(ftp, f'HASH {remote_path}', _parse_hash_reply, hash_algorithm)
+            if checksum:
+                return checksum
+        for algorithm in x_algorithms:
+            checksum = _query(ftp, f'{X_COMMANDS[algorithm]} {remote_path}', _parse_x_reply, algorithm)
+            if checksum:
+                return checksum
+        if self.sidecar:
+            return read_sidecar(ftp, remote_path)
+        return None
+
+    async def expected_async(self, client, remote_path: str) -> Optional[Checksum]:
+        """expected 的异步版本，client 为 ftp_async.AsyncFTP"""
+        key = (client.host, client.port)
+        with self._lock:
+            support = self._features.get(key)
+        if support is None:
+            # 使用会话缓存的 FEAT，列目录时已经查询过就不再发送
+            support = _server_features(await client.features())
+            if support[0]:
+                try:
+                    await client.sendcmd(_hash_option(support[0]))
+                except ftplib.all_errors:
+                    support = (None, support[1])
+            with self._lock:
+                self._features[key] = support
+
+        hash_algorithm, x_algorithms = support
+        commands = [(f'HASH {remote_path}', _parse_hash_reply, hash_algorithm)] if hash_algorithm else []
+        commands += [(f'{X_COMMANDS[a]} {remote_path}', _parse_x_reply, a) for a in x_algorithms]
+        for command, parse, algorithm in commands:
+            try:
+                checksum = parse(await client.sendcmd(command), algorithm)
+            except ftplib.all_errors:
+                continue
+            if checksum:
+                return checksum
+        if self.sidecar:
+            for suffix, algorithm in SIDECARS:
+                try:
+                    data = await client.retrbytes(f'RETR {remote_path}{suffix}', SIDECAR_MAX_SIZE)
+                except ftplib.all_errors:
+                    continue
+                checksum = _parse_sidecar(data, algorithm, os.path.basename(remote_path) + suffix)
+                if checksum:
+                    return checksum
+        return None
+
+    def _server_support(self, ftp):
+        """(HASH 命令使用的算法, 可用的 X 命令算法)"""
+        key = (getattr(ftp, 'host', ''), getattr(ftp, 'port', 0))
+        with self._lock:
+            support = self._features.get(key)
+        if support is None:
+            try:
+                support = _server_features(feature_params(ftp.sendcmd('FEAT')))
+            except ftplib.all_errors:
+                support = (None, ())
+            if support[0]:
+                try:
+                    ftp.sendcmd(_hash_option(support[0]))
+                except ftplib.all_errors:
+                    support = (None, support[1])
+            with self._lock:
+                self._features[key] = support
+        return support
+
+
+def _server_features(features: Dict[str, str]):
+    """由 FEAT 声明的命令 (ftp_listing.feature_params 的结果) 得到 (HASH 命令使用的算法, 可用的 X 命令算法)"""
+    hash_names = [n.rstrip('*').upper() for n in features.get('HASH', '').split(';')]
+    supported = [HASH_NAMES[n] for n in hash_names if n in HASH_NAMES]
+    hash_algorithm = next((a for a in ALGORITHMS if a in supported), None)
+    x_algorithms = tuple(a for a in ALGORITHMS if X_COMMANDS[a] in features)
+    return hash_algorithm, x_algorithms
+
+
+def _hash_option(algorithm: str) -> str:
+    """选择 HASH 命令使用的算法"""
+    name = next(n for n, a in HASH_NAMES.items() if a == algorithm)
+    return f'OPTS HASH {name}'
+
+
+def _query(ftp, command, parse, algorithm) -> Optional[Checksum]:
+    try:
+        return parse(ftp.sendcmd(command), algorithm)
+    except ftplib.all_errors:
+        return None
+
+
+def _parse_hash_reply(reply: str, algorithm: str) -> Optional[Checksum]:
+    """HASH 的回复格式: 213 <算法> <起点>-<终点> <十六进制值> <文件名>"""
+    parts = reply.split(None, 4)
+    if len(parts) < 4 or HASH_NAMES.get(parts[1].upper()) != algorithm:
+        return None
+    return Checksum(algorithm, parts[3].lower(), 'HASH')
+
+
+def _parse_x_reply(reply: str, algorithm: str) -> Optional[Checksum]:
+    """XMD5 等命令的回复一般为 250/213 <十六进制值>，个别服务器在值后面附带文件名"""
+    for token in reply[4:].split():
+        if _is_hex(token):
+            return Checksum(algorithm, token.lower(), X_COMMANDS[algorithm])
+    return None
+
+
+def read_sidecar(ftp, remote_path: str) -> Optional[Checksum]:
+    """读取 remote_path.sha256 / remote_path.md5 (sha256sum/md5sum 的输出格式)"""
+    for suffix, algorithm in SIDECARS:
+        buf = io.BytesIO()
+
+        def collect(data):
+            # 中途断开数据连接会让控制连接的应答错位，所以读完但只保留开头部分
+            if buf.tell() < SIDECAR_MAX_SIZE:
+                buf.write(data)
+
+        try:
+            ftp.retrbinary(f'RETR {remote_path}{suffix}', collect)
+        except ftplib.all_errors:
+            continue
+        checksum = _parse_sidecar(buf.getvalue(), algorithm, os.path.basename(remote_path) + suffix)
+        if checksum:
+            return checksum
+    return None
+
+
+def _parse_sidecar(data: bytes, algorithm: str, name: str) -> Optional[Checksum]:
+    parts = data.decode('utf-8', 'replace').split()
+    if parts and _is_hex(parts[0]) and len(parts[0]) == new_hash(algorithm).digest_size * 2:
+        return Checksum(algorithm, parts[0].lower(), name)
+    return None
+
+
+def _is_hex(text: str) -> bool:
+    try:
+        int(text, 16)
+        return True
+    except ValueError:
+        return False
+
+
+class HashGroup:
+    """把同一份数据同时交给多个哈希"""
+
+    def __init__(self, *hashers):
+        self.hashers = hashers
+
+    def update(self, data):
+        for hasher in self.hashers:
+            hasher.update(data)
+
+
+def combine(*hashers):
+    """合并可选的哈希对象，供接收通道的 hasher 参数使用；全部为 None 时返回 None"""
+    hashers = [h for h in hashers if h is not None]
+    if not hashers:
+        return None
+    return hashers[0] if len(hashers) == 1 else HashGroup(*hashers)
+
+
+def _crc_range(path, start: int, length: int) -> int:
+    with open(path, 'rb') as f, \
+            mmap.mmap(f.fileno(), length, access=mmap.ACCESS_READ, offset=start) as m:
+        return zlib.crc32(m)
+
+
+class BlockLog:
+    """未完成文件的分块校验记录
+
+    文件头之后每个完整的块一个 CRC32 (4字节)，接收通道写完一块就追加一条；
+    只记录完整的块，末尾不足一块的数据续传时重新下载。下载完成后删除
+    """
+
+    def __init__(self, local_path, remote_size: int, block_size: int = BLOCK_SIZE):
+        self.local_path = Path(local_path)
+        self.path = self.local_path.with_name(self.local_path.name + BLOCK_SUFFIX)
+        self.remote_size = remote_size
+        self.block_size = block_size
+        self._file = None
+        self._crc = 0
+        self._filled = 0
+
+    def load(self) -> Optional[List[int]]:
+        """已记录的块校验值；记录不存在或属于另一个版本的远程文件时返回 None"""
+        try:
+            data = self.path.read_bytes()
+        except OSError:
+            return None
+        if len(data) < _BLOCK_HEADER.size:
+            return None
+        magic, block_size, remote_size = _BLOCK_HEADER.unpack_from(data)
+        if magic != _BLOCK_MAGIC or block_size != self.block_size or remote_size != self.remote_size:
+            return None
+        count = (len(data) - _BLOCK_HEADER.size) // 4
+        return list(struct.unpack_from(f'<{count}I', data, _BLOCK_HEADER.size))
+
+    def start(self, crcs: List[int]):
+        """以 crcs 为已记录的块重写记录文件，之后从第 len(crcs) 块开始追加"""
+        self.close()
+        with open(self.path, 'wb') as f:
+            f.write(_BLOCK_HEADER.pack(_BLOCK_MAGIC, self.block_size, self.remote_size))
+            f.write(struct.pack(f'<{len(crcs)}I', *crcs))
+        self._file = open(self.path, 'ab', buffering=0)
+        self._crc = 0
+        self._filled = 0
+
+    def update(self, data):
+        """计入接收通道写入文件的数据 (起点必须在块边界上)"""
+        view = memoryview(data)
+        while view:
+            take = min(len(view), self.block_size - self._filled)
+            self._crc = zlib.crc32(view[:take], self._crc)
+            self._filled += take
+            view = view[take:]
+            if self._filled == self.block_size:
+                if self._file is not None:
+                    self._file.write(struct.pack('<I', self._crc))
+                self._crc = 0
+                self._filled = 0
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def remove(self):
+        """下载完成后删除记录"""
+        self.close()
+        try:
+            self.path.unlink()
+        except OSError:
+            pass
+
+    def check(self, crcs: List[int], count: int, full: bool = False) -> List[int]:
+        """核对前 count 块中末尾的 TAIL_CHECK_BLOCKS 块 (full 为 True 时核对全部)，返回损坏的块号"""
+        first = 0 if full else max(0, count - TAIL_CHECK_BLOCKS)
+        damaged = []
+        for index in range(first, count):
+            if _crc_range(self.local_path, index * self.block_size, self.block_size) != crcs[index]:
+                damaged.append(index)
+        return damaged
+
+
+class BlockResume:
+    """续传前的分块核对 (只读写本地文件，不访问网络)
+
+    - 末尾连续损坏的块和不足一块的尾部截掉，从第一个损坏的块重新下载；
+    - 中间损坏的块列入 repairs [(起点, 长度)]，由调用方用 REST 只重新下载这些范围；
+    - 没有记录 (旧版本留下的文件) 时按原来的方式相信本地数据，并为已有的完整块补建记录；
+    - 记录属于另一个版本的远程文件时从头下载。
+    不超过一块的文件不建记录，未完成时从头下载。范围下载完成后调用 finish()
+    """
+
+    def __init__(self, local_path, remote_size: int, offset: int, full: bool = False,
+                 log: Optional[Callable[[str], None]] = None):
+        self.local_path = local_path
+        self.blocks: Optional[BlockLog] = None
+        self.repairs: List[Tuple[int, int]] = []
+        self._crcs: List[int] = []
+        self._damaged: List[int] = []
+        if remote_size <= BLOCK_SIZE:
+            prepare_resume(local_path, 0)
+            self.offset = 0
+            return
+
+        blocks = self.blocks = BlockLog(local_path, remote_size)
+        crcs = blocks.load() if offset else None
+        if offset and crcs is None:
+            if blocks.path.exists():
+                # 记录与远程文件大小不一致，本地数据属于旧版本
+                offset = 0
+            else:
+                count = offset // BLOCK_SIZE
+                crcs = [_crc_range(local_path, i * BLOCK_SIZE, BLOCK_SIZE) for i in range(count)]
+        crcs = crcs or []
+
+        count = min(len(crcs), offset // BLOCK_SIZE)
+        damaged = blocks.check(crcs, count, full) if count else []
+        # 末尾连续损坏的块直接截掉
+        while damaged and damaged[-1] == count - 1:
+            damaged.pop()
+            count -= 1
+        if count * BLOCK_SIZE != offset and log is not None:
+            log(f"分块校验: 从 {count * BLOCK_SIZE} 字节续传 (本地 {offset} 字节)")
+        self.offset = count * BLOCK_SIZE
+        prepare_resume(local_path, self.offset)
+
+        if damaged and log is not None:
+            log(f"分块校验: {len(damaged)} 个块损坏，重新下载这些范围")
+        self._crcs = crcs[:count]
+        self._damaged = damaged
+        self.repairs = [(first * BLOCK_SIZE, (last - first + 1) * BLOCK_SIZE) for first, last in _runs(damaged)]
+
+    def finish(self) -> Tuple[int, Optional[BlockLog]]:
+        """损坏的范围重新下载后更新记录，返回 (续传偏移, 分块记录)"""
+        if self.blocks is None:
+            return 0, None
+        for index in self._damaged:
+            self._crcs[index] = _crc_range(self.local_path, index * BLOCK_SIZE, BLOCK_SIZE)
+        self.blocks.start(self._crcs)
+        return self.offset, self.blocks
+
+
+def resume_blocks(ftp, remote_path: str, local_path, remote_size: int, offset: int,
+                  full: bool = False, limiter=None,
+                  log: Optional[Callable[[str], None]] = None) -> Tuple[int, Optional[BlockLog]]:
+    """核对续传位置并修复中间损坏的块，返回 (续传偏移, 分块记录)；分块记录作为 hasher 传给接收通道"""
+    plan = BlockResume(local_path, remote_size, offset, full, log)
+    if plan.repairs:
+        with open(local_path, 'r+b', buffering=0) as f:
+            for start, length in plan.repairs:
+                f.seek(start)
+                retrieve_range(ftp, remote_path, f, start, length, limiter=limiter)
+    return plan.finish()
+
+
+def _runs(indexes: List[int]) -> List[Tuple[int, int]]:
+    """把有序的块号合并成连续的区间 [(首, 尾)]，相邻的损坏块一次下载"""
+    runs = []
+    for index in indexes:
+        if runs and runs[-1][1] == index - 1:
+            runs[-1] = (runs[-1][0], index)
+        else:
+            runs.append((index, index))
+    return runs
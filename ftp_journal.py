@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+传输日志
+用 SQLite (WAL 模式) 记录下载任务的状态、已落盘的字节偏移和远程文件的大小/修改时间。
+程序崩溃或重启后直接从日志重建任务队列，无需重新查询每个文件的大小；
+续传位置取日志记录的偏移与本地文件长度中较小的一个，远程文件大小变化时从头下载
+"""
+
+import os
+import time
+import ftplib
+import sqlite3
+import threading
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable, List, Optional, Tuple
+
+JOURNAL_FILE = "transfer_journal.db"
+COMMIT_INTERVAL = 1.0  # 进度检查点的最长提交间隔 (秒)
+
+# (主机, 端口, 用户名)，与连接池的键一致
+Session = Tuple[str, int, str]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY,
+    host TEXT NOT NULL,
+    port INTEGER NOT NULL,
+    username TEXT NOT NULL,
+    remote_path TEXT NOT NULL,
+    local_path TEXT NOT NULL,
+    size INTEGER NOT NULL DEFAULT 0,
+    mtime REAL,
+    offset INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL,
+    error TEXT NOT NULL DEFAULT '',
+    updated REAL NOT NULL,
+    UNIQUE (host, port, username, remote_path, local_path)
+)
+"""
+
+
+@dataclass
+class JournalEntry:
+    """日志中的一个任务"""
+    id: int
+    remote_path: str
+    local_path: str
+    size: int
+    mtime: Optional[float]
+    offset: int
+    status: str
+    error: str
+
+
+class TransferJournal:
+    """线程安全的传输日志
+
+    进度检查点 (checkpoint) 只在内存中的事务里更新，最多每 commit_interval 秒提交一次；
+    崩溃时最多丢失这段时间的进度，续传时从更早的偏移开始，不会超过已落盘的数据
+    """
+
+    def __init__(self, path=JOURNAL_FILE, commit_interval: float = COMMIT_INTERVAL):
+        self.path = Path(path)
+        self.commit_interval = commit_interval
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(SCHEMA)
+        self._in_transaction = False
+        self._last_commit = time.monotonic()
+
+    # ---------- 写入 ----------
+
+    def add(self, session: Session, remote_path: str, local_path: str,
+            size: int = 0, mtime: Optional[float] = None) -> int:
+        """记录一个任务并返回其编号；同一任务再次加入时保留已记录的偏移"""
+        host, port, username = session
+        with self._lock:
+            self._begin()
+            now = time.time()
+            cursor = self._db.execute(
+                "INSERT OR IGNORE INTO tasks (host, port, username, remote_path, local_path,"
+                " size, mtime, status, updated) VALUES (?, ?, ?, ?, ?, ?, ?, '等待中', ?)",
+                (host, port, username, remote_path, local_path, size, mtime, now))
+            if cursor.rowcount:
+                self._maybe_commit()
+                return cursor.lastrowid
+            row = self._db.execute(
+                "SELECT id FROM tasks WHERE host=? AND port=? AND username=?"
+                " AND remote_path=? AND local_path=?",
+                (host, port, username, remote_path, local_path)).fetchone()
+            self._db.execute(
+                "UPDATE tasks SET status='等待中', error='', updated=?,"
+                " size=CASE WHEN ? > 0 THEN ? ELSE size END,"
+                " mtime=COALESCE(?, mtime) WHERE id=?",
+                (now, size, size, mtime, row[0]))
+            self._maybe_commit()
+            return row[0]
+
+    def set_size(self, task_id: int, size: int, mtime: Optional[float] = None):
+        with self._lock:
+            self._begin()
+            self._db.execute("UPDATE tasks SET size=?, mtime=COALESCE(?, mtime), updated=? WHERE id=?",
+                             (size, mtime, time.time(), task_id))
+            self._maybe_commit()
+
+    def checkpoint(self, task_id: int, offset: int):
+        """记录已写入文件的字节偏移 (调用前数据必须已经写入文件)"""
+        with self._lock:
+            self._begin()
+            self._db.execute("UPDATE tasks SET offset=?, updated=? WHERE id=?",
+                             (offset, time.time(), task_id))
+            self._maybe_commit()
+
+    def set_status(self, task_id: int, status: str, error: str = '', offset: Optional[int] = None):
+        """更新任务状态并立即提交"""
+        with self._lock:
+            self._begin()
+            if offset is None:
+                self._db.execute("UPDATE tasks SET status=?, error=?, updated=? WHERE id=?",
+                                 (status, error, time.time(), task_id))
+            else:
+                self._db.execute("UPDATE tasks SET status=?, error=?, offset=?, updated=? WHERE id=?",
+                                 (status, error, offset, time.time(), task_id))
+            self._commit()
+
+    def remove(self, task_ids: Iterable[int]):
+        with self._lock:
+            self._begin()
+            self._db.executemany("DELETE FROM tasks WHERE id=?", ((i,) for i in task_ids))
+            self._commit()
+
+    def clear(self, session: Session, completed_only: bool = False):
+        """删除一个会话的任务；completed_only 为 True 时只删除已完成的任务"""
+        sql = "DELETE FROM tasks WHERE host=? AND port=? AND username=?"
+        if completed_only:
+            sql += " AND status='已完成'"
+        with self._lock:
+            self._begin()
+            self._db.execute(sql, tuple(session))
+            self._commit()
+
+    def commit(self):
+        """提交尚未提交的检查点 (界面定时器或程序退出时调用)"""
+        with self._lock:
+            self._commit()
+
+    def close(self):
+        with self._lock:
+            self._commit()
+            self._db.close()
+
+    # ---------- 读取 ----------
+
+    def entries(self, session: Session) -> List[JournalEntry]:
+        """一个会话的全部任务，按加入顺序"""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, remote_path, local_path, size, mtime, offset, status, error"
+                " FROM tasks WHERE host=? AND port=? AND username=? ORDER BY id",
+                tuple(session)).fetchall()
+        return [JournalEntry(*row) for row in rows]
+
+    def get(self, task_id: int) -> Optional[JournalEntry]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT id, remote_path, local_path, size, mtime, offset, status, error"
+                " FROM tasks WHERE id=?", (task_id,)).fetchone()
+        return JournalEntry(*row) if row else None
+
+    def resume_point(self, task_id: int, ftp, local_path) -> int:
+        """核对续传位置并把本地文件截断到该位置，返回应从哪个偏移继续下载
+
+        远程文件大小与日志记录不一致时从头下载
+        """
+        entry = self.get(task_id)
+        if entry is None:
+            return _local_size(local_path)
+        return resume_from(entry, ftp, local_path)
+
+    async def resume_point_async(self, task_id: int, client, local_path) -> int:
+        """resume_point 的异步版本，client 为 ftp_async.AsyncFTP"""
+        entry = self.get(task_id)
+        if entry is None:
+            return _local_size(local_path)
+        offset = resume_offset(local_path, entry.offset, entry.size)
+        if offset and entry.size > 0:
+            try:
+                if await client.size(entry.remote_path) != entry.size:
+                    offset = 0
+            except ftplib.all_errors:
+                pass
+        prepare_resume(local_path, offset)
+        return offset
+
+    # ---------- 事务 ----------
+
+    def _begin(self):
+        if not self._in_transaction:
+            self._db.execute("BEGIN")
+            self._in_transaction = True
+
+    def _maybe_commit(self):
+        if time.monotonic() - self._last_commit >= self.commit_interval:
+            self._commit()
+
+    def _commit(self):
+        if self._in_transaction:
+            self._db.execute("COMMIT")
+            self._in_transaction = False
+        self._last_commit = time.monotonic()
+
+
+def resume_from(entry: JournalEntry, ftp, local_path) -> int:
+    """按日志记录核对续传位置并截断本地文件 (多进程模式下工作进程拿到记录后直接调用)"""
+    offset = resume_offset(local_path, entry.offset, entry.size)
+    if offset and remote_changed(ftp, entry):
+        offset = 0
+    prepare_resume(local_path, offset)
+    return offset
+
+
+def resume_offset(local_path, journaled: int, size: int) -> int:
+    """核对后的续传位置：不超过日志记录的偏移、本地文件长度和远程文件大小
+
+    本地文件比记录的偏移长时，多出的部分可能是崩溃前没有落盘的数据，截掉重新下载
+    """
+    try:
+        local_size = os.path.getsize(local_path)
+    except OSError:
+        return 0
+    offset = min(journaled, local_size)
+    if size > 0 and offset > size:
+        return 0
+    return offset
+
+
+def _local_size(local_path) -> int:
+    try:
+        return os.path.getsize(local_path)
+    except OSError:
+        return 0
+
+
+def prepare_resume(local_path, offset: int):
+    """把本地文件截断到续传位置，之后以追加方式写入"""
+    try:
+        if os.path.getsize(local_path) > offset:
+            os.truncate(local_path, offset)
+    except OSError:
+        pass
+
+
+def remote_changed(ftp, entry: JournalEntry) -> bool:
+    """续传前用SIZE确认远程文件没有被替换
+
+    列表中的修改时间精度和时区因服务器而异 (LIST只精确到分钟甚至天)，
+    和MDTM比较容易误判，所以这里只核对大小；修改时间记录在日志中供同步和排查使用
+    """
+    if entry.size <= 0:
+        return False
+    try:
+        return ftp.size(entry.remote_path) != entry.size
+    except ftplib.all_errors:
+        # 服务器不支持SIZE时无法确认，按未变化处理
+        return False
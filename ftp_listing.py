@@ -0,0 +1,447 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+FTP目录列表引擎
+每个会话只查询一次FEAT，服务器支持时优先使用MLSD (精确的大小、类型和修改时间)，
+不支持时才回退到LIST文本解析，最后回退到NLST
+"""
+
+import re
+import time
+import ftplib
+import calendar
+import posixpath
+import threading
+from array import array
+from collections import OrderedDict
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+MONTHS = {m: i for i, m in enumerate(
+    ['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec'], 1)}
+
+# Unix风格: drwxr-xr-x 2 user group 4096 Jan  1 12:00 name with  spaces
+UNIX_LIST_RE = re.compile(
+    r'^(?P<perm>[\-dlbcps][\w\-]{9}\S*)\s+\d+\s+\S+\s+\S+\s+(?P<size>\d+)\s+'
+    r'(?P<mon>[A-Za-z]{3})\s+(?P<day>\d{1,2})\s+(?P<time>\d{1,2}:\d{2}|\d{4})\s(?P<name>.+)$')
+
+# 缺少组字段的Unix风格: -rw-r--r-- 1 user 1234 Jan  1 12:00 name
+UNIX_NOGROUP_RE = re.compile(
+    r'^(?P<perm>[\-dlbcps][\w\-]{9}\S*)\s+\d+\s+\S+\s+(?P<size>\d+)\s+'
+    r'(?P<mon>[A-Za-z]{3})\s+(?P<day>\d{1,2})\s+(?P<time>\d{1,2}:\d{2}|\d{4})\s(?P<name>.+)$')
+
+# DOS/IIS风格: 01-01-20  12:00PM       <DIR>          name
+DOS_LIST_RE = re.compile(
+    r'^(?P<date>\d{2}-\d{2}-\d{2,4})\s+(?P<time>\d{1,2}:\d{2}[AaPp][Mm])\s+'
+    r'(?P<size><DIR>|\d+)\s+(?P<name>.+)$')
+
+
+class RemoteEntry(NamedTuple):
+    """目录项：MLSD和LIST解析结果统一成的紧凑记录"""
+    name: str
+    size: int
+    is_dir: bool
+    mtime: Optional[float]  # UTC时间戳，未知时为None
+    permissions: str = ''
+
+    @property
+    def modified(self) -> str:
+        """修改时间的显示文本"""
+        return format_mtime(self.mtime)
+
+
+def format_mtime(mtime: Optional[float]) -> str:
+    """将时间戳格式化为本地时间文本"""
+    if mtime is None:
+        return "未知"
+    return time.strftime('%Y-%m-%d %H:%M', time.localtime(mtime))
+
+
+def parse_mlsd_line(line: str) -> Optional[RemoteEntry]:
+    """解析一行MLSD输出: fact=value;fact=value; name"""
+    facts_str, sep, name = line.partition(' ')
+    if not sep or not name:
+        return None
+
+    facts = {}
+    for fact in facts_str.split(';'):
+        key, eq, value = fact.partition('=')
+        if eq:
+            facts[key.lower()] = value
+
+    entry_type = facts.get('type', '').lower()
+    if entry_type in ('cdir', 'pdir') or name in ('.', '..'):
+        return None
+    is_dir = entry_type == 'dir'
+
+    try:
+        size = int(facts.get('size', facts.get('sizd', 0))) if not is_dir else 0
+    except ValueError:
+        size = 0
+
+    return RemoteEntry(
+        name=name,
+        size=size,
+        is_dir=is_dir,
+        mtime=parse_mlsd_time(facts.get('modify')),
+        permissions=facts.get('unix.mode', facts.get('perm', '')),
+    )
+
+
+def parse_mlsd_time(value: Optional[str]) -> Optional[float]:
+    """解析MLSD的modify事实 (YYYYMMDDHHMMSS[.sss]，UTC)"""
+    if not value or len(value) < 14:
+        return None
+    try:
+        parsed = time.strptime(value[:14], '%Y%m%d%H%M%S')
+    except ValueError:
+        return None
+    frac = 0.0
+    if len(value) > 15 and value[14] == '.':
+        try:
+            frac = float('0' + value[14:])
+        except ValueError:
+            pass
+    return calendar.timegm(parsed) + frac
+
+
+def parse_list_line(line: str, now: Optional[float] = None) -> Optional[RemoteEntry]:
+    """解析一行LIST输出 (Unix或DOS风格)，保留文件名中的连续空格"""
+    line = line.rstrip('\r\n')
+    match = UNIX_LIST_RE.match(line) or UNIX_NOGROUP_RE.match(line)
+    if match:
+        perm = match.group('perm')
+        is_dir = perm.startswith('d')
+        name = match.group('name')
+        if perm.startswith('l') and ' -> ' in name:
+            name = name.split(' -> ', 1)[0]
+        if name in ('.', '..'):
+            return None
+        return RemoteEntry(
+            name=name,
+            size=int(match.group('size')) if not is_dir else 0,
+            is_dir=is_dir,
+            mtime=_unix_list_time(match.group('mon'), match.group('day'), match.group('time'), now),
+            permissions=perm,
+        )
+
+    match = DOS_LIST_RE.match(line)
+    if match:
+        is_dir = match.group('size') == '<DIR>'
+        return RemoteEntry(
+            name=match.group('name'),
+            size=0 if is_dir else int(match.group('size')),
+            is_dir=is_dir,
+            mtime=_dos_list_time(match.group('date'), match.group('time')),
+            permissions='',
+        )
+    return None
+
+
+def _unix_list_time(mon, day, time_or_year, now=None):
+    """LIST中的日期没有年份时取最近的过去时间；结果按UTC处理"""
+    month = MONTHS.get(mon.lower())
+    if not month:
+        return None
+    try:
+        if ':' in time_or_year:
+            hour, minute = (int(x) for x in time_or_year.split(':'))
+            now = time.time() if now is None else now
+            year = time.gmtime(now).tm_year
+            ts = calendar.timegm((year, month, int(day), hour, minute, 0))
+            # 超过现在一天以上说明是去年的文件
+            if ts > now + 86400:
+                ts = calendar.timegm((year - 1, month, int(day), hour, minute, 0))
+            return float(ts)
+        return float(calendar.timegm((int(time_or_year), month, int(day), 0, 0, 0)))
+    except ValueError:
+        return None
+
+
+def _dos_list_time(date_str, time_str):
+    try:
+        month, day, year = (int(x) for x in date_str.split('-'))
+        if year < 100:
+            year += 2000 if year < 70 else 1900
+        hour, minute = int(time_str[:-2].split(':')[0]), int(time_str[:-2].split(':')[1])
+        if time_str[-2:].upper() == 'PM' and hour != 12:
+            hour += 12
+        elif time_str[-2:].upper() == 'AM' and hour == 12:
+            hour = 0
+        return float(calendar.timegm((year, month, day, hour, minute, 0)))
+    except (ValueError, IndexError):
+        return None
+
+
+def feature_params(resp: str) -> Dict[str, str]:
+    """FEAT回复中声明的命令名 (大写) -> 参数，如 HASH 后面列出的算法"""
+    features = {}
+    for line in resp.splitlines()[1:]:
+        if line[:3].isdigit():
+            continue
+        parts = line.strip().split(' ', 1)
+        if parts and parts[0]:
+            features[parts[0].upper()] = parts[1].strip() if len(parts) > 1 else ''
+    return features
+
+
+def parse_features(resp: str) -> set:
+    """FEAT回复中声明的命令名 (大写)"""
+    return set(feature_params(resp))
+
+
+class ListingEngine:
+    """绑定到一个FTP会话的列表引擎，FEAT结果在会话内缓存"""
+
+    def __init__(self, ftp: ftplib.FTP, log=None):
+        self.ftp = ftp
+        self.log = log or (lambda message: None)
+        self._features = None
+        self._mlsd_ok = None
+        self.last_method = ""
+
+    def features(self) -> Dict[str, str]:
+        """查询服务器FEAT (每个会话只查询一次)，返回命令名 -> 参数"""
+        if self._features is None:
+            try:
+                self._features = feature_params(self.ftp.sendcmd('FEAT'))
+            except ftplib.all_errors:
+                self._features = {}
+        return self._features
+
+    def supports_mlsd(self) -> bool:
+        if self._mlsd_ok is None:
+            self._mlsd_ok = 'MLST' in self.features() or 'MLSD' in self.features()
+        return self._mlsd_ok
+
+    def list_dir(self, path: str = '') -> List[RemoteEntry]:
+        """列出目录，依次尝试 MLSD -> LIST -> NLST"""
+        if self.supports_mlsd():
+            try:
+                entries = self._list_mlsd(path)
+                self.last_method = 'MLSD'
+                return entries
+            except ftplib.error_perm as e:
+                # 声明了MLST却不支持MLSD的服务器，本会话内不再尝试
+                self.log(f"MLSD命令失败，改用LIST: {e}")
+                self._mlsd_ok = False
+
+        try:
+            entries = self._list_unix(path)
+            self.last_method = 'LIST'
+            return entries
+        except ftplib.error_perm as e:
+            self.log(f"LIST命令失败: {e}")
+            entries = self._list_names(path)
+            self.last_method = 'NLST'
+            return entries
+
+    def _list_mlsd(self, path):
+        entries = []
+        cmd = f'MLSD {path}' if path else 'MLSD'
+
+        def handle(line):
+            entry = parse_mlsd_line(line)
+            if entry:
+                entries.append(entry)
+
+        self.ftp.retrlines(cmd, handle)
+        return entries
+
+    def _list_unix(self, path):
+        entries = []
+        now = time.time()
+        cmd = f'LIST {path}' if path else 'LIST'
+
+        def handle(line):
+            entry = parse_list_line(line, now)
+            if entry:
+                entries.append(entry)
+            elif line.strip() and not line.startswith('total '):
+                self.log(f"无法解析的LIST行: {line}")
+
+        self.ftp.retrlines(cmd, handle)
+        return entries
+
+    def _list_names(self, path):
+        names = self.ftp.nlst(path) if path else self.ftp.nlst()
+        return [RemoteEntry(name=n.rsplit('/', 1)[-1], size=0, is_dir=False, mtime=None)
+                for n in names if n not in ('.', '..')]
+
+
+class ListingCache:
+    """目录列表缓存：按远程绝对路径索引，带TTL，按总条目数做LRU淘汰"""
+
+    def __init__(self, ttl=300, max_entries=200000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._data = OrderedDict()  # 路径 -> (缓存时间, 目录项列表)
+        self._total = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize(path: str) -> str:
+        path = posixpath.normpath('/' + (path or '/').lstrip('/'))
+        return '/' if path in ('//', '.') else path
+
+    def get(self, path: str) -> Optional[List[RemoteEntry]]:
+        """取出未过期的列表，未命中返回None"""
+        key = self.normalize(path)
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and time.time() - item[0] <= self.ttl:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return item[1]
+            if item is not None:
+                self._remove(key)
+            self.misses += 1
+            return None
+
+    def __contains__(self, path: str) -> bool:
+        """是否有未过期的缓存 (不计入命中统计)"""
+        key = self.normalize(path)
+        with self._lock:
+            item = self._data.get(key)
+            return item is not None and time.time() - item[0] <= self.ttl
+
+    def put(self, path: str, entries: List[RemoteEntry]):
+        key = self.normalize(path)
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            # 单个目录超过上限时不缓存，避免把其他目录全部挤掉
+            if len(entries) > self.max_entries:
+                return
+            self._data[key] = (time.time(), entries)
+            self._total += len(entries)
+            while self._total > self.max_entries and self._data:
+                self._remove(next(iter(self._data)))
+
+    def invalidate(self, path: Optional[str] = None):
+        """使指定目录的缓存失效；不指定路径时清空全部缓存"""
+        with self._lock:
+            if path is None:
+                self._data.clear()
+                self._total = 0
+            else:
+                key = self.normalize(path)
+                if key in self._data:
+                    self._remove(key)
+
+    def format_stats(self) -> str:
+        """统计信息的单行文本，用于日志显示"""
+        with self._lock:
+            dirs, total = len(self._data), self._total
+        return f"列表缓存: 命中 {self.hits}, 未命中 {self.misses}, 目录 {dirs}, 条目 {total}"
+
+    def _remove(self, key):
+        _, entries = self._data.pop(key)
+        self._total -= len(entries)
+
+
+class ListingTable:
+    """按列存储的目录列表，供界面在大目录上快速过滤和排序
+
+    名称、小写名称、大小、目录标志、时间戳各占一列；每种排序键的排列 (目录在前)
+    在首次使用时计算并缓存，过滤和排序都只操作行号。
+    搜索词在上一次的基础上追加字符时，只在上一次的结果中继续筛选。
+    """
+
+    SORT_KEYS = ('name', 'size', 'date', 'type')
+
+    def __init__(self, entries: List[RemoteEntry]):
+        self.entries = entries
+        self.names = [e.name for e in entries]
+        self.lower_names = [n.lower() for n in self.names]
+        self.sizes = array('q', (e.size for e in entries))
+        self.is_dir = bytearray(e.is_dir for e in entries)
+        self.mtimes = array('d', (e.mtime or 0.0 for e in entries))
+        self.hidden = bytearray(n.startswith('.') for n in self.names)
+        self.dir_count = sum(self.is_dir)
+
+        self._orders: Dict[str, Tuple[array, array]] = {}  # 排序键 -> (排列, 行号到名次)
+        self._last_query = None   # (搜索词, 显示隐藏文件)
+        self._last_matches = None  # 上一次过滤结果 (行号列表，升序)
+
+    def __len__(self):
+        return len(self.names)
+
+    def _order(self, key: str) -> Tuple[array, array]:
+        """升序排列 (目录在前) 及其逆排列"""
+        if key == 'type':
+            key = 'name'
+        if key not in self._orders:
+            column = {'name': self.lower_names, 'size': self.sizes, 'date': self.mtimes}[key]
+            is_dir = self.is_dir
+            perm = array('l', sorted(range(len(self)), key=lambda i: (not is_dir[i], column[i])))
+            rank = array('l', [0]) * len(perm)
+            for pos, i in enumerate(perm):
+                rank[i] = pos
+            self._orders[key] = (perm, rank)
+        return self._orders[key]
+
+    def filter(self, search: str = '', show_hidden: bool = False) -> Optional[List[int]]:
+        """返回匹配的行号 (升序)；没有任何过滤条件时返回None表示全部"""
+        search = search.lower()
+        query = (search, show_hidden)
+        if not search and show_hidden:
+            self._last_query, self._last_matches = query, None
+            return None
+
+        # 新搜索词是上一次的延伸时，只需在上一次的结果中筛选
+        last = self._last_query
+        if (last is not None and self._last_matches is not None
+                and last[1] == show_hidden and search.startswith(last[0])):
+            candidates = self._last_matches
+        else:
+            hidden = self.hidden
+            candidates = range(len(self)) if show_hidden else [i for i in range(len(self)) if not hidden[i]]
+
+        if search:
+            lower = self.lower_names
+            matches = [i for i in candidates if search in lower[i]]
+        else:
+            matches = list(candidates)
+
+        self._last_query, self._last_matches = query, matches
+        return matches
+
+    def query(self, search: str = '', sort_key: str = 'name', descending: bool = False,
+              show_hidden: bool = False) -> List[int]:
+        """过滤并排序，返回显示顺序的行号
+
+        目录始终在前；按类型降序时整体倒序 (文件在前)，与原来的排序规则一致
+        """
+        matches = self.filter(search, show_hidden)
+        perm, rank = self._order(sort_key)
+        n, dirs = len(self), self.dir_count
+
+        if matches is not None and len(matches) < n // 8:
+            # 结果较少时按名次直接排序，代价与结果数相关
+            if sort_key == 'type' and descending:
+                return sorted(matches, key=lambda i: -rank[i])
+            if descending:
+                return sorted(matches, key=lambda i: (rank[i] >= dirs, -rank[i]))
+            return sorted(matches, key=rank.__getitem__)
+
+        if sort_key == 'type' and descending:
+            order = perm[::-1]
+        elif descending:
+            order = perm[dirs - 1::-1] + perm[:dirs - 1:-1] if dirs else perm[::-1]
+        else:
+            order = perm
+        if matches is None:
+            return list(order)
+        mask = bytearray(n)
+        for i in matches:
+            mask[i] = 1
+        return [i for i in order if mask[i]]
+
+    def totals(self, rows: List[int]) -> Tuple[int, int, int]:
+        """统计 (目录数, 文件数, 文件总大小)"""
+        is_dir, sizes = self.is_dir, self.sizes
+        dirs = sum(is_dir[i] for i in rows)
+        total_size = sum(sizes[i] for i in rows if not is_dir[i])
+        return dirs, len(rows) - dirs, total_size
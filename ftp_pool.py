@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+FTP连接池
+按 (主机, 端口, 用户名) 复用已登录的FTP会话，省去每个文件的TCP握手和USER/PASS往返
+"""
+
+import time
+import ftplib
+import weakref
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+
+class FTPConnectionPool:
+    """有上限的FTP会话池，复用前用NOOP做健康检查，空闲超时的会话会被回收"""
+
+    def __init__(self, max_per_key=4, idle_timeout=60, timeout=30):
+        self.max_per_key = max_per_key
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+
+        self._idle = {}       # key -> [(ftp, 归还时间), ...]
+        self._in_use = {}     # key -> 已借出的会话数
+        self._owners = {}     # id(ftp) -> key
+        self._rtt = {}        # key -> 健康检查NOOP往返时间 (指数平滑，秒)
+        self._cond = threading.Condition()
+        self._reaper = None   # 定期回收空闲超时会话的后台线程，第一次有会话归还时启动
+
+        # 统计信息
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(host, port, username):
+        return (host, int(port), username or 'anonymous')
+
+    def acquire(self, host, port, username, password, passive=True, wait=None):
+        """借出一个已登录的会话，池满时最多等待 wait 秒 (None 表示一直等待)"""
+        key = self.make_key(host, port, username)
+        deadline = None if wait is None else time.time() + wait
+
+        while True:
+            ftp = None
+            expired = []
+            try:
+                with self._cond:
+                    while True:
+                        expired += self._evict_expired(key)
+                        idle = self._idle.get(key)
+                        if idle:
+                            ftp, _ = idle.pop()
+                            self._checkout(key, ftp)
+                            break
+                        if self._in_use.get(key, 0) < self.max_per_key:
+                            # 先占位，登录在锁外进行，避免阻塞其他线程
+                            self._in_use[key] = self._in_use.get(key, 0) + 1
+                            self.misses += 1
+                            break
+
+                        remaining = None if deadline is None else deadline - time.time()
+                        if remaining is not None and remaining <= 0:
+                            raise TimeoutError(f"连接池已满: {key[0]}:{key[1]}")
+                        self._cond.wait(remaining)
+            finally:
+                # 过期会话的 QUIT 要等一次往返，在锁外关闭
+                self._close_all(expired)
+
+            if ftp is None:
+                break
+
+            # 复用前在锁外做NOOP健康检查，顺便测量控制连接往返时间
+            started = time.monotonic()
+            if self._is_alive(ftp):
+                rtt = time.monotonic() - started
+                with self._cond:
+                    self.hits += 1
+                    last = self._rtt.get(key)
+                    self._rtt[key] = rtt if last is None else last + 0.3 * (rtt - last)
+                ftp.set_pasv(passive)
+                return ftp
+            with self._cond:
+                self.evictions += 1
+            self.release(ftp, discard=True)
+
+        try:
+            ftp = ftplib.FTP()
+            ftp.connect(host, int(port), self.timeout)
+            ftp.login(username, password)
+            ftp.set_pasv(passive)
+        except Exception:
+            with self._cond:
+                self._in_use[key] -= 1
+                self._cond.notify()
+            raise
+
+        with self._cond:
+            self._owners[id(ftp)] = key
+        return ftp
+
+    def release(self, ftp, discard=False):
+        """归还会话；传输出错时应 discard=True，直接关闭而不放回池中"""
+        with self._cond:
+            key = self._owners.pop(id(ftp), None)
+            if key is None:
+                return
+            self._in_use[key] -= 1
+            if not discard:
+                self._idle.setdefault(key, []).append((ftp, time.time()))
+                self._start_reaper()
+            self._cond.notify()
+        if discard:
+            self._close(ftp)
+
+    @contextmanager
+    def connection(self, host, port, username, password, passive=True):
+        """with 语句形式的借出/归还，块内抛出异常时丢弃该会话"""
+        ftp = self.acquire(host, port, username, password, passive)
+        try:
+            yield ftp
+        except BaseException:
+            self.release(ftp, discard=True)
+            raise
+        else:
+            self.release(ftp)
+
+    def latency(self, host, port, username):
+        """最近的控制连接往返时间 (秒)，还没有复用过会话时返回 None"""
+        with self._cond:
+            return self._rtt.get(self.make_key(host, port, username))
+
+    def evict_idle(self):
+        """回收所有空闲超时的会话 (后台线程定期调用)"""
+        expired = []
+        with self._cond:
+            for key in list(self._idle):
+                expired += self._evict_expired(key)
+        self._close_all(expired)
+
+    def clear(self, host=None, port=None, username=None):
+        """关闭空闲会话；指定主机时只关闭该服务器的会话"""
+        closing = []
+        with self._cond:
+            if host is None:
+                keys = list(self._idle)
+            else:
+                keys = [self.make_key(host, port, username)]
+            for key in keys:
+                closing += [ftp for ftp, _ in self._idle.pop(key, [])]
+        self._close_all(closing)
+
+    def get_stats(self):
+        """返回命中/未命中等统计信息"""
+        with self._cond:
+            idle = sum(len(v) for v in self._idle.values())
+            in_use = sum(self._in_use.values())
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / total if total else 0.0,
+            'idle': idle,
+            'in_use': in_use,
+        }
+
+    def format_stats(self):
+        """统计信息的单行文本，用于日志显示"""
+        stats = self.get_stats()
+        return (f"连接池: 命中 {stats['hits']}, 未命中 {stats['misses']}, "
+                f"回收 {stats['evictions']}, 空闲 {stats['idle']}, 使用中 {stats['in_use']}")
+
+    def _checkout(self, key, ftp):
+        self._in_use[key] = self._in_use.get(key, 0) + 1
+        self._owners[id(ftp)] = key
+
+    def _evict_expired(self, key):
+        """从空闲列表中取出超时的会话 (持有锁时调用)，由调用方在锁外关闭"""
+        idle = self._idle.get(key)
+        if not idle:
+            return []
+        now = time.time()
+        fresh = []
+        expired = []
+        for ftp, released_at in idle:
+            if now - released_at > self.idle_timeout:
+                self.evictions += 1
+                expired.append(ftp)
+            else:
+                fresh.append((ftp, released_at))
+        self._idle[key] = fresh
+        return expired
+
+    def _start_reaper(self):
+        """(持有锁时调用) 启动回收线程；线程只持有弱引用，连接池不再使用时自行退出"""
+        if self._reaper is None:
+            self._reaper = threading.Thread(target=self._reap, args=(weakref.ref(self),),
+                                            daemon=True, name='ftp-pool-reaper')
+            self._reaper.start()
+
+    @staticmethod
+    def _reap(pool_ref):
+        while True:
+            pool = pool_ref()
+            if pool is None:
+                return
+            interval = max(1.0, min(pool.idle_timeout / 2, 30.0))
+            pool.evict_idle()
+            del pool
+            time.sleep(interval)
+
+    @staticmethod
+    def _is_alive(ftp):
+        try:
+            ftp.voidcmd('NOOP')
+            return True
+        except Exception:
+            return False
+
+    @classmethod
+    def _close_all(cls, sessions):
+        for ftp in sessions:
+            cls._close(ftp)
+
+    @staticmethod
+    def _close(ftp):
+        try:
+            ftp.quit()
+        except Exception:
+            try:
+                ftp.close()
+            except Exception:
+                pass
+
+
+def fetch_sizes(ftp, paths):
+    """在同一控制连接上流水线发送SIZE命令，一次往返取回整批文件大小
+
+    返回 {路径: 大小}，查询失败的路径对应 None
+    """
+    ftp.voidcmd('TYPE I')  # 部分服务器在ASCII模式下拒绝SIZE
+    for path in paths:
+        ftp.putcmd(f'SIZE {path}')
+    
+    sizes = {}
+    for path in paths:
+        try:
+            resp = ftp.getresp()
+        except (ftplib.error_perm, ftplib.error_temp):
+            sizes[path] = None
+            continue
+        try:
+            sizes[path] = int(resp[3:].strip()) if resp[:3] == '213' else None
+        except ValueError:
+            sizes[path] = None
+    return sizes
+
+
+class SizePrefetcher:
+    """后台批量查询下载任务的文件大小，避免在界面线程上逐个发送SIZE"""
+
+    def __init__(self, connection_factory, batch_size=64, on_done=None, idle_exit=5.0):
+        # connection_factory() 需返回一个 with 语句可用的会话，例如连接池的 connection()
+        self.connection_factory = connection_factory
+        self.batch_size = batch_size
+        self.on_done = on_done
+        self.idle_exit = idle_exit
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def submit(self, tasks):
+        """提交需要查询大小的任务 (任务需有 remote_path 和 size 属性)"""
+        with self._cond:
+            self._queue.extend(tasks)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def pending(self):
+        """尚未查询的任务数"""
+        with self._cond:
+            return len(self._queue)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._queue:
+                    self._cond.wait(self.idle_exit)
+                if not self._queue:
+                    # 空闲一段时间后线程退出，下次提交时再启动
+                    self._thread = None
+                    return
+                count = min(self.batch_size, len(self._queue))
+                batch = [self._queue.popleft() for _ in range(count)]
+
+            paths = list(dict.fromkeys(task.remote_path for task in batch))
+            try:
+                with self.connection_factory() as ftp:
+                    sizes = fetch_sizes(ftp, paths)
+            except Exception:
+                sizes = {}
+
+            for task in batch:
+                size = sizes.get(task.remote_path)
+                if size is not None and not task.size:
+                    task.size = size
+            if self.on_done:
+                self.on_done(batch)
+
+
+# 进程内共享的默认连接池
+default_pool = FTPConnectionPool()
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+多进程下载后端
+开启校验后哈希和分块CRC都在接收线程中计算，单个进程受GIL限制，网络还没跑满CPU就先成了瓶颈。
+这里把下载任务按槽位分给多个工作进程，每个进程有自己的连接池和下载线程；
+每个槽位在共享内存中有一个计数器，工作进程写入已落盘的字节数，父进程按时间间隔读取，
+开始和结束事件经管道队列返回。全局和主机限速的令牌桶也在共享内存中，所有进程共用同一个限速
+"""
+
+import os
+import ftplib
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable, List, Optional, Tuple
+
+from ftp_integrity import IntegrityChecker
+from ftp_journal import JournalEntry
+from ftp_pool import FTPConnectionPool
+from ftp_ratelimit import RateLimiter, SharedTokenBucket
+from ftp_storage import download_part
+from ftp_transfer import ADAPTIVE, DEFAULT_BUFFER_SIZE, PROGRESS_INTERVAL, AdaptiveBlockSizer
+
+# 子进程用 spawn 方式启动：父进程里有界面和事件循环线程，fork 后子进程可能卡在它们持有的锁上
+CONTEXT = multiprocessing.get_context('spawn')
+
+# (主机, 端口, 用户名, 密码)
+Session = Tuple[str, int, str, str]
+
+
+@dataclass
+class ProcessJob:
+    """发给工作进程的下载任务"""
+    slot: int
+    remote_path: str
+    local_path: str                       # 目标文件，数据先写入旁边的 .part 文件
+    size: int
+    offset: int                           # 父进程检查过的 .part 文件长度
+    entry: Optional[JournalEntry] = None  # 传输日志记录，工作进程据此核对续传位置
+    verify: bool = False
+    chunk_size: object = DEFAULT_BUFFER_SIZE
+
+
+@dataclass
+class ProcessResult:
+    """工作进程返回的下载结果"""
+    status: str
+    error_msg: str = ''
+    downloaded: Optional[int] = None      # None 表示出错时保留父进程看到的进度
+    error: Optional[BaseException] = None  # ftplib 和网络错误原样返回，供识别会话数超限和判断是否重试
+
+
+@dataclass
+class _SlotState:
+    done: threading.Event = field(default_factory=threading.Event)
+    offset: Optional[int] = None  # 工作进程核对后的续传起点
+    result: Optional[ProcessResult] = None
+
+
+class ProcessBackend:
+    """父进程一侧：启动工作进程、分配槽位、收集事件
+
+    工作进程 i 负责槽位 [i * slots_per_process, (i + 1) * slots_per_process)；
+    acquire() 总是从空闲槽位最多的进程中取，任务均匀分布到各个进程
+    """
+
+    def __init__(self, session: Session, global_bucket: SharedTokenBucket,
+                 host_bucket: Optional[SharedTokenBucket] = None, processes: Optional[int] = None,
+                 slots_per_process: int = 8, timeout: int = 30):
+        self.session = session
+        self.processes = max(1, processes or os.cpu_count() or 1)
+        self.slots_per_process = max(1, slots_per_process)
+        self.slots = self.processes * self.slots_per_process
+        self.progress = CONTEXT.RawArray('q', self.slots)  # 每个槽位本次已写入文件的字节数
+        self.task_buckets = [SharedTokenBucket(ctx=CONTEXT) for _ in range(self.slots)]
+
+        self._cond = threading.Condition()
+        self._free = [list(range(i * self.slots_per_process, (i + 1) * self.slots_per_process))
+                      for i in range(self.processes)]
+        self._states = {}
+        self._events = CONTEXT.Queue()
+        self._jobs = [CONTEXT.Queue() for _ in range(self.processes)]
+        self._workers = []
+        for index in range(self.processes):
+            first = index * self.slots_per_process
+            worker = CONTEXT.Process(
+                target=_worker_main, daemon=True, name=f'ftp-worker-{index}',
+                args=(self._jobs[index], self._events, self.progress, session, timeout,
+                      global_bucket, host_bucket, first,
+                      self.task_buckets[first:first + self.slots_per_process]))
+            worker.start()
+            self._workers.append(worker)
+        self._collector = threading.Thread(target=self._collect, daemon=True)
+        self._collector.start()
+
+    def acquire(self) -> int:
+        """取一个空闲槽位，全部占用时等待"""
+        with self._cond:
+            while not any(self._free):
+                self._cond.wait()
+            index = max(range(self.processes), key=lambda i: len(self._free[i]))
+            return self._free[index].pop()
+
+    def release(self, slot: int):
+        with self._cond:
+            self._states.pop(slot, None)
+            self._free[slot // self.slots_per_process].append(slot)
+            self._cond.notify()
+
+    def download(self, job: ProcessJob, progress: Optional[Callable[[int, int], None]] = None,
+                 interval: float = PROGRESS_INTERVAL) -> ProcessResult:
+        """在工作进程中下载并等待结果；等待期间按 interval 调用 progress(续传起点, 本次写入字节数)"""
+        state = _SlotState()
+        with self._cond:
+            self._states[job.slot] = state
+        self.progress[job.slot] = 0
+        worker = job.slot // self.slots_per_process
+        self._jobs[worker].put(job)
+
+        while not state.done.wait(interval):
+            if not self._workers[worker].is_alive():
+                return ProcessResult("失败", "工作进程已退出")
+            if progress is not None and state.offset is not None:
+                progress(state.offset, self.progress[job.slot])
+        if progress is not None and state.offset is not None:
+            progress(state.offset, self.progress[job.slot])
+        return state.result
+
+    def shutdown(self):
+        """通知工作进程处理完手头的任务后退出"""
+        for jobs in self._jobs:
+            jobs.put(None)
+        self._events.put(None)
+        self._collector.join(1.0)
+
+    def _collect(self):
+        """汇总工作进程的事件: ('start', 槽位, 续传起点) / ('done', 槽位, ProcessResult)"""
+        while True:
+            try:
+                event = self._events.get()
+            except (EOFError, OSError):
+                return
+            if event is None:
+                return
+            kind, slot, value = event
+            with self._cond:
+                state = self._states.get(slot)
+            if state is None:
+                continue
+            if kind == 'start':
+                state.offset = value
+            else:
+                state.result = value
+                state.done.set()
+
+
+def _worker_main(jobs, events, progress, session: Session, timeout: int,
+                 global_bucket, host_bucket, first_slot: int, task_buckets: List[SharedTokenBucket]):
+    """工作进程入口：每个槽位一个下载线程，共用本进程的连接池"""
+    pool = FTPConnectionPool(max_per_key=len(task_buckets), timeout=timeout)
+    integrity = IntegrityChecker()
+    with ThreadPoolExecutor(len(task_buckets)) as executor:
+        while True:
+            job = jobs.get()
+            if job is None:
+                break
+            limiter = RateLimiter(global_bucket, host_bucket, task_buckets[job.slot - first_slot])
+            executor.submit(_run_job, job, pool, session, integrity, limiter, events, progress)
+    pool.clear()
+
+
+def _run_job(job: ProcessJob, pool: FTPConnectionPool, session: Session, integrity: IntegrityChecker,
+             limiter: RateLimiter, events, progress):
+    """在工作进程中下载一个文件 (ftp_storage.download_part)，开始时报告核对后的续传起点"""
+    host, port, username, password = session
+
+    def report(written):
+        progress[job.slot] = written
+
+    def start(offset):
+        events.put(('start', job.slot, offset))
+        return report
+
+    try:
+        with pool.connection(host, port, username, password) as ftp:
+            tuner = AdaptiveBlockSizer() if job.chunk_size == ADAPTIVE else None
+            done = download_part(ftp, job.remote_path, job.local_path, job.size, job.offset, start, job.entry,
+                                 integrity if job.verify else None, job.chunk_size, tuner, limiter, log=print)
+        result = ProcessResult(done.status, done.error_msg, done.downloaded)
+    except Exception as e:
+        result = ProcessResult("失败", str(e), None,
+                               e if isinstance(e, (ftplib.Error, OSError, EOFError)) else None)
+    events.put(('done', job.slot, result))
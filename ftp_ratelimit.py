@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+带宽整形
+令牌桶限速，分全局、单个主机、单个任务三级；接收循环每读到一小块数据就按
+三级中最紧的限制等待相应的时间，速率在传输过程中可以随时修改
+"""
+
+import time
+import threading
+import multiprocessing
+from typing import Dict, Optional
+
+UNITS = {'': 1, 'B': 1, 'K': 1024, 'KB': 1024, 'M': 1024 ** 2, 'MB': 1024 ** 2, 'G': 1024 ** 3, 'GB': 1024 ** 3}
+
+
+class TokenBucket:
+    """令牌桶，rate 为字节/秒，0 表示不限速
+
+    允许欠账：取走令牌后余额为负时，调用方按欠额等待，
+    突发量只有约0.1秒的流量，因此等待均匀分布，不会出现长时间停顿后的集中突发
+    """
+
+    BURST_SECONDS = 0.1
+    MIN_BURST = 4096
+
+    def __init__(self, rate: int = 0):
+        self._lock = threading.Lock()
+        self._rate = 0
+        self._tokens = 0.0
+        self._stamp = time.monotonic()
+        self.burst = 0
+        self.set_rate(rate)
+
+    @property
+    def rate(self) -> int:
+        return self._rate
+
+    def set_rate(self, rate: int):
+        """修改速率，立即对正在进行的传输生效"""
+        rate = max(0, int(rate or 0))
+        with self._lock:
+            self._refill(time.monotonic())
+            self._rate = rate
+            self.burst = max(self.MIN_BURST, int(rate * self.BURST_SECONDS)) if rate else 0
+            # 改为更低的速率时丢弃多余的令牌和旧速率下的欠账
+            self._tokens = max(-self.burst, min(self._tokens, self.burst))
+
+    def reserve(self, nbytes: int) -> float:
+        """取走 nbytes 个令牌，返回需要等待的秒数"""
+        with self._lock:
+            if not self._rate:
+                return 0.0
+            self._refill(time.monotonic())
+            self._tokens -= nbytes
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self._rate
+
+    def _refill(self, now: float):
+        if self._rate:
+            self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self._rate)
+        self._stamp = now
+
+
+def _shared_field(index: int, cast=float):
+    return property(lambda self: cast(self._shared[index]),
+                    lambda self, value: self._shared.__setitem__(index, value))
+
+
+class SharedTokenBucket(TokenBucket):
+    """状态放在共享内存中的令牌桶，多个进程共用同一个限速
+
+    作为 Process 的参数传给子进程后，两边操作的是同一块共享内存，父进程修改速率立即对子进程生效；
+    ctx 为 None 时使用 spawn 方式的多进程上下文 (与 ftp_process 一致)
+    """
+
+    _rate = _shared_field(0, int)
+    _tokens = _shared_field(1)
+    _stamp = _shared_field(2)
+    burst = _shared_field(3, int)
+
+    def __init__(self, rate: int = 0, ctx=None):
+        ctx = ctx or multiprocessing.get_context('spawn')
+        self._shared = ctx.RawArray('d', 4)  # 速率, 令牌, 时间戳, 突发量
+        self._lock = ctx.Lock()
+        self._stamp = time.monotonic()
+        self.set_rate(rate)
+
+
+class RateLimiter:
+    """一条传输连接的限速器，数据依次经过全局、主机、任务三个令牌桶"""
+
+    def __init__(self, *buckets: Optional[TokenBucket]):
+        self.buckets = [bucket for bucket in buckets if bucket is not None]
+
+    def chunk_size(self, default: int) -> int:
+        """限速时每次读取不超过最紧一级的突发量，保证节奏平滑"""
+        size = default
+        for bucket in self.buckets:
+            if bucket.rate and bucket.burst < size:
+                size = bucket.burst
+        return size
+
+    def reserve(self, nbytes: int) -> float:
+        """记入 nbytes 字节的流量，返回需要等待的秒数 (异步传输用 asyncio.sleep 等待)"""
+        wait = 0.0
+        for bucket in self.buckets:
+            wait = max(wait, bucket.reserve(nbytes))
+        return wait
+
+    def throttle(self, nbytes: int):
+        """记入 nbytes 字节的流量，超出任一级限制时等待"""
+        wait = self.reserve(nbytes)
+        if wait > 0:
+            time.sleep(wait)
+
+
+class BandwidthManager:
+    """全局和按主机的限速设置，为每条传输连接生成 RateLimiter
+
+    host_rate 为未单独设置的主机使用的默认限速；
+    bucket_factory 为 SharedTokenBucket 时全局和主机限速可以由多个进程共用
+    """
+
+    def __init__(self, global_rate: int = 0, host_rate: int = 0, bucket_factory=TokenBucket):
+        self.bucket_factory = bucket_factory
+        self.global_bucket = bucket_factory(global_rate)
+        self.host_rate = host_rate
+        self._hosts: Dict[str, TokenBucket] = {}
+        self._custom: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def set_global_rate(self, rate: int):
+        self.global_bucket.set_rate(rate)
+
+    def set_host_rate(self, rate: int, host: Optional[str] = None):
+        """设置单个主机的限速；host 为 None 时修改默认值 (不影响单独设置过的主机)"""
+        with self._lock:
+            if host is None:
+                self.host_rate = rate
+                for name, bucket in self._hosts.items():
+                    if name not in self._custom:
+                        bucket.set_rate(rate)
+            else:
+                self._custom[host] = rate
+                self._bucket(host).set_rate(rate)
+
+    def host_rates(self) -> Dict[str, int]:
+        """单独设置过限速的主机"""
+        with self._lock:
+            return dict(self._custom)
+
+    def limiter(self, host: Optional[str] = None,
+                task_bucket: Optional[TokenBucket] = None) -> RateLimiter:
+        return RateLimiter(self.global_bucket, self.host_bucket(host) if host else None, task_bucket)
+
+    def host_bucket(self, host: str) -> TokenBucket:
+        with self._lock:
+            return self._bucket(host)
+
+    def _bucket(self, host: str) -> TokenBucket:
+        bucket = self._hosts.get(host)
+        if bucket is None:
+            bucket = self._hosts[host] = self.bucket_factory(self._custom.get(host, self.host_rate))
+        return bucket
+
+
+class SpeedMeter:
+    """按采样计算的当前速度 (指数平滑)
+
+    用平均速度时，限速修改后显示的数值要很久才会变化；
+    这里只看最近几次采样，显示的就是整形后的实际速率
+    """
+
+    def __init__(self, smoothing: float = 0.3):
+        self.smoothing = smoothing
+        self.speed = 0.0
+        self._last_total = 0
+        self._last_time = time.monotonic()
+
+    def update(self, total: int) -> float:
+        """total 为创建以来的累计字节数，返回当前速度 (字节/秒)"""
+        now = time.monotonic()
+        if now > self._last_time:
+            current = (total - self._last_total) / (now - self._last_time)
+            if self.speed:
+                self.speed += self.smoothing * (current - self.speed)
+            else:
+                self.speed = current
+        self._last_total = total
+        self._last_time = now
+        return self.speed
+
+
+def parse_rate(text) -> int:
+    """解析速率，如 500K、2M、1048576，单位为字节/秒；0 或空表示不限速"""
+    text = str(text or '').strip().upper()
+    if text.endswith('/S'):
+        text = text[:-2]
+    number = text.rstrip('KMGB')
+    unit = text[len(number):]
+    if unit not in UNITS:
+        raise ValueError(f"无效的速率: {text}")
+    try:
+        value = float(number or 0)
+    except ValueError:
+        raise ValueError(f"无效的速率: {text}")
+    if value < 0:
+        raise ValueError(f"无效的速率: {text}")
+    return int(value * UNITS[unit])
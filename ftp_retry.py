@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+失败重试策略
+下载因网络错误中断后，等待一段时间重新连接，从已写入的位置续传。
+等待时间由策略决定，重试次数由调用方决定 (命令行 -r，下载管理器的 max_retries)
+"""
+
+import time
+import ftplib
+import random
+from dataclasses import dataclass
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    """第 n 次重试前等待 min(max_delay, delay * backoff ** (n - 1)) 秒，再随机缩短最多 jitter 比例
+
+    jitter 让同时失败的多个连接错开重连时间，不会在同一时刻一起涌向服务器
+    """
+    delay: float = 2.0
+    backoff: float = 1.0
+    max_delay: float = 30.0
+    jitter: float = 0.0
+
+    def wait(self, attempt: int) -> float:
+        """第 attempt 次重试 (从1开始) 前的等待秒数"""
+        wait = min(self.max_delay, self.delay * self.backoff ** max(0, attempt - 1))
+        if self.jitter:
+            wait *= 1 - random.uniform(0, self.jitter)
+        return wait
+
+    def sleep(self, attempt: int):
+        wait = self.wait(attempt)
+        if wait > 0:
+            time.sleep(wait)
+
+
+POLICIES = {
+    'fixed': RetryPolicy(),                              # 每次固定等待2秒
+    'immediate': RetryPolicy(0.0),                       # 立即重连
+    'backoff': RetryPolicy(0.5, 2.0, 30.0, 0.5),         # 0.5秒起指数退避，带随机抖动
+}
+
+
+def retryable(error: BaseException) -> bool:
+    """网络错误和服务器的临时错误 (4xx) 值得重试；5xx 永久错误 (如文件不存在) 重试也不会成功"""
+    if isinstance(error, ftplib.error_perm):
+        return False
+    return isinstance(error, (OSError, EOFError, ftplib.Error))
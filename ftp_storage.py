@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+下载文件的本地存储
+未完成的数据写入目标旁边的 .part 文件，完成并核对大小后原子改名为目标文件，
+其他程序不会读到写了一半的文件；开始写入前为整个文件预先分配磁盘空间，
+大文件在 ext4/XFS 上一次分配、连续存放，不会随着逐块追加而产生碎片。
+分段下载的 .part 一开始就扩展到完整长度，进度只记在 .seg 分段状态文件中，文件长度不能作为续传起点。
+download_part 是各个下载入口共用的单连接下载流程：核对续传位置、修复损坏的块、边收边算校验、核对后改名
+"""
+
+import os
+import sys
+import json
+import errno
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, List, Optional
+
+from ftp_integrity import BLOCK_SUFFIX, BlockLog, Checksum, IntegrityChecker, StreamHash, combine, resume_blocks
+from ftp_journal import JournalEntry, resume_from
+from ftp_transfer import DEFAULT_BUFFER_SIZE, retrieve_file
+
+PART_SUFFIX = '.part'
+SEGMENT_SUFFIX = '.seg'
+PREALLOCATE_MIN = 1024 * 1024   # 小于1MB的文件不预分配
+FALLOC_FL_KEEP_SIZE = 0x01
+
+_fallocate = None
+if sys.platform.startswith('linux'):
+    try:
+        import ctypes
+        _libc = ctypes.CDLL(None, use_errno=True)
+        _fallocate = _libc.fallocate
+        _fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+        _fallocate.restype = ctypes.c_int
+    except (ImportError, OSError, AttributeError):
+        _fallocate = None
+
+
+def part_path(local_path) -> Path:
+    """local_path 对应的未完成文件"""
+    local_path = Path(local_path)
+    return local_path.with_name(local_path.name + PART_SUFFIX)
+
+
+def segment_path(local_path) -> Path:
+    """local_path 对应的分段状态文件"""
+    local_path = Path(local_path)
+    return local_path.with_name(local_path.name + SEGMENT_SUFFIX)
+
+
+def load_segments(state_path, remote_size: int) -> Optional[List[List[int]]]:
+    """读取分段状态 [[起点, 当前位置, 终点), ...]，文件不存在、损坏或远程文件大小变化时返回 None"""
+    try:
+        with open(state_path, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+        if state.get('size') == remote_size:
+            return [list(seg) for seg in state['segments']]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    return None
+
+
+def _discard_segments(local_path, part: Path, remote_size: int):
+    """单连接续传前处理分段下载留下的文件：只保留第一段从头连续写入的部分，删除分段状态"""
+    state_path = segment_path(local_path)
+    if not state_path.exists():
+        return
+    # 旧版本的分段下载直接写在目标路径上
+    if local_path.exists() and not part.exists():
+        os.replace(local_path, part)
+    ranges = load_segments(state_path, remote_size) or []
+    prefix = next((pos for start, pos, _ in ranges if start == 0), 0)
+    if part.exists():
+        with open(part, 'r+b') as f:
+            f.truncate(min(prefix, remote_size))
+    state_path.unlink()
+
+
+def resume_size(local_path, remote_size: int) -> Optional[int]:
+    """下载前检查本地文件，返回 .part 文件的续传起点；目标文件已完整时返回 None
+
+    目标文件大小与远程不一致时，是旧版本直接写入目标路径留下的未完成文件：
+    比远程小的连同分块校验记录改名为 .part 继续续传，否则删除；.part 比远程大时从头下载。
+    旁边有分段状态文件时，文件长度不代表已写入的数据，只从第一段的当前位置续传
+    """
+    local_path = Path(local_path)
+    part = part_path(local_path)
+    local_path.parent.mkdir(parents=True, exist_ok=True)
+    _discard_segments(local_path, part, remote_size)
+
+    if local_path.exists():
+        size = local_path.stat().st_size
+        if size == remote_size:
+            return None
+        if size < remote_size and not part.exists():
+            os.replace(local_path, part)
+            blocks = local_path.with_name(local_path.name + BLOCK_SUFFIX)
+            if blocks.exists():
+                os.replace(blocks, part.with_name(part.name + BLOCK_SUFFIX))
+        else:
+            local_path.unlink()
+
+    try:
+        size = part.stat().st_size
+    except OSError:
+        return 0
+    if size > remote_size:
+        part.unlink()
+        return 0
+    return size
+
+
+def preallocate(f, size: int) -> bool:
+    """为文件 [当前长度, size) 预先分配磁盘空间，不改变文件长度 (FALLOC_FL_KEEP_SIZE)
+
+    文件长度仍然等于已写入的字节数，续传照常按长度判断；只在 Linux 上生效，
+    文件系统不支持时忽略，磁盘空间不足时抛出 OSError，下载在传输前就失败
+    """
+    if _fallocate is None or size < PREALLOCATE_MIN:
+        return False
+    fd = f.fileno()
+    start = os.fstat(fd).st_size
+    if start >= size:
+        return False
+    if _fallocate(fd, FALLOC_FL_KEEP_SIZE, start, size - start) == 0:
+        return True
+    err = ctypes.get_errno()
+    if err == errno.ENOSPC:
+        raise OSError(err, os.strerror(err), getattr(f, 'name', None))
+    return False
+
+
+def allocate(f, size: int):
+    """把文件扩展到 size 字节并分配磁盘空间 (分段下载各段写入自己的偏移)；不支持时只扩展长度"""
+    if hasattr(os, 'posix_fallocate') and size >= PREALLOCATE_MIN:
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+            return
+        except OSError as e:
+            if e.errno == errno.ENOSPC:
+                raise
+    f.truncate(size)
+
+
+def open_part(part, offset: int, size: int):
+    """打开 .part 文件准备写入 (offset 大于0时追加)，并为整个文件预先分配磁盘空间"""
+    f = open(part, 'ab' if offset > 0 else 'wb', buffering=0)
+    try:
+        preallocate(f, size)
+    except OSError:
+        f.close()
+        raise
+    return f
+
+
+def commit_part(part, local_path, size: int):
+    """核对 .part 文件大小后原子改名为目标文件，大小不符时抛出 IOError (保留 .part 供续传)"""
+    actual = os.path.getsize(part)
+    if actual != size:
+        raise IOError(f"下载不完整: {actual}/{size}")
+    os.replace(part, local_path)
+
+
+@dataclass
+class PartResult:
+    """download_part / finish_part 的结果"""
+    status: str                          # "已完成" 或 "失败"
+    downloaded: int                      # .part 文件中的字节数，校验失败删除后为 0
+    error_msg: str = ''
+    checksum: Optional[Checksum] = None  # 服务器提供的校验值，没有校验时为 None
+    digest: Optional[str] = None         # 下载内容的哈希 (有校验值且下载完整时)
+
+
+def finish_part(local_path, size: int, downloaded: int, blocks: Optional[BlockLog] = None,
+                hasher: Optional[StreamHash] = None, checksum: Optional[Checksum] = None) -> PartResult:
+    """传输结束后检查完整性：完整且校验通过时改名为目标文件，内容损坏时删除 .part (不能再从它续传)
+
+    size 为 0 (服务器没有返回大小) 时不核对长度，以实际写入的字节数为准
+    """
+    part = part_path(local_path)
+    if size > 0 and downloaded != size:
+        return PartResult("失败", downloaded, "下载不完整", checksum)
+    if blocks is not None:
+        blocks.remove()
+    digest = hasher.hexdigest() if hasher is not None else None
+    if hasher is not None and not hasher.matches(checksum):
+        part.unlink()
+        return PartResult("失败", 0, f"校验失败 ({checksum.source} {checksum.algorithm})", checksum, digest)
+    # 核对大小后改名，目标路径上只会出现完整的文件
+    commit_part(part, local_path, size or downloaded)
+    return PartResult("已完成", downloaded, '', checksum, digest)
+
+
+def download_part(ftp, remote_path: str, local_path, size: int, offset: int,
+                  start: Callable[[int], Optional[Callable]] = None, entry: Optional[JournalEntry] = None,
+                  integrity: Optional[IntegrityChecker] = None, buffer_size=DEFAULT_BUFFER_SIZE,
+                  tuner=None, limiter=None, full: bool = False,
+                  log: Optional[Callable[[str], None]] = None) -> PartResult:
+    """经 .part 文件下载一个文件，offset 为 resume_size 返回的续传起点；返回下载结果
+
+    - entry 为传输日志记录时从核对过的偏移续传，而不是直接相信本地文件长度
+    - 只从分块校验通过的位置续传，中间损坏的块先单独重新下载 (full 为 True 时核对全部块)
+    - integrity 不为 None 时在传输前查询校验值 (传输过程中控制连接不能发命令)，续传时先对本地前缀计算哈希
+    - start 在续传起点确定后以该偏移调用，返回的函数作为接收进度回调 (参数为本次已写入的字节数，
+      返回 False 时停止接收，已写入的部分下次续传)
+    """
+    part = part_path(local_path)
+    if entry is not None and offset:
+        offset = resume_from(entry, ftp, part)
+    offset, blocks = resume_blocks(ftp, remote_path, part, size, offset, full, limiter, log)
+
+    checksum = hasher = None
+    if integrity is not None:
+        checksum = integrity.expected(ftp, remote_path)
+        if checksum is None:
+            if log is not None:
+                log(f"服务器没有提供校验值，跳过校验: {remote_path}")
+        else:
+            hasher = StreamHash(checksum.algorithm).resume(part, offset)
+    progress = start(offset) if start is not None else None
+
+    # 数据写入 .part 文件，打开时为整个文件预分配磁盘空间
+    with open_part(part, offset, size) as f:
+        try:
+            written = retrieve_file(ftp, remote_path, f, offset or None, buffer_size, progress,
+                                    tuner=tuner, limiter=limiter, hasher=combine(hasher, blocks))
+        finally:
+            if blocks is not None:
+                blocks.close()
+    return finish_part(local_path, size, offset + written, blocks, hasher, checksum)
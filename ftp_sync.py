@@ -0,0 +1,517 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+FTP目录同步引擎
+每次同步把远程目录树快照成清单 (路径、大小、修改时间) 保存在本地，
+下次同步时与上次清单和本地目录三方对比，只传输发生变化的文件；
+未变化的大目录树只需要列表的时间，不需要逐个文件的SIZE/MDTM
+"""
+
+import os
+import json
+import time
+import queue
+import ftplib
+import fnmatch
+import calendar
+import threading
+from pathlib import Path
+from dataclasses import dataclass, field
+from typing import Dict, List, NamedTuple, Optional
+
+from ftp_listing import ListingCache, ListingEngine
+from ftp_storage import PART_SUFFIX, commit_part, open_part, part_path
+from ftp_transfer import retrieve_file, store_file
+
+MANIFEST_DIR = "sync_manifests"
+HISTORY_FILE = "sync_history.json"
+HISTORY_LIMIT = 200
+MTIME_TOLERANCE = 2  # FTP时间戳常只有秒或分钟精度，误差内视为相同
+
+
+class FileState(NamedTuple):
+    """快照中的单个文件"""
+    size: int
+    mtime: Optional[float]  # UTC时间戳，未知时为None
+
+
+class ManifestEntry(NamedTuple):
+    """清单记录：上次同步完成时两端的状态"""
+    size: int
+    remote_mtime: Optional[float]
+    local_mtime: Optional[float]
+
+
+@dataclass
+class SyncPlan:
+    """对比结果，路径均为相对同步根目录的 / 分隔路径"""
+    downloads: List[str] = field(default_factory=list)
+    uploads: List[str] = field(default_factory=list)
+    delete_local: List[str] = field(default_factory=list)
+    delete_remote: List[str] = field(default_factory=list)
+    unchanged: int = 0
+    conflicts: int = 0
+
+    @property
+    def total(self) -> int:
+        return len(self.downloads) + len(self.uploads) + len(self.delete_local) + len(self.delete_remote)
+
+    def summary(self) -> str:
+        return (f"下载 {len(self.downloads)}, 上传 {len(self.uploads)}, "
+                f"删除本地 {len(self.delete_local)}, 删除远程 {len(self.delete_remote)}, "
+                f"未变化 {self.unchanged}, 冲突 {self.conflicts}")
+
+
+class SyncEngine:
+    """按 SyncProfile 执行增量同步
+
+    connection_factory() 需返回一个 with 语句可用的已登录会话，例如连接池的 connection()
+    """
+
+    def __init__(self, profile, connection_factory, walkers=4, workers=3,
+                 state_dir=".", log=None):
+        self.profile = profile
+        self.connection_factory = connection_factory
+        self.walkers = walkers
+        self.workers = workers
+        self.state_dir = Path(state_dir)
+        self.log = log or (lambda message: None)
+
+        self.remote: Dict[str, FileState] = {}
+        self.local: Dict[str, FileState] = {}
+        self.previous: Dict[str, ManifestEntry] = {}
+        self.scan_errors: List[str] = []
+        self._lock = threading.Lock()
+
+    # ---------- 清单 ----------
+
+    @property
+    def manifest_path(self) -> Path:
+        safe = "".join(c if c.isalnum() or c in '-_' else '_' for c in (self.profile.name or 'default'))
+        return self.state_dir / MANIFEST_DIR / f"{safe}.json"
+
+    def load_manifest(self) -> Dict[str, ManifestEntry]:
+        """读取上次同步的清单；配置的路径变化后清单作废"""
+        try:
+            with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if (data.get('remote_path') != self.profile.remote_path
+                or data.get('local_path') != self.profile.local_path):
+            return {}
+        return {path: ManifestEntry(*values) for path, values in data.get('files', {}).items()}
+
+    def save_manifest(self, entries: Dict[str, ManifestEntry]):
+        """原子写入清单，中途崩溃不会留下损坏的文件"""
+        path = self.manifest_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        data = {
+            'remote_path': self.profile.remote_path,
+            'local_path': self.profile.local_path,
+            'time': time.time(),
+            'files': {p: list(e) for p, e in entries.items()},
+        }
+        tmp = path.with_suffix('.tmp')
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+        os.replace(tmp, path)
+
+    # ---------- 过滤 ----------
+
+    def _excluded(self, rel: str, name: str) -> bool:
+        return any(fnmatch.fnmatch(name, p) or fnmatch.fnmatch(rel, p)
+                   for p in self.profile.exclude_patterns if p)
+
+    def _included(self, rel: str, name: str) -> bool:
+        filters = [p for p in self.profile.file_filters if p] or ['*']
+        return any(fnmatch.fnmatch(name, p) for p in filters) and not self._excluded(rel, name)
+
+    # ---------- 扫描 ----------
+
+    def scan_local(self) -> Dict[str, FileState]:
+        """递归扫描本地目录"""
+        files = {}
+        root = Path(self.profile.local_path)
+        if not root.is_dir():
+            return files
+
+        stack = [('', str(root))]
+        while stack:
+            rel_dir, abs_dir = stack.pop()
+            try:
+                with os.scandir(abs_dir) as it:
+                    for entry in it:
+                        rel = f"{rel_dir}/{entry.name}" if rel_dir else entry.name
+                        if entry.is_dir(follow_symlinks=False):
+                            if not self._excluded(rel, entry.name):
+                                stack.append((rel, entry.path))
+                        elif entry.name.endswith(PART_SUFFIX):
+                            continue   # 中断的下载留下的未完成文件
+                        elif entry.is_file() and self._included(rel, entry.name):
+                            st = entry.stat()
+                            files[rel] = FileState(st.st_size, st.st_mtime)
+            except OSError as e:
+                self.scan_errors.append(f"本地 {abs_dir}: {e}")
+        return files
+
+    def scan_remote(self) -> Dict[str, FileState]:
+        """多个列表连接并行遍历远程目录树 (MLSD直接带回大小和时间)"""
+        files = {}
+        root = ListingCache.normalize(self.profile.remote_path)
+        dir_queue = queue.Queue()
+        dir_queue.put('')
+
+        threads = [threading.Thread(target=self._walk_worker, args=(root, dir_queue, files), daemon=True)
+                   for _ in range(max(1, self.walkers))]
+        for t in threads:
+            t.start()
+        dir_queue.join()
+        for _ in threads:
+            dir_queue.put(None)
+        for t in threads:
+            t.join()
+        return files
+
+    def _walk_worker(self, root, dir_queue, files):
+        while True:
+            connected = False
+            try:
+                with self.connection_factory() as ftp:
+                    connected = True
+                    lister = ListingEngine(ftp)
+                    while True:
+                        rel = dir_queue.get()
+                        try:
+                            if rel is None:
+                                return
+                            self._scan_remote_dir(ftp, lister, root, rel, dir_queue, files)
+                        except ftplib.error_perm as e:
+                            self._record_error(f"远程 /{rel}: {e}")
+                        except Exception as e:
+                            # 连接出错时丢弃该会话，重连后继续处理其他目录
+                            self._record_error(f"远程 /{rel}: {e}")
+                            raise
+                        finally:
+                            dir_queue.task_done()
+            except Exception as e:
+                if connected:
+                    continue
+                # 无法建立连接时也要消耗一个目录，保证遍历一定能结束
+                rel = dir_queue.get()
+                if rel is not None:
+                    self._record_error(f"远程 /{rel}: {e}")
+                dir_queue.task_done()
+                if rel is None:
+                    return
+
+    def _scan_remote_dir(self, ftp, lister, root, rel, dir_queue, files):
+        ftp.cwd(self._remote_path(root, rel))
+        for entry in lister.list_dir():
+            if '/' in entry.name or entry.name in ('.', '..'):
+                continue
+            child = f"{rel}/{entry.name}" if rel else entry.name
+            if entry.is_dir:
+                if not self._excluded(child, entry.name):
+                    dir_queue.put(child)
+            elif self._included(child, entry.name):
+                with self._lock:
+                    files[child] = FileState(entry.size, entry.mtime)
+
+    def _record_error(self, message):
+        with self._lock:
+            self.scan_errors.append(message)
+        self.log(f"扫描失败: {message}")
+
+    @staticmethod
+    def _remote_path(root, rel):
+        if not rel:
+            return root
+        return root.rstrip('/') + '/' + rel
+
+    # ---------- 对比 ----------
+
+    def plan(self) -> SyncPlan:
+        """扫描两端并与上次清单对比，生成同步计划"""
+        self.scan_errors = []
+        self.previous = self.load_manifest()
+        self.local = self.scan_local()
+        self.remote = self.scan_remote()
+        plan = diff_trees(self.remote, self.local, self.previous,
+                          self.profile.sync_mode, self.profile.delete_extra)
+        if self.scan_errors and (plan.delete_local or plan.delete_remote):
+            # 扫描不完整时删除判断不可靠，本次不做任何删除
+            self.log(f"扫描出现 {len(self.scan_errors)} 个错误，跳过删除操作")
+            plan.delete_local.clear()
+            plan.delete_remote.clear()
+        return plan
+
+    # ---------- 执行 ----------
+
+    def execute(self, plan: SyncPlan, progress=None) -> dict:
+        """执行同步计划并更新清单，返回本次同步的统计记录
+
+        progress(已完成数, 总数, 路径) 在工作线程中调用
+        """
+        start_time = time.time()
+        jobs = queue.Queue()
+        for rel in plan.downloads:
+            jobs.put(('download', rel))
+        for rel in plan.uploads:
+            jobs.put(('upload', rel))
+        for rel in plan.delete_local:
+            jobs.put(('delete_local', rel))
+        for rel in plan.delete_remote:
+            jobs.put(('delete_remote', rel))
+
+        results = {}  # 路径 -> 新的清单记录，删除成功为None
+        failed = []
+        counters = {'done': 0, 'bytes': 0}
+        created_dirs = set()
+
+        def worker():
+            while True:
+                try:
+                    action, rel = jobs.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    with self.connection_factory() as ftp:
+                        entry, size = self._run_action(ftp, action, rel, created_dirs)
+                    with self._lock:
+                        results[rel] = entry
+                        counters['bytes'] += size
+                except Exception as e:
+                    self.log(f"同步失败 {rel}: {e}")
+                    with self._lock:
+                        failed.append(rel)
+                with self._lock:
+                    counters['done'] += 1
+                    done = counters['done']
+                if progress:
+                    progress(done, plan.total, rel)
+
+        threads = [threading.Thread(target=worker, daemon=True)
+                   for _ in range(max(1, min(self.workers, plan.total)))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.save_manifest(self._merge_manifest(results, failed))
+
+        record = {
+            'profile': self.profile.name,
+            'time': datetime_text(start_time),
+            'mode': self.profile.sync_mode,
+            'downloaded': len(plan.downloads),
+            'uploaded': len(plan.uploads),
+            'deleted': len(plan.delete_local) + len(plan.delete_remote),
+            'unchanged': plan.unchanged,
+            'conflicts': plan.conflicts,
+            'failed': len(failed),
+            'bytes': counters['bytes'],
+            'duration': round(time.time() - start_time, 2),
+            'errors': len(self.scan_errors),
+        }
+        append_history(record, self.state_dir)
+        return record
+
+    def _run_action(self, ftp, action, rel, created_dirs):
+        """执行单个同步动作，返回 (新的清单记录, 传输字节数)"""
+        root = ListingCache.normalize(self.profile.remote_path)
+        remote_path = self._remote_path(root, rel)
+        local_path = Path(self.profile.local_path) / rel
+
+        if action == 'download':
+            state = self.remote[rel]
+            local_path.parent.mkdir(parents=True, exist_ok=True)
+            # 写入 .part 文件后再替换，同步过程中本地的旧版本保持完整
+            part = part_path(local_path)
+            with open_part(part, 0, state.size) as f:
+                retrieve_file(ftp, remote_path, f)
+            commit_part(part, local_path, state.size)
+            if self.profile.preserve_timestamps and state.mtime is not None:
+                os.utime(local_path, (state.mtime, state.mtime))
+            st = local_path.stat()
+            return ManifestEntry(state.size, state.mtime, st.st_mtime), state.size
+
+        if action == 'upload':
+            state = self.local[rel]
+            self._ensure_remote_dirs(ftp, root, rel, created_dirs)
+            # 远程文件可能是旧版本，不能按大小续传，整个文件重新上传
+            with open(local_path, 'rb') as f:
+                store_file(ftp, remote_path, f)
+            remote_mtime = None
+            if self.profile.preserve_timestamps and state.mtime is not None:
+                remote_mtime = self._set_remote_mtime(ftp, remote_path, state.mtime)
+            if remote_mtime is None:
+                remote_mtime = self._remote_mtime(ftp, remote_path)
+            return ManifestEntry(state.size, remote_mtime, state.mtime), state.size
+
+        if action == 'delete_local':
+            local_path.unlink()
+            return None, 0
+
+        if action == 'delete_remote':
+            ftp.delete(remote_path)
+            return None, 0
+
+        raise ValueError(f"未知的同步动作: {action}")
+
+    def _ensure_remote_dirs(self, ftp, root, rel, created_dirs):
+        parts = rel.split('/')[:-1]
+        for i in range(1, len(parts) + 1):
+            path = self._remote_path(root, '/'.join(parts[:i]))
+            with self._lock:
+                if path in created_dirs:
+                    continue
+            try:
+                ftp.mkd(path)
+            except ftplib.error_perm:
+                pass  # 目录已存在
+            with self._lock:
+                created_dirs.add(path)
+
+    @staticmethod
+    def _set_remote_mtime(ftp, remote_path, mtime):
+        """用MFMT保持远程时间戳，服务器不支持时返回None"""
+        stamp = time.strftime('%Y%m%d%H%M%S', time.gmtime(mtime))
+        try:
+            ftp.sendcmd(f'MFMT {stamp} {remote_path}')
+            return float(int(mtime))
+        except ftplib.all_errors:
+            return None
+
+    @staticmethod
+    def _remote_mtime(ftp, remote_path):
+        """上传后用MDTM取回服务器记录的时间，下次同步据此判断是否变化"""
+        try:
+            resp = ftp.sendcmd(f'MDTM {remote_path}')
+            return float(calendar.timegm(time.strptime(resp[4:18], '%Y%m%d%H%M%S')))
+        except (ftplib.all_errors, ValueError):
+            return None
+
+    def _merge_manifest(self, results, failed):
+        """新清单 = 两端都存在的未变化文件 + 本次成功传输的文件；失败的保留旧记录"""
+        manifest = {}
+        for rel in set(self.remote) & set(self.local):
+            r, l = self.remote[rel], self.local[rel]
+            if r.size == l.size:
+                manifest[rel] = ManifestEntry(r.size, r.mtime, l.mtime)
+        for rel in failed:
+            manifest.pop(rel, None)
+            if rel in self.previous:
+                manifest[rel] = self.previous[rel]
+        for rel, entry in results.items():
+            if entry is None:
+                manifest.pop(rel, None)
+            else:
+                manifest[rel] = entry
+        return manifest
+
+
+def _same_time(a: Optional[float], b: Optional[float]) -> bool:
+    if a is None or b is None:
+        return a is None and b is None
+    return abs(a - b) < MTIME_TOLERANCE
+
+
+def _unchanged(prev: Optional[ManifestEntry], remote: FileState, local: FileState) -> bool:
+    """两端都与上次同步完成时一致"""
+    return (prev is not None
+            and remote.size == prev.size and _same_time(remote.mtime, prev.remote_mtime)
+            and local.size == prev.size and _same_time(local.mtime, prev.local_mtime))
+
+
+def _identical(remote: FileState, local: FileState) -> bool:
+    """没有清单记录时，大小相同且时间一致也视为相同 (例如之前镜像下载过)"""
+    return remote.size == local.size and remote.mtime is not None and _same_time(remote.mtime, local.mtime)
+
+
+def diff_trees(remote: Dict[str, FileState], local: Dict[str, FileState],
+               previous: Dict[str, ManifestEntry], mode: str = "download",
+               delete_extra: bool = False) -> SyncPlan:
+    """三方对比远程快照、本地快照和上次清单
+
+    mode: download 以远程为准，upload 以本地为准，bidirectional 双向合并
+    """
+    plan = SyncPlan()
+
+    if mode == "download":
+        for rel, r in remote.items():
+            l = local.get(rel)
+            if l is not None and (_unchanged(previous.get(rel), r, l) or _identical(r, l)):
+                plan.unchanged += 1
+            else:
+                plan.downloads.append(rel)
+        if delete_extra:
+            plan.delete_local.extend(rel for rel in local if rel not in remote)
+
+    elif mode == "upload":
+        for rel, l in local.items():
+            r = remote.get(rel)
+            if r is not None and (_unchanged(previous.get(rel), r, l) or _identical(r, l)):
+                plan.unchanged += 1
+            else:
+                plan.uploads.append(rel)
+        if delete_extra:
+            plan.delete_remote.extend(rel for rel in remote if rel not in local)
+
+    elif mode == "bidirectional":
+        for rel in set(remote) | set(local):
+            r, l, p = remote.get(rel), local.get(rel), previous.get(rel)
+            if r is not None and l is not None:
+                if _unchanged(p, r, l) or _identical(r, l):
+                    plan.unchanged += 1
+                    continue
+                remote_changed = p is None or r.size != p.size or not _same_time(r.mtime, p.remote_mtime)
+                local_changed = p is None or l.size != p.size or not _same_time(l.mtime, p.local_mtime)
+                if remote_changed and not local_changed:
+                    plan.downloads.append(rel)
+                elif local_changed and not remote_changed:
+                    plan.uploads.append(rel)
+                else:
+                    # 两端都改过：保留较新的版本
+                    plan.conflicts += 1
+                    if (r.mtime or 0) >= (l.mtime or 0):
+                        plan.downloads.append(rel)
+                    else:
+                        plan.uploads.append(rel)
+            elif r is not None:
+                # 上次同步时存在、现在本地没有：本地删除了它
+                if p is not None and delete_extra:
+                    plan.delete_remote.append(rel)
+                else:
+                    plan.downloads.append(rel)
+            else:
+                if p is not None and delete_extra:
+                    plan.delete_local.append(rel)
+                else:
+                    plan.uploads.append(rel)
+    else:
+        raise ValueError(f"未知的同步模式: {mode}")
+
+    for paths in (plan.downloads, plan.uploads, plan.delete_local, plan.delete_remote):
+        paths.sort()
+    return plan
+
+
+def datetime_text(timestamp: float) -> str:
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp))
+
+
+def load_history(state_dir=".") -> List[dict]:
+    """读取同步历史 (最新的在最后)"""
+    try:
+        with open(Path(state_dir) / HISTORY_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return []
+
+
+def append_history(record: dict, state_dir="."):
+    history = load_history(state_dir)
+    history.append(record)
+    with open(Path(state_dir) / HISTORY_FILE, 'w', encoding='utf-8') as f:
+        json.dump(history[-HISTORY_LIMIT:], f, ensure_ascii=False, indent=2)
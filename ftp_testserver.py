@@ -0,0 +1,414 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+本机FTP测试服务器
+在当前进程的线程中运行的小型FTP服务器，提供一个本地目录中的文件，基准测试和离线测试用它代替公共服务器。
+可以模拟网络和服务器的限制：
+  latency       每条控制命令回复前的等待时间 (秒)，相当于一次往返的延迟
+  bandwidth     所有数据连接合计的发送速度上限 (字节/秒)，0 表示不限速
+  max_sessions  同时连接的会话数上限，超出时回复 421 后断开 (与常见服务器的行为一致)
+支持本项目下载、列表、校验和上传用到的命令：USER/PASS、FEAT、SIZE、MDTM、REST、EPSV/PASV、
+RETR/STOR/APPE、LIST/NLST/MLSD、CWD/CDUP/PWD、HASH、MKD/DELE；不校验用户名和密码
+"""
+
+import os
+import sys
+import time
+import socket
+import hashlib
+import argparse
+import posixpath
+import threading
+import socketserver
+from typing import Optional
+
+from ftp_ratelimit import RateLimiter, TokenBucket, parse_rate
+
+SEND_CHUNK = 256 * 1024
+DATA_TIMEOUT = 30
+MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+HASHES = {'SHA-256': 'sha256', 'SHA-1': 'sha1', 'MD5': 'md5'}
+
+
+class _Session(socketserver.StreamRequestHandler):
+    """一个控制连接"""
+
+    # 150 和 226 两条回复紧接着发送，开着 Nagle 算法时第二条要等客户端的延迟确认 (约40ms)
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.ftp_server: 'LocalFTPServer' = self.server.owner
+        self.cwd = '/'
+        self.rest = 0
+        self.pasv: Optional[socket.socket] = None
+        self.hash_name = 'SHA-256'
+
+    def handle(self):
+        owner = self.ftp_server
+        if not owner._enter():
+            self.reply('421 Too many connections, try again later')
+            return
+        try:
+            self.reply('220 pythonFtp test server ready')
+            while True:
+                line = self.rfile.readline()
+                if not line:
+                    return
+                cmd, _, arg = line.decode('utf-8', 'replace').rstrip('\r\n').partition(' ')
+                cmd = cmd.upper()
+                owner._count('commands')
+                if owner.latency:
+                    time.sleep(owner.latency)
+                handler = getattr(self, 'ftp_' + cmd, None)
+                if handler is None:
+                    self.reply(f'502 {cmd} not implemented')
+                elif handler(arg) is False:
+                    return
+        except OSError:
+            pass
+        finally:
+            if self.pasv is not None:
+                self.pasv.close()
+            owner._leave()
+
+    def reply(self, text: str):
+        self.wfile.write(text.encode('utf-8') + b'\r\n')
+        self.wfile.flush()
+
+    def real_path(self, path: str) -> str:
+        """FTP路径 -> 本地路径 (normpath 去掉 ..，不会越出根目录)"""
+        path = posixpath.normpath(posixpath.join(self.cwd, path or '.'))
+        return os.path.join(self.ftp_server.root, path.lstrip('/'))
+
+    # ---------- 会话 ----------
+
+    def ftp_USER(self, arg):
+        self.reply('331 Password required')
+
+    def ftp_PASS(self, arg):
+        self.reply('230 Logged in')
+
+    def ftp_QUIT(self, arg):
+        self.reply('221 Goodbye')
+        return False
+
+    def ftp_NOOP(self, arg):
+        self.reply('200 OK')
+
+    def ftp_SYST(self, arg):
+        self.reply('215 UNIX Type: L8')
+
+    def ftp_TYPE(self, arg):
+        self.reply(f'200 Type set to {arg}')
+
+    def ftp_FEAT(self, arg):
+        owner = self.ftp_server
+        lines = [' SIZE', ' MDTM', ' EPSV', ' PASV', ' UTF8']
+        if owner.rest:
+            lines.append(' REST STREAM')
+        if owner.mlsd:
+            lines.append(' MLST type*;size*;modify*;')
+        if owner.hash:
+            lines.append(' HASH ' + ';'.join(n + ('*' if n == self.hash_name else '') for n in HASHES))
+        self.reply('211-Features:\r\n' + '\r\n'.join(lines) + '\r\n211 End')
+
+    def ftp_OPTS(self, arg):
+        name, _, value = arg.partition(' ')
+        if name.upper() == 'HASH':
+            if value.upper() not in HASHES:
+                self.reply('501 Unknown algorithm')
+                return
+            self.hash_name = value.upper()
+        self.reply('200 OK')
+
+    # ---------- 目录 ----------
+
+    def ftp_PWD(self, arg):
+        self.reply(f'257 "{self.cwd}" is the current directory')
+
+    def ftp_CWD(self, arg):
+        if os.path.isdir(self.real_path(arg)):
+            self.cwd = posixpath.normpath(posixpath.join(self.cwd, arg))
+            self.reply('250 OK')
+        else:
+            self.reply('550 No such directory')
+
+    def ftp_CDUP(self, arg):
+        return self.ftp_CWD('..')
+
+    def ftp_MKD(self, arg):
+        try:
+            os.mkdir(self.real_path(arg))
+            self.reply(f'257 "{arg}" created')
+        except OSError as e:
+            self.reply(f'550 {e.strerror}')
+
+    def ftp_DELE(self, arg):
+        try:
+            os.remove(self.real_path(arg))
+            self.reply('250 Deleted')
+        except OSError as e:
+            self.reply(f'550 {e.strerror}')
+
+    # ---------- 文件信息 ----------
+
+    def ftp_SIZE(self, arg):
+        path = self.real_path(arg)
+        if os.path.isfile(path):
+            self.reply(f'213 {os.path.getsize(path)}')
+        else:
+            self.reply('550 No such file')
+
+    def ftp_MDTM(self, arg):
+        path = self.real_path(arg)
+        if os.path.isfile(path):
+            self.reply('213 ' + time.strftime('%Y%m%d%H%M%S', time.gmtime(os.path.getmtime(path))))
+        else:
+            self.reply('550 No such file')
+
+    def ftp_HASH(self, arg):
+        path = self.real_path(arg)
+        if not self.ftp_server.hash or not os.path.isfile(path):
+            self.reply('550 Cannot hash file')
+            return
+        digest = hashlib.new(HASHES[self.hash_name])
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(SEND_CHUNK), b''):
+                digest.update(block)
+        self.reply(f'213 {self.hash_name} 0-{os.path.getsize(path)} {digest.hexdigest()} {arg}')
+
+    # ---------- 数据连接 ----------
+
+    def _listen(self) -> int:
+        if self.pasv is not None:
+            self.pasv.close()
+        self.pasv = socket.create_server((self.ftp_server.host, 0), backlog=1)
+        self.pasv.settimeout(DATA_TIMEOUT)
+        return self.pasv.getsockname()[1]
+
+    def ftp_PASV(self, arg):
+        port = self._listen()
+        host = self.ftp_server.host.replace('.', ',')
+        self.reply(f'227 Entering Passive Mode ({host},{port >> 8},{port & 255})')
+
+    def ftp_EPSV(self, arg):
+        self.reply(f'229 Entering Extended Passive Mode (|||{self._listen()}|)')
+
+    def ftp_REST(self, arg):
+        if not self.ftp_server.rest:
+            self.reply('502 REST not supported')
+            return
+        self.rest = int(arg)
+        self.reply(f'350 Restarting at {self.rest}')
+
+    def _transfer(self, send):
+        """接受数据连接并调用 send(conn)，结束后回复 226"""
+        if self.pasv is None:
+            self.reply('425 Use PASV or EPSV first')
+            return
+        self.reply('150 Opening data connection')
+        try:
+            conn, _ = self.pasv.accept()
+        except OSError:
+            self.reply('425 Cannot open data connection')
+            return
+        finally:
+            self.pasv.close()
+            self.pasv = None
+            rest, self.rest = self.rest, 0
+        try:
+            with conn:
+                conn.settimeout(DATA_TIMEOUT)
+                send(conn, rest)
+        except OSError:
+            self.reply('426 Connection closed; transfer aborted')
+            return
+        self.reply('226 Transfer complete')
+
+    def ftp_RETR(self, arg):
+        path = self.real_path(arg)
+        if not os.path.isfile(path):
+            self.reply('550 No such file')
+            return
+
+        def send(conn, rest):
+            with open(path, 'rb') as f:
+                self.ftp_server._send_file(conn, f, rest)
+
+        self._transfer(send)
+
+    def _store(self, arg, append):
+        path = self.real_path(arg)
+
+        def receive(conn, rest):
+            with open(path, 'ab' if append else ('r+b' if rest and os.path.exists(path) else 'wb')) as f:
+                if rest and not append:
+                    f.seek(rest)
+                    f.truncate()
+                for block in iter(lambda: conn.recv(SEND_CHUNK), b''):
+                    f.write(block)
+
+        self._transfer(receive)
+
+    def ftp_STOR(self, arg):
+        self._store(arg, False)
+
+    def ftp_APPE(self, arg):
+        self._store(arg, True)
+
+    def _listing(self, arg, format_line):
+        path = self.real_path(' '.join(a for a in arg.split() if not a.startswith('-')))
+        if not os.path.isdir(path):
+            self.reply('550 No such directory')
+            return
+        lines = []
+        with os.scandir(path) as it:
+            for entry in sorted(it, key=lambda e: e.name):
+                lines.append(format_line(entry, entry.stat()))
+        data = ''.join(line + '\r\n' for line in lines).encode('utf-8')
+        self._transfer(lambda conn, rest: self.ftp_server._send_bytes(conn, data))
+
+    def ftp_MLSD(self, arg):
+        if not self.ftp_server.mlsd:
+            self.reply('500 MLSD not supported')
+            return
+        self._listing(arg, lambda e, st: (
+            f"type={'dir' if e.is_dir() else 'file'};size={st.st_size};"
+            f"modify={time.strftime('%Y%m%d%H%M%S', time.gmtime(st.st_mtime))}; {e.name}"))
+
+    def ftp_LIST(self, arg):
+        def line(e, st):
+            t = time.gmtime(st.st_mtime)
+            stamp = f"{MONTHS[t.tm_mon - 1]} {t.tm_mday:2d} {t.tm_hour:02d}:{t.tm_min:02d}"
+            return f"{'d' if e.is_dir() else '-'}rw-r--r-- 1 ftp ftp {st.st_size:>12} {stamp} {e.name}"
+        self._listing(arg, line)
+
+    def ftp_NLST(self, arg):
+        self._listing(arg, lambda e, st: e.name)
+
+
+class _Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 1024
+
+
+class LocalFTPServer:
+    """在后台线程中运行的FTP服务器，root 为提供文件的本地目录
+
+    with LocalFTPServer(root, latency=0.02, bandwidth=50 * 1024 ** 2) as server:
+        host, port = server.address
+    """
+
+    def __init__(self, root, host: str = '127.0.0.1', port: int = 0, latency: float = 0.0,
+                 bandwidth: int = 0, max_sessions: int = 0, rest: bool = True, mlsd: bool = True,
+                 hash: bool = True):
+        self.root = os.path.abspath(root)
+        self.host = host
+        self.latency = latency
+        self.max_sessions = max_sessions
+        self.rest = rest
+        self.mlsd = mlsd
+        self.hash = hash
+        self.bucket = TokenBucket(bandwidth)
+        self.stats = {'sessions': 0, 'peak_sessions': 0, 'rejected': 0, 'commands': 0, 'bytes_sent': 0}
+        self._lock = threading.Lock()
+        self._active = 0
+        self._server = _Server((host, port), _Session)
+        self._server.owner = self
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def address(self):
+        return self._server.server_address[:2]
+
+    def start(self) -> 'LocalFTPServer':
+        self._thread = threading.Thread(target=self._server.serve_forever, args=(0.1,), daemon=True,
+                                        name='ftp-testserver')
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def set_bandwidth(self, rate: int):
+        """修改带宽上限，立即对正在进行的传输生效"""
+        self.bucket.set_rate(rate)
+
+    def _enter(self) -> bool:
+        with self._lock:
+            if self.max_sessions and self._active >= self.max_sessions:
+                self.stats['rejected'] += 1
+                return False
+            self._active += 1
+            self.stats['sessions'] += 1
+            self.stats['peak_sessions'] = max(self.stats['peak_sessions'], self._active)
+            return True
+
+    def _leave(self):
+        with self._lock:
+            self._active -= 1
+
+    def _count(self, key: str, n: int = 1):
+        with self._lock:
+            self.stats[key] += n
+
+    def _send_file(self, conn: socket.socket, f, offset: int):
+        """不限速时用 sendfile 发送，限速时按令牌桶分块发送"""
+        if not self.bucket.rate:
+            self._count('bytes_sent', conn.sendfile(f, offset))
+            return
+        f.seek(offset)
+        limiter = RateLimiter(self.bucket)
+        while True:
+            block = f.read(limiter.chunk_size(SEND_CHUNK))
+            if not block:
+                return
+            limiter.throttle(len(block))
+            conn.sendall(block)
+            self._count('bytes_sent', len(block))
+
+    def _send_bytes(self, conn: socket.socket, data: bytes):
+        limiter = RateLimiter(self.bucket)
+        view = memoryview(data)
+        while view:
+            block = view[:limiter.chunk_size(SEND_CHUNK)]
+            limiter.throttle(len(block))
+            conn.sendall(block)
+            view = view[len(block):]
+        self._count('bytes_sent', len(data))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='本机FTP测试服务器')
+    parser.add_argument('root', help='提供文件的本地目录')
+    parser.add_argument('--host', default='127.0.0.1', help='监听地址 (默认127.0.0.1)')
+    parser.add_argument('-p', '--port', type=int, default=2121, help='监听端口 (默认2121)')
+    parser.add_argument('--latency', type=float, default=0.0, help='每条命令回复前的延迟 (毫秒)')
+    parser.add_argument('--bandwidth', default='0', help='合计发送速度上限，如 10M (默认不限速)')
+    parser.add_argument('--max-sessions', type=int, default=0, help='同时连接的会话数上限 (默认不限制)')
+    parser.add_argument('--no-rest', action='store_true', help='不支持REST (测试单连接回退)')
+    parser.add_argument('--no-mlsd', action='store_true', help='不支持MLSD (测试LIST解析)')
+    args = parser.parse_args()
+
+    server = LocalFTPServer(args.root, args.host, args.port, args.latency / 1000, parse_rate(args.bandwidth),
+                            args.max_sessions, rest=not args.no_rest, mlsd=not args.no_mlsd)
+    host, port = server.address
+    print(f"📡 FTP测试服务器: ftp://{host}:{port}/ -> {server.root}")
+    try:
+        server.start()._thread.join()
+    except KeyboardInterrupt:
+        server.stop()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
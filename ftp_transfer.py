@@ -0,0 +1,505 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+高速数据接收通道
+用 recv_into 把数据连接上的数据直接读进预先分配的大缓冲区，缓冲区满时整块写入文件；
+进度按时间间隔采样，而不是每收到一小块数据就回调一次；
+自适应模式下按实测吞吐量调整每次读取的块大小和套接字接收缓冲区 (SO_RCVBUF)；
+Linux 上可选用 splice 模式，数据经管道从套接字直接移入文件，不复制到用户态；
+上传方向用 sendfile 把文件直接发送到数据连接，不经过用户态缓冲区
+"""
+
+import os
+import mmap
+import stat
+import time
+import select
+import socket
+import ftplib
+from typing import Callable, List, Optional, Tuple
+
+try:
+    import ssl
+    _SSLSocket = ssl.SSLSocket
+except ImportError:
+    _SSLSocket = None
+
+DEFAULT_BUFFER_SIZE = 1024 * 1024   # 1 MiB，64 KiB的整数倍
+PROGRESS_INTERVAL = 0.25             # 进度回调的最小间隔 (秒)
+
+ADAPTIVE = 'auto'                    # 块大小参数取此值时启用自适应模式
+ADAPTIVE_MIN_BLOCK = 16 * 1024
+ADAPTIVE_MAX_BLOCK = 8 * 1024 * 1024
+ADAPTIVE_SAMPLE_INTERVAL = 0.5       # 吞吐量采样间隔 (秒)
+
+SPLICE = 'splice'                    # 块大小参数取此值时用 os.splice 接收 (仅 Linux，其他情况退回普通接收)
+SPLICE_PIPE_SIZE = 1024 * 1024       # 管道容量，即每次 splice 最多移动的字节数
+SPLICE_HASH_WINDOW = 4 * 1024 * 1024  # 需要计算哈希时，每写入这么多数据映射一次文件交给哈希
+
+
+class AdaptiveBlockSizer:
+    """按实测吞吐量调整接收块大小 (爬山法)
+
+    从较小的块开始，每个采样周期统计吞吐量和 recv 调用次数：
+    吞吐量提升就继续沿同一方向把块大小翻倍/减半，下降就反向；
+    折返两次后锁定在测得吞吐量最高的块大小。
+    块大小同时决定每次写文件的数据量，SO_RCVBUF 设为块大小的两倍 (只增不减，
+    避免把内核已自动调大的缓冲区改小)。
+    一个实例只用于一条数据连接；history 记录 (耗时, 块大小, 字节/秒) 吞吐曲线
+    """
+
+    GAIN = 1.05       # 吞吐量变化超过5%才认为有差别
+    MAX_REVERSALS = 2
+
+    def __init__(self, initial: int = 64 * 1024, min_size: int = ADAPTIVE_MIN_BLOCK,
+                 max_size: int = ADAPTIVE_MAX_BLOCK,
+                 sample_interval: float = ADAPTIVE_SAMPLE_INTERVAL,
+                 log: Optional[Callable[[str], None]] = None):
+        self.min_size = max(4096, int(min_size))
+        self.max_size = max(self.min_size, int(max_size))
+        self.block_size = min(self.max_size, max(self.min_size, int(initial)))
+        self.sample_interval = sample_interval
+        self.log = log
+        self.history: List[Tuple[float, int, float]] = []
+        self.best: Optional[Tuple[int, float]] = None   # (块大小, 字节/秒)
+        self.locked = False
+        self._direction = 1
+        self._reversals = 0
+        self._last_rate = None
+        self._sock = None
+        self._rcvbuf = 0
+        self._started = time.monotonic()
+
+    def attach(self, sock):
+        """开始一条数据连接：记录内核当前的接收缓冲区大小并按当前块大小设置
+
+        同一实例可以依次用于同一服务器的多条连接，已锁定的块大小会沿用
+        """
+        self._sock = sock
+        try:
+            self._rcvbuf = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+        except (AttributeError, OSError):
+            self._sock = None
+        self._apply_rcvbuf()
+
+    def sample(self, elapsed: float, nbytes: int, calls: int) -> int:
+        """提交一个采样周期的统计，返回新的块大小"""
+        if elapsed <= 0 or calls == 0:
+            return self.block_size
+        rate = nbytes / elapsed
+        size = self.block_size
+        self.history.append((time.monotonic() - self._started, size, rate))
+        if self.best is None or rate > self.best[1]:
+            self.best = (size, rate)
+        if self.locked:
+            return size
+
+        last = self._last_rate
+        self._last_rate = rate
+        if last is not None and rate * self.GAIN < last:
+            # 上一步调整让吞吐量变差，反向
+            self._direction = -self._direction
+            self._reversals += 1
+            if self._reversals >= self.MAX_REVERSALS:
+                return self._lock()
+
+        if self._direction > 0 and nbytes < calls * size // 2:
+            # recv 平均填不满半个块，瓶颈在网络而不是调用开销，再加大块没有意义
+            return self._lock()
+        new_size = size * 2 if self._direction > 0 else size // 2
+        new_size = min(self.max_size, max(self.min_size, new_size))
+        if new_size == size:
+            return self._lock()
+        self._set(new_size)
+        self._emit(f"块大小 {format_size(size)} -> {format_size(new_size)} "
+                   f"(当前 {format_rate(rate)})")
+        return new_size
+
+    def summary(self) -> str:
+        """块大小选择结果和吞吐曲线，一行文本"""
+        if not self.history:
+            return f"自适应缓冲: 块大小 {format_size(self.block_size)} (传输过短，未调整)"
+        curve = ", ".join(f"{t:.1f}s {format_size(size)} {format_rate(rate)}"
+                          for t, size, rate in self.history)
+        return f"自适应缓冲: 块大小 {format_size(self.block_size)}，吞吐曲线: {curve}"
+
+    def _lock(self) -> int:
+        self._set(self.best[0])
+        self.locked = True
+        self._emit(f"锁定块大小 {format_size(self.block_size)} ({format_rate(self.best[1])})")
+        return self.block_size
+
+    def _set(self, size: int):
+        self.block_size = size
+        self._apply_rcvbuf()
+
+    def _apply_rcvbuf(self):
+        wanted = self.block_size * 2
+        if self._sock is None or wanted <= self._rcvbuf:
+            return
+        try:
+            self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, wanted)
+            self._rcvbuf = self._sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+        except OSError:
+            self._sock = None
+
+    def _emit(self, message: str):
+        if self.log is not None:
+            self.log(message)
+
+
+def format_size(size: int) -> str:
+    if size >= 1024 * 1024:
+        return f"{size / (1024 * 1024):g}MB"
+    return f"{size // 1024}KB"
+
+
+def format_rate(rate: float) -> str:
+    return f"{rate / (1024 * 1024):.1f}MB/s"
+
+
+def receive_into(conn, fileobj, buffer_size=DEFAULT_BUFFER_SIZE, limit=None,
+                 progress=None, interval=PROGRESS_INTERVAL, tuner=None, limiter=None, hasher=None):
+    """从已建立的数据连接读取数据写入 fileobj，返回写入的字节数
+
+    limit 限制最多读取的字节数 (分段下载用)；
+    progress(已写入字节数) 按 interval 采样调用，调用前先把缓冲区写入文件，
+    因此回调看到的字节数一定已经落盘；回调返回 False 时停止接收；
+    tuner 为 AdaptiveBlockSizer 时块大小由它按吞吐量调整，忽略 buffer_size；
+    limiter 为 ftp_ratelimit.RateLimiter 时每次读取后按限速等待；
+    hasher 为 ftp_integrity.StreamHash 时写入文件的数据同时计入哈希；
+    buffer_size 为 SPLICE 且 splice_supported() 时改用 splice_into
+    """
+    if buffer_size == SPLICE:
+        if tuner is None and splice_supported(conn, fileobj):
+            return splice_into(conn, fileobj, limit, progress, interval, limiter, hasher)
+        buffer_size = DEFAULT_BUFFER_SIZE
+    if tuner is not None:
+        tuner.attach(conn)
+        block = tuner.block_size
+    else:
+        block = max(4096, int(buffer_size))
+    buf = bytearray(block)
+    view = memoryview(buf)
+    filled = 0
+    written = 0
+    remaining = limit
+    last_report = sample_start = time.monotonic()
+    sample_bytes = sample_calls = 0
+
+    try:
+        while remaining is None or remaining > 0:
+            want = block - filled
+            if remaining is not None and remaining < want:
+                want = remaining
+            if limiter is not None:
+                want = limiter.chunk_size(want)
+            n = conn.recv_into(view[filled:filled + want])
+            if not n:
+                break
+            if limiter is not None:
+                limiter.throttle(n)
+            filled += n
+            if remaining is not None:
+                remaining -= n
+
+            if tuner is not None:
+                sample_bytes += n
+                sample_calls += 1
+                now = time.monotonic()
+                if now - sample_start >= tuner.sample_interval:
+                    block = tuner.sample(now - sample_start, sample_bytes, sample_calls)
+                    sample_start = now
+                    sample_bytes = sample_calls = 0
+                    if block > len(buf):
+                        if filled:
+                            _write_all(fileobj, view[:filled], hasher)
+                            written += filled
+                            filled = 0
+                        view.release()
+                        buf = bytearray(block)
+                        view = memoryview(buf)
+
+            if filled >= block:
+                _write_all(fileobj, view[:filled], hasher)
+                written += filled
+                filled = 0
+
+            if progress is not None:
+                now = time.monotonic()
+                if now - last_report >= interval:
+                    last_report = now
+                    if filled:
+                        _write_all(fileobj, view[:filled], hasher)
+                        written += filled
+                        filled = 0
+                    if progress(written) is False:
+                        break
+
+        if filled:
+            _write_all(fileobj, view[:filled], hasher)
+            written += filled
+    finally:
+        view.release()
+
+    if progress is not None:
+        progress(written)
+    return written
+
+
+def splice_supported(conn, fileobj) -> bool:
+    """能否用 splice 接收：Linux、非TLS的数据连接、写入目标是普通文件"""
+    if not hasattr(os, 'splice') or (_SSLSocket is not None and isinstance(conn, _SSLSocket)):
+        return False
+    try:
+        return conn.fileno() >= 0 and stat.S_ISREG(os.fstat(fileobj.fileno()).st_mode)
+    except (AttributeError, OSError, ValueError):
+        return False
+
+
+def splice_into(conn, fileobj, limit=None, progress=None, interval=PROGRESS_INTERVAL,
+                limiter=None, hasher=None):
+    """用 os.splice 把数据连接上的数据经管道写入 fileobj 的当前位置，返回写入的字节数
+
+    数据在内核中从套接字缓冲区移到管道、再移到文件页缓存，不复制到用户态，
+    Python 只在每次移动最多 SPLICE_PIPE_SIZE 字节时执行一次循环。
+    hasher 需要看到数据，因此每写入 SPLICE_HASH_WINDOW 字节 (以及每次回调进度前)
+    把新写入的范围从页缓存只读映射出来交给 hasher，同样不经过 bytes 对象。
+    参数含义与 receive_into 相同；以追加模式打开的文件临时去掉 O_APPEND (splice 不能写入追加模式的文件)
+    """
+    import fcntl
+
+    if hasattr(fileobj, 'flush'):
+        fileobj.flush()
+    fd = fileobj.fileno()
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    if flags & os.O_APPEND:
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags & ~os.O_APPEND)
+        start = os.lseek(fd, 0, os.SEEK_END)
+    else:
+        start = os.lseek(fd, 0, os.SEEK_CUR)
+    sock = conn.fileno()
+    timeout = conn.gettimeout()
+    poller = select.poll()
+    poller.register(sock, select.POLLIN)
+
+    pipe_r, pipe_w = os.pipe()
+    reader = None
+    pos = hashed = start
+    try:
+        try:
+            fcntl.fcntl(pipe_w, fcntl.F_SETPIPE_SZ, SPLICE_PIPE_SIZE)
+        except (AttributeError, OSError):
+            pass  # 超过 /proc/sys/fs/pipe-max-size 时保持默认的 64KB
+        if hasher is not None:
+            # 写入目标可能是只写打开的，另开一个只读描述符用于映射
+            reader = os.open(f'/proc/self/fd/{fd}', os.O_RDONLY)
+
+        remaining = limit
+        last_report = time.monotonic()
+        while remaining is None or remaining > 0:
+            want = SPLICE_PIPE_SIZE if remaining is None else min(SPLICE_PIPE_SIZE, remaining)
+            if limiter is not None:
+                want = limiter.chunk_size(want)
+            try:
+                n = os.splice(sock, pipe_w, want, flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+            except BlockingIOError:
+                # 有超时的套接字是非阻塞的，等待数据到达
+                if not poller.poll(None if timeout is None else timeout * 1000):
+                    raise socket.timeout('timed out')
+                continue
+            if not n:
+                break
+            if limiter is not None:
+                limiter.throttle(n)
+            if remaining is not None:
+                remaining -= n
+            while n:
+                moved = os.splice(pipe_r, fd, n, offset_dst=pos, flags=os.SPLICE_F_MOVE)
+                pos += moved
+                n -= moved
+
+            if reader is not None and pos - hashed >= SPLICE_HASH_WINDOW:
+                hashed = _hash_range(reader, hashed, pos, hasher)
+            if progress is not None:
+                now = time.monotonic()
+                if now - last_report >= interval:
+                    last_report = now
+                    if reader is not None:
+                        hashed = _hash_range(reader, hashed, pos, hasher)
+                    if progress(pos - start) is False:
+                        break
+
+        if reader is not None:
+            _hash_range(reader, hashed, pos, hasher)
+    finally:
+        os.close(pipe_r)
+        os.close(pipe_w)
+        if reader is not None:
+            os.close(reader)
+        if flags & os.O_APPEND:
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags)
+        else:
+            os.lseek(fd, pos, os.SEEK_SET)
+
+    if progress is not None:
+        progress(pos - start)
+    return pos - start
+
+
+def _hash_range(fd, start, end, hasher) -> int:
+    """把文件 [start, end) 只读映射后交给 hasher，返回 end"""
+    if end <= start:
+        return start
+    base = start - start % mmap.ALLOCATIONGRANULARITY
+    with mmap.mmap(fd, end - base, access=mmap.ACCESS_READ, offset=base) as mapped:
+        with memoryview(mapped) as view, view[start - base:] as data:
+            hasher.update(data)
+    return end
+
+
+def retrieve_file(ftp, remote_path, fileobj, rest=None, buffer_size=DEFAULT_BUFFER_SIZE,
+                  progress=None, interval=PROGRESS_INTERVAL, tuner=None, limiter=None, hasher=None):
+    """以二进制模式下载 remote_path 写入 fileobj，rest 为续传起点；返回本次写入的字节数
+
+    替代 retrbinary：不为每个数据块创建bytes对象，也不逐块调用回调
+    """
+    stopped = False
+    report = None
+    if progress is not None:
+        def report(written):
+            nonlocal stopped
+            if progress(written) is False:
+                stopped = True
+                return False
+
+    ftp.voidcmd('TYPE I')
+    with ftp.transfercmd(f'RETR {remote_path}', rest) as conn:
+        received = receive_into(conn, fileobj, buffer_size, None, report, interval, tuner, limiter, hasher)
+        if not stopped and _SSLSocket is not None and isinstance(conn, _SSLSocket):
+            conn.unwrap()
+    try:
+        ftp.voidresp()
+    except ftplib.error_temp:
+        # 回调要求停止时提前关闭了数据连接，服务器会回复426
+        if not stopped:
+            raise
+    return received
+
+
+def retrieve_range(ftp, remote_path, fileobj, start, length, buffer_size=DEFAULT_BUFFER_SIZE,
+                   limiter=None, hasher=None):
+    """只下载 [start, start + length) 这一段写入 fileobj 的当前位置，返回写入的字节数
+
+    读够后提前关闭数据连接，服务器回复的426不算错误，控制连接可以继续使用
+    """
+    ftp.voidcmd('TYPE I')
+    with ftp.transfercmd(f'RETR {remote_path}', start) as conn:
+        received = receive_into(conn, fileobj, buffer_size, length, limiter=limiter, hasher=hasher)
+    try:
+        ftp.voidresp()
+    except ftplib.error_temp:
+        if received < length:
+            raise
+    return received
+
+
+def send_file(conn, fileobj, offset=0, count=None, buffer_size=DEFAULT_BUFFER_SIZE,
+              progress=None, interval=PROGRESS_INTERVAL, limiter=None):
+    """把 fileobj 中从 offset 开始的 count 字节 (默认到文件末尾) 发送到数据连接，返回发送的字节数
+
+    普通TCP连接用 socket.sendfile，支持 os.sendfile 的平台上由内核直接把页缓存发到套接字；
+    TLS连接和不支持 sendfile 的平台 (Windows) 把文件 mmap 到内存，按块发送内存视图，
+    同样不为每块数据创建 bytes 对象。
+    progress(已发送字节数) 按 interval 采样调用，返回 False 时停止发送；
+    limiter 为 ftp_ratelimit.RateLimiter 时每块发送后按限速等待
+    """
+    end = os.fstat(fileobj.fileno()).st_size
+    if count is not None:
+        end = min(end, offset + count)
+    if end <= offset:
+        if progress is not None:
+            progress(0)
+        return 0
+
+    block = max(4096, int(buffer_size))
+    use_sendfile = hasattr(os, 'sendfile') and not (_SSLSocket is not None and isinstance(conn, _SSLSocket))
+    mapped = view = None
+    if not use_sendfile:
+        mapped = mmap.mmap(fileobj.fileno(), end, access=mmap.ACCESS_READ)
+        view = memoryview(mapped)
+    pos = offset
+    last_report = time.monotonic()
+
+    try:
+        while pos < end:
+            want = min(block, end - pos)
+            if limiter is not None:
+                want = limiter.chunk_size(want)
+            if use_sendfile:
+                n = conn.sendfile(fileobj, pos, want)
+                if not n:
+                    break  # 文件在上传过程中被截短
+            else:
+                conn.sendall(view[pos:pos + want])
+                n = want
+            if limiter is not None:
+                limiter.throttle(n)
+            pos += n
+
+            if progress is not None:
+                now = time.monotonic()
+                if now - last_report >= interval:
+                    last_report = now
+                    if progress(pos - offset) is False:
+                        break
+    finally:
+        if view is not None:
+            view.release()
+            mapped.close()
+
+    if progress is not None:
+        progress(pos - offset)
+    return pos - offset
+
+
+def store_file(ftp, remote_path, fileobj, rest=None, append=False, buffer_size=DEFAULT_BUFFER_SIZE,
+               progress=None, interval=PROGRESS_INTERVAL, limiter=None):
+    """以二进制模式把 fileobj 从 rest (默认0) 开始的内容上传到 remote_path，返回本次发送的字节数
+
+    append 为 True 时用 APPE 追加到远程文件末尾，否则用 STOR (rest 不为空时先发送 REST)；
+    替代 storbinary：数据从文件直接发送到套接字，不经过 read() 读出的 bytes 对象
+    """
+    stopped = False
+    report = None
+    if progress is not None:
+        def report(sent):
+            nonlocal stopped
+            if progress(sent) is False:
+                stopped = True
+                return False
+
+    ftp.voidcmd('TYPE I')
+    command = 'APPE' if append else 'STOR'
+    with ftp.transfercmd(f'{command} {remote_path}', None if append else rest) as conn:
+        sent = send_file(conn, fileobj, rest or 0, None, buffer_size, report, interval, limiter)
+        if not stopped and _SSLSocket is not None and isinstance(conn, _SSLSocket):
+            conn.unwrap()
+    try:
+        ftp.voidresp()
+    except ftplib.error_temp:
+        if not stopped:
+            raise
+    return sent
+
+
+def _write_all(fileobj, data, hasher=None):
+    """写入全部数据 (无缓冲文件的 write 可能只写入一部分)，写入后再计入哈希"""
+    rest = data
+    while rest:
+        n = fileobj.write(rest)
+        if n is None or n >= len(rest):
+            break
+        rest = rest[n:]
+    if hasher is not None:
+        hasher.update(data)
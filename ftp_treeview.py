@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+虚拟化列表视图
+Treeview 中只保留可见区域的行，滚动时复用这些行并从数据源取新内容；
+每次刷新只修改内容发生变化的行，数万行的目录或任务列表也不会拖慢界面
+"""
+
+import tkinter as tk
+from tkinter import ttk
+from typing import Callable, Dict, List, Optional, Tuple
+
+# 行内容: (text, values, tags)
+RowData = Tuple[str, tuple, tuple]
+
+
+class VirtualTreeview:
+    """为 ttk.Treeview 提供虚拟滚动
+
+    row_provider(行号) 返回该行的 (text, values, tags)；
+    选择状态按行号保存，滚出可见区域后再滚回来依然保持选中
+    """
+
+    def __init__(self, tree: ttk.Treeview, scrollbar: ttk.Scrollbar,
+                 row_provider: Callable[[int], RowData]):
+        self.tree = tree
+        self.scrollbar = scrollbar
+        self.row_provider = row_provider
+
+        self.row_count = 0
+        self.top = 0          # 可见区域第一行的行号
+        self.visible = 20     # 可见行数，窗口尺寸变化时重新计算
+        self._slots: List[str] = []                       # 复用的行控件，按显示顺序
+        self._rendered: Dict[str, Tuple[int, RowData]] = {}  # 行控件 -> (行号, 已显示的内容)
+        self._selected = set()
+
+        # 滚动条和滚轮都由本类接管
+        scrollbar.configure(command=self._on_scrollbar)
+        tree.configure(yscrollcommand='')
+        tree.bind('<Configure>', self._on_resize, add='+')
+        tree.bind('<<TreeviewSelect>>', self._on_select, add='+')
+        tree.bind('<MouseWheel>', self._on_wheel)
+        tree.bind('<Button-4>', lambda e: self._scroll_by(-3))
+        tree.bind('<Button-5>', lambda e: self._scroll_by(3))
+        tree.bind('<Up>', lambda e: self._on_key(-1))
+        tree.bind('<Down>', lambda e: self._on_key(1))
+        tree.bind('<Prior>', lambda e: self._scroll_by(-self.visible))
+        tree.bind('<Next>', lambda e: self._scroll_by(self.visible))
+        tree.bind('<Home>', lambda e: self.scroll_to(0))
+        tree.bind('<End>', lambda e: self.scroll_to(self.row_count))
+
+    # ---------- 数据 ----------
+
+    def set_row_count(self, count: int, reset: bool = False):
+        """设置总行数并刷新；reset 为 True 时 (例如换了目录) 回到顶部并清除选择"""
+        self.row_count = count
+        if reset:
+            self.top = 0
+            self._selected.clear()
+        else:
+            self._selected = {row for row in self._selected if row < count}
+        self.refresh()
+
+    def refresh(self):
+        """按当前滚动位置重新取数据，只更新内容变化的行"""
+        count = self.row_count
+        self.top = max(0, min(self.top, count - self.visible))
+        end = min(count, self.top + self.visible)
+        wanted = end - self.top
+
+        tree = self.tree
+        while len(self._slots) < wanted:
+            self._slots.append(tree.insert('', tk.END))
+        while len(self._slots) > wanted:
+            iid = self._slots.pop()
+            self._rendered.pop(iid, None)
+            tree.delete(iid)
+
+        selection = []
+        for offset, iid in enumerate(self._slots):
+            row = self.top + offset
+            data = self.row_provider(row)
+            if self._rendered.get(iid) != (row, data):
+                text, values, tags = data
+                tree.item(iid, text=text, values=values, tags=tags)
+                self._rendered[iid] = (row, data)
+            if row in self._selected:
+                selection.append(iid)
+
+        if tuple(selection) != tree.selection():
+            tree.selection_set(selection)
+
+        if count:
+            self.scrollbar.set(self.top / count, end / count)
+        else:
+            self.scrollbar.set(0.0, 1.0)
+
+    # ---------- 选择 ----------
+
+    def selected_rows(self) -> List[int]:
+        """选中的行号 (升序)"""
+        return sorted(self._selected)
+
+    def row_of(self, iid: str) -> Optional[int]:
+        rendered = self._rendered.get(iid)
+        return rendered[0] if rendered else None
+
+    def row_at(self, y: int) -> Optional[int]:
+        """鼠标位置对应的行号"""
+        return self.row_of(self.tree.identify_row(y))
+
+    def clear(self):
+        self.set_row_count(0, reset=True)
+
+    def _on_select(self, event=None):
+        # 可见区域内以控件的选择为准，区域外的选择保持不变
+        visible_rows = {self.top + i for i in range(len(self._slots))}
+        chosen = {self.row_of(iid) for iid in self.tree.selection()} - {None}
+        self._selected = (self._selected - visible_rows) | chosen
+
+    # ---------- 滚动 ----------
+
+    def scroll_to(self, row: int):
+        self.top = row
+        self.refresh()
+        return 'break'
+
+    def _scroll_by(self, rows: int):
+        return self.scroll_to(self.top + rows)
+
+    def _on_scrollbar(self, action, *args):
+        if action == 'moveto':
+            self.scroll_to(int(float(args[0]) * self.row_count))
+        elif action == 'scroll':
+            amount = int(args[0])
+            self._scroll_by(amount * self.visible if args[1] == 'pages' else amount)
+
+    def _on_wheel(self, event):
+        return self._scroll_by(-3 if event.delta > 0 else 3)
+
+    def _on_key(self, step: int):
+        """方向键移到可见区域边缘时滚动一行并移动选择"""
+        focus = self.row_of(self.tree.focus())
+        if focus is None:
+            return None
+        target = focus + step
+        if 0 <= target - self.top < len(self._slots):
+            return None  # 仍在可见区域内，交给Treeview默认处理
+        if not 0 <= target < self.row_count:
+            return 'break'
+        self._selected = {target}
+        self.scroll_to(self.top + step)
+        iid = self._slots[target - self.top]
+        self.tree.focus(iid)
+        return 'break'
+
+    def _on_resize(self, event):
+        # 表头约占一行高度，只显示完整可见的行
+        visible = max(1, event.height // self._row_height() - 1)
+        if visible != self.visible:
+            self.visible = visible
+            self.refresh()
+
+    def _row_height(self) -> int:
+        style = ttk.Style(self.tree)
+        height = style.lookup(self.tree.cget('style') or 'Treeview', 'rowheight')
+        try:
+            return max(1, int(height))
+        except (TypeError, ValueError):
+            return 20
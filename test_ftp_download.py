@@ -8,9 +8,26 @@ FTP下载工具测试脚本
 import os
 import sys
 import time
+import ftplib
+import socket
+import asyncio
+import hashlib
 import tempfile
+import threading
 from pathlib import Path
-from ftp_downloader import FTPDownloader, parse_ftp_url
+from ftp_async import AsyncFTP, AsyncFileWriter
+from ftp_concurrency import ConcurrencyStore, ConcurrencyTuner
+from ftp_downloader import BatchDownloader, FTPDownloader, parse_ftp_url, read_manifest
+from ftp_faultproxy import FaultProfile, FaultProxy
+from ftp_integrity import BLOCK_SIZE, BlockLog, Checksum, IntegrityChecker, StreamHash, resume_blocks
+from ftp_journal import TransferJournal, resume_offset
+from ftp_listing import ListingEngine, ListingTable, RemoteEntry, parse_features, parse_list_line, parse_mlsd_line
+from ftp_storage import commit_part, download_part, open_part, part_path, resume_size, segment_path
+from ftp_sync import FileState, ManifestEntry, diff_trees
+from ftp_testserver import LocalFTPServer
+from ftp_ratelimit import SharedTokenBucket, TokenBucket, parse_rate
+from ftp_retry import POLICIES, RetryPolicy
+from ftp_transfer import SPLICE, AdaptiveBlockSizer, receive_into, send_file
 
 def test_public_ftp():
     """测试公共FTP服务器"""
@@ -120,6 +137,456 @@ def test_url_parsing():
         except Exception as e:
             print(f"✗ {url} - {e}")
 
+def test_read_manifest():
+    """测试批量下载清单解析"""
+    print("\n🧪 测试清单解析...")
+    
+    lines = [
+        "# 注释",
+        "pub/a.txt",
+        "ftp://u:p@other.example.com:2121/b.bin\tsaved/b.bin",
+        '{"path": "../c.txt", "local": "dir/"}',
+        "{bad",
+    ]
+    entries = read_manifest(lines, "ftp://ftp.example.com/data/", "out")
+    assert len(entries) == 4
+    assert entries[0]['remote'] == "/data/pub/a.txt"
+    assert entries[0]['local'] == str(Path("out/pub/a.txt"))
+    assert (entries[1]['host'], entries[1]['port'], entries[1]['username']) == ("other.example.com", 2121, "u")
+    assert entries[1]['local'] == str(Path("out/saved/b.bin"))
+    assert entries[2]['local'] == str(Path("out/dir/c.txt"))
+    assert 'error' in entries[3]
+    print("✓ 清单解析正确")
+
+def test_listing_parsers():
+    """测试MLSD/LIST解析"""
+    print("\n🧪 测试目录列表解析...")
+    
+    entry = parse_mlsd_line("type=file;size=1024;modify=20240102030405; name  with spaces.txt")
+    assert entry.name == "name  with spaces.txt"
+    assert entry.size == 1024 and not entry.is_dir
+    assert entry.mtime == 1704164645.0
+    assert parse_mlsd_line("type=cdir;modify=20240102030405; .") is None
+    
+    entry = parse_list_line("-rw-r--r--   1 ftp  ftp   2048 Jan  2  2024 two  spaces.bin")
+    assert entry.name == "two  spaces.bin" and entry.size == 2048
+    
+    entry = parse_list_line("drwxr-xr-x   2 ftp  ftp   4096 Jan  2  2024 pub")
+    assert entry.is_dir and entry.size == 0
+    
+    entry = parse_list_line("01-02-24  03:04PM       <DIR>          Program Files")
+    assert entry.is_dir and entry.name == "Program Files"
+    
+    assert parse_list_line("total 12") is None
+    print("✓ 解析结果正确")
+
+def test_listing_table():
+    """测试列表过滤和排序"""
+    print("\n🧪 测试列表过滤排序...")
+    
+    table = ListingTable([
+        RemoteEntry("b.txt", 300, False, 3.0),
+        RemoteEntry("pub", 0, True, 1.0),
+        RemoteEntry(".hidden", 10, False, 2.0),
+        RemoteEntry("A.bin", 200, False, 4.0),
+    ])
+    names = lambda rows: [table.names[i] for i in rows]
+    
+    assert names(table.query()) == ["pub", "A.bin", "b.txt"]
+    assert names(table.query(sort_key="size", descending=True)) == ["pub", "b.txt", "A.bin"]
+    assert names(table.query(sort_key="type", descending=True, show_hidden=True)) == ["b.txt", "A.bin", ".hidden", "pub"]
+    # 搜索词逐字延长时在上次结果中继续筛选
+    assert names(table.query("b")) == ["pub", "A.bin", "b.txt"]
+    assert names(table.query("b.")) == ["b.txt"]
+    assert names(table.query("")) == ["pub", "A.bin", "b.txt"]
+    print("✓ 过滤排序结果正确")
+
+def test_sync_diff():
+    """测试同步对比"""
+    print("\n🧪 测试同步对比...")
+    
+    remote = {'a': FileState(10, 1000.0), 'b': FileState(20, 2000.0), 'new': FileState(5, 3000.0)}
+    local = {'a': FileState(10, 5000.0), 'b': FileState(20, 2000.0), 'old': FileState(1, 100.0)}
+    previous = {'a': ManifestEntry(10, 1000.0, 5000.0)}
+    
+    # a 与清单一致，b 大小和时间相同，只需下载 new
+    plan = diff_trees(remote, local, previous, "download", delete_extra=True)
+    assert plan.downloads == ['new'] and plan.unchanged == 2
+    assert plan.delete_local == ['old']
+    
+    # 双向：远程改过的下载，本地新增的上传
+    remote['a'] = FileState(11, 1500.0)
+    plan = diff_trees(remote, local, previous, "bidirectional")
+    assert plan.downloads == ['a', 'new'] and plan.uploads == ['old']
+    print("✓ 对比结果正确")
+
+def test_adaptive_block_size():
+    """测试自适应块大小调整"""
+    print("\n🧪 测试自适应块大小...")
+    
+    # 吞吐量在256KB时最高：先翻倍试探，变差后折返，最终锁定在256KB
+    rates = {64: 100, 128: 150, 256: 200, 512: 120}
+    tuner = AdaptiveBlockSizer(initial=64 * 1024)
+    for _ in range(8):
+        size = tuner.block_size
+        rate = rates.get(size // 1024, 50) * 1024 * 1024
+        tuner.sample(1.0, rate, rate // size)
+    assert tuner.locked and tuner.block_size == 256 * 1024
+    
+    # recv 填不满块时不再加大
+    tuner = AdaptiveBlockSizer(initial=64 * 1024)
+    tuner.sample(1.0, 1000 * 4096, 1000)
+    assert tuner.locked and tuner.block_size == 64 * 1024
+    print(f"✓ {tuner.summary()}")
+
+def test_rate_limit():
+    """测试令牌桶限速"""
+    print("\n🧪 测试令牌桶限速...")
+    
+    assert parse_rate("500K") == 500 * 1024
+    assert parse_rate("2M") == 2 * 1024 * 1024
+    assert parse_rate("") == 0
+    
+    # 100KB/s：取走10KB需要等待约0.1秒，不限速时不等待；共享内存中的令牌桶行为相同
+    for factory in (TokenBucket, SharedTokenBucket):
+        bucket = factory(100 * 1024)
+        wait = bucket.reserve(10 * 1024)
+        assert 0.09 < wait <= 0.1
+        bucket.set_rate(0)
+        assert bucket.reserve(10 * 1024 * 1024) == 0
+    print("✓ 限速计算正确")
+
+def test_concurrency_tuner():
+    """测试并发数自动调节"""
+    print("\n🧪 测试并发数自动调节...")
+    
+    # 服务器总带宽在4个连接时饱和：3 -> 4 有提升，4 -> 5 没有提升，退回4
+    applied = []
+    received = [0]
+    with tempfile.TemporaryDirectory() as state_dir:
+        store = ConcurrencyStore(Path(state_dir) / "concurrency.json")
+        tuner = ConcurrencyTuner("example.com", applied.append, lambda: received[0],
+                                 initial=3, store=store)
+        for second in range(8):
+            received[0] += min(tuner.level, 4) * 10 * 1024 * 1024
+            tuner.tick(now=float(second))
+        assert tuner.level == 4 and not tuner.probing
+        assert applied == [4, 5, 4]
+        
+        # 421 会话数超限：立即减少并发并记住上限
+        assert tuner.report_error(ftplib.error_temp("421 Too many connections"))
+        assert tuner.level == 3 and tuner.ceiling == 3
+        assert not tuner.report_error(ftplib.error_perm("550 No such file"))
+        
+        # 下次从学到的并发数开始
+        learned = ConcurrencyTuner("example.com", applied.append, lambda: 0, store=store)
+        assert learned.level == 3 and learned.ceiling == 3
+    print("✓ 调节结果正确")
+
+def test_transfer_journal():
+    """测试传输日志"""
+    print("\n🧪 测试传输日志...")
+    
+    with tempfile.TemporaryDirectory() as state_dir:
+        db = Path(state_dir) / "journal.db"
+        local = Path(state_dir) / "big.iso"
+        session = ("example.com", 21, "anonymous")
+        journal = TransferJournal(db, commit_interval=60)
+        task_id = journal.add(session, "/pub/big.iso", str(local), 1000)
+        assert journal.add(session, "/pub/big.iso", str(local)) == task_id
+        journal.checkpoint(task_id, 600)
+        journal.close()
+        
+        # 重新打开 (模拟重启)：任务和已提交的偏移都还在
+        journal = TransferJournal(db)
+        entries = journal.entries(session)
+        assert [(e.remote_path, e.size, e.offset) for e in entries] == [("/pub/big.iso", 1000, 600)]
+        
+        # 续传位置取日志偏移和本地文件长度中较小的一个
+        local.write_bytes(b"x" * 800)
+        assert resume_offset(local, 600, 1000) == 600
+        assert resume_offset(local, 900, 1000) == 800
+        assert resume_offset(Path(state_dir) / "missing", 600, 1000) == 0
+        
+        journal.set_status(task_id, "已完成", offset=1000)
+        journal.clear(session, completed_only=True)
+        assert journal.entries(session) == []
+        journal.close()
+    print("✓ 日志记录和续传位置正确")
+
+def test_stream_hash():
+    """测试边收边算的哈希和续传时的前缀哈希"""
+    print("\n🧪 测试完整性校验...")
+    
+    data = os.urandom(300 * 1024)
+    expected = Checksum('sha256', hashlib.sha256(data).hexdigest().upper(), 'HASH')
+    with tempfile.TemporaryDirectory() as state_dir:
+        local = Path(state_dir) / "part.bin"
+        local.write_bytes(data[:100 * 1024])
+        
+        # 续传：本地前缀用 mmap 计算，之后接着计入新收到的数据
+        hasher = StreamHash('sha256').resume(local, 100 * 1024)
+        hasher.update(memoryview(data)[100 * 1024:])
+        assert hasher.length == len(data) and hasher.matches(expected)
+        assert not StreamHash('sha256').resume(local, 100 * 1024).matches(expected)
+    
+    # 部分服务器返回的CRC32省略前导零
+    crc = StreamHash('crc32')
+    crc.update(b"abc")
+    assert crc.matches(Checksum('crc32', crc.hexdigest().lstrip('0').upper(), 'XCRC'))
+    print("✓ 哈希计算正确")
+
+def test_block_resume():
+    """测试续传前的分块校验"""
+    print("\n🧪 测试分块校验续传...")
+    
+    data = os.urandom(3 * BLOCK_SIZE + 1000)
+    remote_size = 8 * BLOCK_SIZE
+    with tempfile.TemporaryDirectory() as state_dir:
+        local = Path(state_dir) / "part.bin"
+        local.write_bytes(data)
+        blocks = BlockLog(local, remote_size)
+        blocks.start([])
+        blocks.update(data)
+        blocks.close()
+        assert len(blocks.load()) == 3
+        
+        # 末尾不足一块的数据不可信，从最后一个完整块之后续传
+        offset, blocks = resume_blocks(None, "/big", local, remote_size, len(data))
+        blocks.close()
+        assert offset == 3 * BLOCK_SIZE and local.stat().st_size == offset
+        
+        # 最后一块写坏 (断电时没有落盘)，从这一块重新下载
+        with open(local, 'r+b') as f:
+            f.seek(2 * BLOCK_SIZE + 10)
+            f.write(b"torn")
+        offset, blocks = resume_blocks(None, "/big", local, remote_size, 3 * BLOCK_SIZE)
+        blocks.close()
+        assert offset == 2 * BLOCK_SIZE and len(blocks.load()) == 2
+    print("✓ 续传位置正确")
+
+def test_async_client():
+    """测试异步客户端的回复解析和文件写入"""
+    print("\n🧪 测试异步客户端...")
+    
+    async def run(path):
+        client = AsyncFTP()
+        client._reader = asyncio.StreamReader()
+        client._reader.feed_data(b"211-Features:\r\n MLST size*;\r\n SIZE\r\n211 End\r\n"
+                                 b"550 No such file\r\n")
+        features = parse_features(await client.getresp())
+        try:
+            await client.getresp()
+            raise AssertionError("5xx应抛出error_perm")
+        except ftplib.error_perm:
+            pass
+        
+        hasher = StreamHash('sha256')
+        async with AsyncFileWriter(path, 'wb', flush_size=1000, hasher=hasher) as writer:
+            for _ in range(5):
+                await writer.write(b"x" * 300)
+        return features, hasher, writer.written
+    
+    with tempfile.TemporaryDirectory() as state_dir:
+        path = Path(state_dir) / "out.bin"
+        features, hasher, written = asyncio.run(run(path))
+        assert features == {'MLST', 'SIZE'}
+        assert written == 1500 and path.read_bytes() == b"x" * 1500
+        assert hasher.hexdigest() == hashlib.sha256(b"x" * 1500).hexdigest()
+    print("✓ 回复解析和写入正确")
+
+def test_send_file():
+    """测试上传发送：从续传偏移开始发送文件的剩余部分"""
+    print("\n🧪 测试上传发送...")
+    
+    data = os.urandom(300000)
+    with tempfile.TemporaryDirectory() as state_dir:
+        path = Path(state_dir) / "up.bin"
+        path.write_bytes(data)
+        left, right = socket.socketpair()
+        received = []
+        
+        def drain():
+            while True:
+                chunk = right.recv(65536)
+                if not chunk:
+                    break
+                received.append(chunk)
+        
+        reader = threading.Thread(target=drain)
+        reader.start()
+        reports = []
+        with left, right, open(path, 'rb') as f:
+            sent = send_file(left, f, 1000, 50000, 4096)
+            sent += send_file(left, f, 51000, None, 4096, reports.append, interval=0)
+            left.shutdown(socket.SHUT_WR)
+            reader.join()
+        received = b"".join(received)
+        assert sent == len(data) - 1000 and received == data[1000:]
+        assert reports and reports[-1] == len(data) - 51000
+    print("✓ 发送内容正确")
+
+def test_splice_receive():
+    """测试 splice 接收：追加到已有文件之后，哈希与写入的内容一致"""
+    print("\n🧪 测试splice接收...")
+    
+    data = os.urandom(3 * 1024 * 1024 + 17)
+    with tempfile.TemporaryDirectory() as state_dir:
+        path = Path(state_dir) / "in.bin"
+        path.write_bytes(b"head")
+        left, right = socket.socketpair()
+        sender = threading.Thread(target=lambda: (left.sendall(data), left.close()))
+        sender.start()
+        hasher = StreamHash('sha256')
+        with right, open(path, 'ab', buffering=0) as f:
+            received = receive_into(right, f, SPLICE, hasher=hasher)
+            f.write(b"tail")
+        sender.join()
+        assert received == len(data)
+        assert path.read_bytes() == b"head" + data + b"tail"
+        assert hasher.hexdigest() == hashlib.sha256(data).hexdigest()
+    print("✓ 接收内容正确" if hasattr(os, 'splice') else "✓ 不支持splice时退回普通接收")
+
+def test_part_file():
+    """测试 .part 文件：旧版本留在目标路径的未完成文件改名续传，完成后核对大小再改名"""
+    print("\n🧪 测试.part文件...")
+    
+    with tempfile.TemporaryDirectory() as state_dir:
+        path = Path(state_dir) / "big.bin"
+        part = part_path(path)
+        path.write_bytes(b"x" * 100)
+        assert resume_size(path, 300) == 100
+        assert part.exists() and not path.exists()
+        
+        with open_part(part, 100, 300) as f:
+            f.write(b"y" * 150)
+        try:
+            commit_part(part, path, 300)
+            assert False, "大小不符时应抛出异常"
+        except IOError:
+            pass
+        assert resume_size(path, 300) == 250
+        
+        with open_part(part, 250, 300) as f:
+            f.write(b"z" * 50)
+        commit_part(part, path, 300)
+        assert not part.exists() and path.stat().st_size == 300
+        assert resume_size(path, 300) is None
+        assert resume_size(path, 200) == 0 and not path.exists()
+        
+        # 分段下载中断：.part 已扩展到完整长度，单连接续传只接着第一段写入的部分
+        part.write_bytes(b"a" * 100 + b"\0" * 150 + b"b" * 50)
+        segment_path(path).write_text('{"size": 300, "segments": [[0, 100, 150], [150, 300, 300]]}')
+        assert resume_size(path, 300) == 100
+        assert part.read_bytes() == b"a" * 100 and not segment_path(path).exists()
+        part.write_bytes(b"\0" * 300)
+        segment_path(path).write_text('{"size": 999, "segments": []}')
+        assert resume_size(path, 300) == 0
+    print("✓ 续传起点和改名正确")
+
+def test_local_server():
+    """测试本机FTP服务器：下载、断点续传和目录列表，不依赖公共服务器"""
+    print("\n🧪 测试本机FTP服务器...")
+    
+    data = os.urandom(300 * 1024 + 7)
+    with tempfile.TemporaryDirectory() as root, tempfile.TemporaryDirectory() as out:
+        (Path(root) / "pub").mkdir()
+        (Path(root) / "pub" / "data.bin").write_bytes(data)
+        with LocalFTPServer(root) as server:
+            host, port = server.address
+            downloader = FTPDownloader(host, "test", "test", port, verify=True)
+            assert downloader.connect()
+            local_path = Path(out) / "data.bin"
+            part_path(local_path).write_bytes(data[:100000])
+            assert downloader.download_with_resume("/pub/data.bin", str(local_path))
+            assert local_path.read_bytes() == data
+            entries = ListingEngine(downloader.ftp).list_dir("/pub")
+            assert [(e.name, e.size) for e in entries] == [("data.bin", len(data))]
+            downloader.disconnect()
+    print("✓ 下载、续传和列表正确")
+
+def test_download_part():
+    """测试共用的下载流程：从 .part 续传并核对校验值，大小未知时按实际长度改名，校验失败删除 .part"""
+    print("\n🧪 测试下载流程...")
+    
+    data = os.urandom(3 * BLOCK_SIZE + 7)
+    with tempfile.TemporaryDirectory() as root, tempfile.TemporaryDirectory() as out:
+        (Path(root) / "data.bin").write_bytes(data)
+        with LocalFTPServer(root) as server:
+            ftp = ftplib.FTP()
+            ftp.connect(*server.address)
+            ftp.login("test", "test")
+            integrity = IntegrityChecker()
+            offsets = []
+            
+            local_path = Path(out) / "data.bin"
+            part_path(local_path).write_bytes(data[:BLOCK_SIZE + 100])
+            offset = resume_size(local_path, len(data))
+            result = download_part(ftp, "/data.bin", local_path, len(data), offset,
+                                   lambda start: offsets.append(start), integrity=integrity)
+            assert result.status == "已完成" and result.checksum is not None
+            # 从最后一个完整的块续传
+            assert offsets == [BLOCK_SIZE] and local_path.read_bytes() == data
+            
+            # 服务器没有返回大小
+            unsized = Path(out) / "unsized.bin"
+            result = download_part(ftp, "/data.bin", unsized, 0, 0)
+            assert result.status == "已完成" and unsized.read_bytes() == data
+            
+            # 续传的前缀已损坏 (没有分块记录，无法发现)，整个文件的哈希不符
+            bad = Path(out) / "bad.bin"
+            part_path(bad).write_bytes(b"\0" * BLOCK_SIZE)
+            result = download_part(ftp, "/data.bin", bad, len(data), BLOCK_SIZE, integrity=integrity)
+            assert result.status == "失败" and result.downloaded == 0 and result.digest is not None
+            assert not bad.exists() and not part_path(bad).exists()
+            ftp.quit()
+    print("✓ 续传、校验和改名正确")
+
+def test_batch_download():
+    """测试批量下载：文件数超过 SIZE_BATCH * jobs 时查询大小的线程也能借到会话"""
+    print("\n🧪 测试批量下载...")
+    
+    jobs = 2
+    count = BatchDownloader.SIZE_BATCH * jobs + 10
+    with tempfile.TemporaryDirectory() as root, tempfile.TemporaryDirectory() as out:
+        for i in range(count):
+            (Path(root) / f"f{i:04d}.txt").write_bytes(b"%d" % i)
+        with LocalFTPServer(root) as server:
+            host, port = server.address
+            entries = read_manifest([f"f{i:04d}.txt" for i in range(count)], f"ftp://{host}:{port}/", out)
+            summary = {}
+            batch = BatchDownloader(jobs=jobs, max_retries=1)
+            thread = threading.Thread(target=lambda: summary.update(batch.run(entries)), daemon=True)
+            thread.start()
+            thread.join(60)
+            assert not thread.is_alive(), "批量下载没有结束"
+        assert summary['done'] == count and summary['failed'] == 0
+        assert (Path(out) / f"f{count - 1:04d}.txt").read_bytes() == b"%d" % (count - 1)
+    print("✓ 批量下载完成")
+
+def test_retry_after_reset():
+    """测试重试策略：经故障注入代理下载，数据连接被重置后立即重连并续传"""
+    print("\n🧪 测试断线重试...")
+    
+    policy = RetryPolicy(0.5, 2.0, 3.0)
+    assert [policy.wait(n) for n in (1, 2, 3, 4)] == [0.5, 1.0, 2.0, 3.0]
+    
+    data = os.urandom(2 * 1024 * 1024)
+    with tempfile.TemporaryDirectory() as root, tempfile.TemporaryDirectory() as out:
+        (Path(root) / "data.bin").write_bytes(data)
+        profile = FaultProfile(reset_rate=1.0, max_faults=2, seed=1)
+        with LocalFTPServer(root) as server, FaultProxy(server.address, profile) as proxy:
+            host, port = proxy.address
+            downloader = FTPDownloader(host, "test", "test", port, timeout=5, retry_policy=POLICIES["immediate"])
+            assert downloader.connect()
+            local_path = Path(out) / "data.bin"
+            assert downloader.download_with_resume("/data.bin", str(local_path), max_retries=3)
+            downloader.disconnect()
+            assert local_path.read_bytes() == data
+            assert proxy.stats["resets"] == 2
+            assert all(event.recovered is not None for event in proxy.events)
+    print("✓ 重置后续传成功")
+
 def main():
     """主测试函数"""
     print("🚀 FTP下载工具测试套件")
@@ -128,6 +595,60 @@ def main():
     # 测试URL解析
     test_url_parsing()
     
+    # 测试清单解析
+    test_read_manifest()
+    
+    # 测试目录列表解析
+    test_listing_parsers()
+    
+    # 测试列表过滤排序
+    test_listing_table()
+    
+    # 测试同步对比
+    test_sync_diff()
+    
+    # 测试自适应块大小
+    test_adaptive_block_size()
+    
+    # 测试限速
+    test_rate_limit()
+    
+    # 测试并发数自动调节
+    test_concurrency_tuner()
+    
+    # 测试传输日志
+    test_transfer_journal()
+    
+    # 测试完整性校验
+    test_stream_hash()
+    
+    # 测试分块校验续传
+    test_block_resume()
+    
+    # 测试异步客户端
+    test_async_client()
+    
+    # 测试上传发送
+    test_send_file()
+    
+    # 测试splice接收
+    test_splice_receive()
+    
+    # 测试.part文件
+    test_part_file()
+    
+    # 测试本机FTP服务器
+    test_local_server()
+    
+    # 测试下载流程
+    test_download_part()
+    
+    # 测试批量下载
+    test_batch_download()
+    
+    # 测试断线重试
+    test_retry_after_reset()
+    
     # 测试公共FTP服务器连接
     test_public_ftp()
     